@@ -1,13 +1,33 @@
-from typing import TypedDict, List, Dict, Any, Optional, Literal
+from typing import TypedDict, List, Dict, Any, Optional, Literal, NamedTuple, Generator, Callable, Iterator, AsyncIterator, Tuple
+from langgraph.config import get_stream_writer
 from langgraph.graph import StateGraph, START, END
-import google.generativeai as genai
+from langchain_core.runnables import RunnableLambda
 from dotenv import load_dotenv
+import asyncio
+import contextvars
+import json
 import os
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
 
 load_dotenv()
 
 # Import your existing RAG tools and prompts
-from rag import rag, shop_information_rag, search_internet
+from rag import rag, arag, search_internet, asearch_internet
+from shop_directory import get_shop_directory
+from search_client import get_search_client
+from context_budget import assemble_context
+from conversation_store import get_conversation_store, history_block
+from query_classifier import fast_detect_language, fast_route, refers_to_history
+from embeddings import aembed_texts, embed_texts
+from llm_provider import get_llm_provider
+from tracing import atraced_node, current_span, get_tracer, span, traced_node
+from decision_memo import DECISION_MEMO, get_decision_memo
+from response_cache import RESPONSE_CACHE, CachedResponse, get_response_cache, query_key
 from prompt import (
     MANAGER_INSTRUCTION, 
     PRODUCT_INSTRUCTION, 
@@ -15,12 +35,51 @@ from prompt import (
     QUERY_REWRITER_INSTRUCTION,
     CONTEXT_EVALUATOR_INSTRUCTION,
     SOURCE_SELECTOR_INSTRUCTION,
-    RESPONSE_EVALUATOR_INSTRUCTION
+    RESPONSE_EVALUATOR_INSTRUCTION,
+    QUERY_PLANNER_INSTRUCTION,
+    DECISION_PROMPT_VERSION
 )
 
-# Configure Gemini API
-genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-model = genai.GenerativeModel('gemini-2.0-flash')
+# Fast planner: one structured call replaces the language, rewrite, routing,
+# context and source-selection calls (falls back to them on invalid output)
+FAST_PLANNER = os.getenv("FAST_PLANNER", "false").lower() == "true"
+
+# Parallel retrieval: per-source timeouts and an overall deadline (seconds)
+SOURCE_TIMEOUTS = {
+    "vector_database": float(os.getenv("VECTOR_SOURCE_TIMEOUT", "5")),
+    "shop_database": float(os.getenv("SHOP_SOURCE_TIMEOUT", "2")),
+    "internet_search": float(os.getenv("INTERNET_SEARCH_TIMEOUT", "4")),
+}
+RETRIEVAL_DEADLINE = float(os.getenv("RETRIEVAL_DEADLINE", "6"))
+
+# Products retrieved per query, and the ceiling when a retry widens retrieval
+RETRIEVAL_K = int(os.getenv("RETRIEVAL_K", "5"))
+RETRIEVAL_MAX_K = int(os.getenv("RETRIEVAL_MAX_K", "20"))
+
+# Wall-clock budget for a whole turn (seconds); no retry starts with less
+# than RETRY_MIN_REMAINING left
+TURN_DEADLINE = float(os.getenv("TURN_DEADLINE", "30"))
+RETRY_MIN_REMAINING = float(os.getenv("RETRY_MIN_REMAINING", "8"))
+
+# Conversation store session used by the terminal chat
+CLI_SESSION_ID = "cli"
+
+# Shared by all turns; late sources finish in the background
+retrieval_pool = ThreadPoolExecutor(
+    max_workers=int(os.getenv("RETRIEVAL_WORKERS", "16")),
+    thread_name_prefix="retrieval"
+)
+
+# Stream the answer token by token in the command-line chat
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "false").lower() == "true"
+
+# How streamed answers are evaluated: "background" (after the answer is
+# delivered, no retry), "skip", or "inline" (before finalizing, may retry)
+STREAMING_EVALUATION = os.getenv("STREAMING_EVALUATION", "background").lower()
+evaluation_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="evaluation")
+
+VALID_ROUTES = {"product", "shop_information"}
+VALID_SOURCES = {"vector_database", "shop_database", "internet_search"}
 
 # Define our State
 class AgentState(TypedDict):
@@ -33,9 +92,18 @@ class AgentState(TypedDict):
     # Loop control
     max_iterations: int
     current_iteration: int
+    # Wall-clock time (time.time()) by which the turn must finish
+    deadline_at: Optional[float]
+    # Stages redone by retries so far ("retrieve", "rewrite", "regenerate")
+    retry_stages: List[str]
+    # Groups the turn's trace spans; turn_started_at is the turn's wall-clock start
+    trace_id: Optional[str]
+    turn_started_at: float
     
     # The conversation history
     messages: List[Dict[str, Any]]
+    # Compact, token-capped history block (running summary + recent turns) for prompts
+    history: str
     
     # Agent routing and decisions
     routing_decision: Optional[str]
@@ -47,6 +115,11 @@ class AgentState(TypedDict):
     shop_info_rag_results: Optional[str]
     internet_search_results: Optional[str]
     retrieved_context: Optional[str]
+    timed_out_sources: List[str]
+    # Estimated tokens of retrieved_context after budgeting
+    context_tokens: int
+    # Products requested from the vector database
+    retrieval_k: int
     
     # Response evaluation
     response: Optional[str]
@@ -54,32 +127,354 @@ class AgentState(TypedDict):
     
     # Final response
     final_response: Optional[str]
+    
+    # Whether the fast planner produced a valid plan for this turn
+    planner_used: bool
+    
+    # Stream answer tokens through the graph's custom stream mode
+    stream_response: bool
+    
+    # Whether the answer came from the semantic response cache
+    response_cache_hit: bool
+    
+    # Optional customer coordinates {"latitude", "longitude"} for nearest-store lookup
+    user_location: Optional[Dict[str, float]]
 
-def detect_language(state: AgentState):
-    """Detect the language of the user's query"""
+def parse_query_plan(text: str) -> Optional[Dict[str, Any]]:
+    """Parse and validate the planner's JSON output, returning None if it does not fit the schema"""
+    text = text.strip()
+    # Tolerate a fenced ```json block
+    fenced = re.search(r"```(?:json)?\s*(.*?)```", text, re.DOTALL)
+    if fenced:
+        text = fenced.group(1).strip()
+    
+    try:
+        plan = json.loads(text)
+    except json.JSONDecodeError:
+        return None
+    
+    if not isinstance(plan, dict):
+        return None
+    
+    language = plan.get("language")
+    rewritten_query = plan.get("rewritten_query")
+    route = plan.get("route")
+    needs_additional_info = plan.get("needs_additional_info")
+    sources = plan.get("sources", [])
+    
+    if not isinstance(language, str) or not language.strip():
+        return None
+    if not isinstance(rewritten_query, str) or not rewritten_query.strip():
+        return None
+    if not isinstance(route, str) or route.strip().lower() not in VALID_ROUTES:
+        return None
+    if isinstance(needs_additional_info, str) and needs_additional_info.strip().lower() in ("yes", "no", "true", "false"):
+        needs_additional_info = needs_additional_info.strip().lower() in ("yes", "true")
+    if not isinstance(needs_additional_info, bool):
+        return None
+    if isinstance(sources, str):
+        sources = sources.split(",")
+    if not isinstance(sources, list):
+        return None
+    
+    route = route.strip().lower()
+    sources = [str(source).strip() for source in sources if str(source).strip() in VALID_SOURCES]
+    if needs_additional_info and not sources:
+        sources = ["vector_database"] if route == "product" else ["shop_database"]
+    
+    return {
+        "language": language.strip().lower(),
+        "rewritten_query": rewritten_query.strip(),
+        "route": route,
+        "needs_additional_info": needs_additional_info,
+        "sources": sources
+    }
+
+class LLMCall(NamedTuple):
+    """A model request yielded by a node's step generator"""
+    prompt: str
+    json_mode: bool = False
+    # Forward tokens to the graph's custom stream as they arrive
+    stream: bool = False
+    # Node name under which a deterministic decision is memoized
+    memo: Optional[str] = None
+
+class EvaluationStats:
+    """Thread-safe counts of background response evaluations by outcome"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts: Counter = Counter()
+
+    def record(self, outcome: str) -> None:
+        with self._lock:
+            self._counts[outcome] += 1
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._counts)
+
+evaluation_stats = EvaluationStats()
+
+def _token_writer() -> Callable[[Any], None]:
+    """The graph's custom stream writer, or a no-op outside a graph run"""
+    try:
+        return get_stream_writer()
+    except RuntimeError:
+        return lambda chunk: None
+
+def _memo_lookup(call: LLMCall) -> Optional[str]:
+    if not (DECISION_MEMO and call.memo):
+        return None
+    value = get_decision_memo().get(call.memo, DECISION_PROMPT_VERSION, call.prompt)
+    if value is not None:
+        print(f"[System] Reusing memoized {call.memo} decision")
+    return value
+
+def _memo_store(call: LLMCall, text: str) -> None:
+    if DECISION_MEMO and call.memo:
+        get_decision_memo().put(call.memo, DECISION_PROMPT_VERSION, call.prompt, text)
+
+def _llm_span(call: LLMCall):
+    """Trace span for a model call, named after the decision or the calling node"""
+    parent = current_span()
+    name = call.memo or (parent.name if parent else "generate_content")
+    return span(name, "llm", json_mode=call.json_mode, stream=call.stream)
+
+def generate_text(call: LLMCall) -> str:
+    """Blocking model call, answered from the decision memo when possible"""
+    with _llm_span(call) as trace:
+        return _generate_text(call, trace)
+
+def _generate_text(call: LLMCall, trace) -> str:
+    memoized = _memo_lookup(call)
+    if trace is not None:
+        trace.set(cache_hit=memoized is not None)
+    if memoized is not None:
+        return memoized
+    
+    llm = get_llm_provider()
+    if not call.stream:
+        text = llm.generate(call.prompt, json_mode=call.json_mode)
+        _memo_store(call, text)
+        return text
+    
+    write = _token_writer()
+    parts = []
+    for text in llm.stream(call.prompt):
+        parts.append(text)
+        write({"event": "token", "text": text})
+    return "".join(parts)
+
+async def agenerate_text(call: LLMCall) -> str:
+    """Non-blocking model call, answered from the decision memo when possible"""
+    with _llm_span(call) as trace:
+        return await _agenerate_text(call, trace)
+
+async def _agenerate_text(call: LLMCall, trace) -> str:
+    memoized = _memo_lookup(call)
+    if trace is not None:
+        trace.set(cache_hit=memoized is not None)
+    if memoized is not None:
+        return memoized
+    
+    llm = get_llm_provider()
+    if not call.stream:
+        text = await llm.agenerate(call.prompt, json_mode=call.json_mode)
+        _memo_store(call, text)
+        return text
+    
+    write = _token_writer()
+    parts = []
+    async for text in llm.astream(call.prompt):
+        parts.append(text)
+        write({"event": "token", "text": text})
+    return "".join(parts)
+
+def run_steps(steps: Generator[LLMCall, str, Dict[str, Any]]) -> Dict[str, Any]:
+    """Drive a node's step generator with blocking model calls
+
+    Each node is written once as a generator that yields LLMCall requests and
+    receives the response text (or the raised exception) back, so the sync and
+    async graphs share the same node logic.
+    """
+    try:
+        call = next(steps)
+        while True:
+            try:
+                text = generate_text(call)
+            except Exception as e:
+                call = steps.throw(e)
+            else:
+                call = steps.send(text)
+    except StopIteration as stop:
+        return stop.value
+
+async def arun_steps(steps: Generator[LLMCall, str, Dict[str, Any]]) -> Dict[str, Any]:
+    """Drive a node's step generator with async model calls"""
+    try:
+        call = next(steps)
+        while True:
+            try:
+                text = await agenerate_text(call)
+            except Exception as e:
+                call = steps.throw(e)
+            else:
+                call = steps.send(text)
+    except StopIteration as stop:
+        return stop.value
+
+def record_turn(state: AgentState, **attributes: Any) -> None:
+    """Emit the turn's trace span with its totals and how the turn went"""
+    get_tracer().record_turn(
+        state.get("trace_id"),
+        state.get("turn_started_at"),
+        route=state.get("routing_decision"),
+        iterations=state.get("current_iteration"),
+        graph_retries=len(state.get("retry_stages") or []),
+        retry_stages=state.get("retry_stages") or [],
+        timed_out_sources=state.get("timed_out_sources") or [],
+        context_tokens=state.get("context_tokens"),
+        **attributes
+    )
+
+def _cached_response_update(state: AgentState, entry: CachedResponse) -> Dict[str, Any]:
+    print(f"[System] Response cache hit (cached query: {entry.query})")
+    if state.get("stream_response"):
+        _token_writer()({"event": "token", "text": entry.response})
+    return {
+        "response_cache_hit": True,
+        "language": entry.language or state["language"],
+        "routing_decision": entry.routing_decision,
+        "response": entry.response,
+        "response_quality_good": True,
+        "final_response": entry.response
+    }
+
+def response_cacheable(state: AgentState) -> bool:
+    """Whether the turn's answer depends on the query alone"""
+    # Answers for a located customer depend on where they are
+    if state.get("user_location"):
+        return False
+    # Follow-ups like "còn cái rẻ hơn?" depend on the conversation; self-contained
+    # questions later in a chat are answered as on a first turn
+    return not (state.get("history") and refers_to_history(state["original_query"]))
+
+def check_response_cache(state: AgentState):
+    """Answer near-duplicate questions from the semantic response cache"""
+    if not RESPONSE_CACHE or not response_cacheable(state):
+        return {"response_cache_hit": False}
+    
     query = state["original_query"]
-    print(f"\n[System] Detecting language for: {query}")
+    cache = get_response_cache()
+    try:
+        entry = cache.lookup_exact(query) or cache.lookup(embed_texts([query_key(query)])[0], query)
+    except Exception as e:
+        print(f"[System] Response cache lookup failed: {e}")
+        entry = None
+    
+    if entry is None:
+        return {"response_cache_hit": False}
+    return _cached_response_update(state, entry)
 
+async def acheck_response_cache(state: AgentState):
+    """Async variant of check_response_cache"""
+    if not RESPONSE_CACHE or not response_cacheable(state):
+        return {"response_cache_hit": False}
+    
+    query = state["original_query"]
+    cache = get_response_cache()
+    try:
+        # Lookups read the index version stamp, so they run off the event loop
+        entry = await asyncio.to_thread(cache.lookup_exact, query)
+        if entry is None:
+            embedding = (await aembed_texts([query_key(query)]))[0]
+            entry = await asyncio.to_thread(cache.lookup, embedding, query)
+    except Exception as e:
+        print(f"[System] Response cache lookup failed: {e}")
+        entry = None
+    
+    if entry is None:
+        return {"response_cache_hit": False}
+    return _cached_response_update(state, entry)
+
+def history_section(state: AgentState) -> str:
+    """Prompt lines with the conversation so far, or nothing on a first turn"""
+    history = state.get("history")
+    if not history:
+        return ""
+    return f"Conversation so far (use it to resolve references like \"it\" or \"the cheaper one\"):\n{history}\n"
+
+def plan_query_steps(state: AgentState):
+    """Planner agent: language, rewrite, routing, context need and sources in one call"""
+    query = state["original_query"]
+    print(f"\n[System] Planning query in a single call: {query}")
+    
     prompt = f"""
-    Detect the language of this query and respond with just the language code:
-    Query: {query}
+    {QUERY_PLANNER_INSTRUCTION}
     
-    Respond with only: 'vi' for Vietnamese, 'en' for English, or the appropriate language code.
+    {history_section(state)}
+    Query: {query}
     """
     
-    response = model.generate_content(prompt)
-    language = response.text.strip().lower()
+    try:
+        response_text = yield LLMCall(prompt, json_mode=True)
+        plan = parse_query_plan(response_text)
+    except Exception as e:
+        print(f"[System] Planner call failed: {e}")
+        plan = None
+    
+    if plan is None:
+        print("[System] Planner output invalid, falling back to step-by-step planning")
+        return {
+            "planner_used": False
+        }
     
-    print(f"[System] Detected language: {language}")
+    print(f"[System] Plan: language={plan['language']}, route={plan['route']}, "
+          f"needs additional info={plan['needs_additional_info']}, sources={plan['sources']}")
+    print(f"[System] Rewritten query: {plan['rewritten_query']}")
+    
+    return {
+        "language": plan["language"],
+        "rewritten_query": plan["rewritten_query"],
+        "current_query": plan["rewritten_query"],
+        "current_iteration": 1,
+        "routing_decision": plan["route"],
+        "needs_additional_info": plan["needs_additional_info"],
+        "selected_sources": plan["sources"],
+        "planner_used": True
+    }
+
+def detect_language_steps(state: AgentState):
+    """Detect the language of the user's query"""
+    query = state["original_query"]
+    print(f"\n[System] Detecting language for: {query}")
+
+    # Rule-based fast path; escalate to the LLM only when unsure
+    language = fast_detect_language(query)
+    
+    if language:
+        print(f"[System] Detected language (rules): {language}")
+    else:
+        prompt = f"""
+        Detect the language of this query and respond with just the language code:
+        Query: {query}
+        
+        Respond with only: 'vi' for Vietnamese, 'en' for English, or the appropriate language code.
+        """
+        
+        response_text = yield LLMCall(prompt, memo="detect_language")
+        language = response_text.strip().lower()
+        
+        print(f"[System] Detected language: {language}")
     
     return {
         "language": language,
         "current_query": query,
-        "current_iteration": 0,
-        "max_iterations": 3
+        "current_iteration": 0
     }
 
-def rewrite_query(state: AgentState):
+def rewrite_query_steps(state: AgentState):
     """Agent that rewrites the query for better processing"""
     current_query = state["current_query"]
     language = state["language"]
@@ -89,14 +484,15 @@ def rewrite_query(state: AgentState):
     prompt = f"""
     {QUERY_REWRITER_INSTRUCTION}
     
+    {history_section(state)}
     Original query: {current_query}
     Language: {language}
     
     Rewrite this query to be more specific and searchable while maintaining the original intent.
     """
     
-    response = model.generate_content(prompt)
-    rewritten_query = response.text.strip()
+    response_text = yield LLMCall(prompt, memo="rewrite_query")
+    rewritten_query = response_text.strip()
     
     print(f"[System] Rewritten query: {rewritten_query}")
     
@@ -106,27 +502,30 @@ def rewrite_query(state: AgentState):
         "current_iteration": state["current_iteration"] + 1
     }
 
-def determine_agent_and_context_need(state: AgentState):
+def determine_agent_and_context_need_steps(state: AgentState):
     """Manager agent determines routing and if additional context is needed"""
     query = state["current_query"]
     
     print(f"[System] Determining routing and context needs")
     
-    # First determine routing
-    routing_prompt = f"""
-    {MANAGER_INSTRUCTION}
-    
-    User query: {query}
-    
-    Determine if this should be handled by:
-    1. "product" - for product related queries
-    2. "shop_information" - for store information, hours, location, etc.
-    
-    Respond with just: "product" or "shop_information"
-    """
+    # First determine routing, using the rule-based fast path when it is confident
+    routing_decision = fast_route(query)
     
-    routing_response = model.generate_content(routing_prompt)
-    routing_decision = routing_response.text.strip().lower()
+    if not routing_decision:
+        routing_prompt = f"""
+        {MANAGER_INSTRUCTION}
+        
+        User query: {query}
+        
+        Determine if this should be handled by:
+        1. "product" - for product related queries
+        2. "shop_information" - for store information, hours, location, etc.
+        
+        Respond with just: "product" or "shop_information"
+        """
+        
+        routing_text = yield LLMCall(routing_prompt, memo="route_agent")
+        routing_decision = routing_text.strip().lower()
     
     # Then determine if additional context is needed
     context_prompt = f"""
@@ -145,8 +544,8 @@ def determine_agent_and_context_need(state: AgentState):
     Respond with just: "yes" or "no"
     """
     
-    context_response = model.generate_content(context_prompt)
-    needs_additional_info = context_response.text.strip().lower() == "yes"
+    context_text = yield LLMCall(context_prompt, memo="context_need")
+    needs_additional_info = context_text.strip().lower() == "yes"
     
     print(f"[System] Routing: {routing_decision}, Needs additional info: {needs_additional_info}")
     
@@ -155,7 +554,7 @@ def determine_agent_and_context_need(state: AgentState):
         "needs_additional_info": needs_additional_info
     }
 
-def select_information_sources(state: AgentState):
+def select_information_sources_steps(state: AgentState):
     """Agent that selects which sources to use for additional information"""
     query = state["current_query"]
     routing_decision = state["routing_decision"]
@@ -176,8 +575,8 @@ def select_information_sources(state: AgentState):
     You can select multiple sources. Respond with a comma-separated list like: "vector_database,internet_search"
     """
     
-    response = model.generate_content(prompt)
-    selected_sources = [source.strip() for source in response.text.strip().split(",")]
+    response_text = yield LLMCall(prompt, memo="select_information_sources")
+    selected_sources = [source.strip() for source in response_text.strip().split(",")]
     
     print(f"[System] Selected sources: {selected_sources}")
     
@@ -185,51 +584,146 @@ def select_information_sources(state: AgentState):
         "selected_sources": selected_sources
     }
 
+# Source name -> (state field, context heading)
+RETRIEVAL_SOURCES = {
+    "vector_database": ("product_rag_results", "Product Information"),
+    "shop_database": ("shop_info_rag_results", "Shop Information"),
+    "internet_search": ("internet_search_results", "Internet Search Results"),
+}
+
+def time_left(state: AgentState) -> float:
+    """Seconds until the turn deadline (infinite without one)"""
+    deadline_at = state.get("deadline_at")
+    return deadline_at - time.time() if deadline_at else float("inf")
+
+def source_timeout(name: str, elapsed: float, turn_remaining: float = float("inf")) -> float:
+    """Time left for a source given its own timeout, the retrieval deadline and the turn deadline"""
+    limit = min(SOURCE_TIMEOUTS.get(name, RETRIEVAL_DEADLINE), RETRIEVAL_DEADLINE, turn_remaining)
+    return max(0.0, limit - elapsed)
+
+def budget_context(state: AgentState, results: List[Tuple[str, str, str]]) -> Dict[str, Any]:
+    """Deduplicate, rank and trim retrieved results to the context token budget"""
+    primary_source = "shop_database" if "shop" in (state.get("routing_decision") or "") else "vector_database"
+    assembly = assemble_context(results, primary_source=primary_source)
+    
+    print(f"[System] Context uses {assembly.tokens_used}/{assembly.token_budget or 'unlimited'} tokens "
+          f"({assembly.chunks_used} chunks, {assembly.chunks_dropped} dropped)")
+    
+    return {
+        "retrieved_context": assembly.text,
+        "context_tokens": assembly.tokens_used
+    }
+
 def retrieve_context(state: AgentState):
-    """Retrieve context from selected sources"""
+    """Retrieve context from selected sources
+
+    Selected sources run concurrently. Each has its own timeout and the whole
+    step has a deadline; sources that are late are dropped and listed in
+    timed_out_sources instead of holding up the answer.
+    """
     query = state["current_query"]
     selected_sources = state["selected_sources"]
+    # Area names may be dropped by the rewrite, so match stores on both queries
+    shop_query = f"{state['original_query']} {query}"
+    retrieval_k = state.get("retrieval_k") or RETRIEVAL_K
     
     print(f"[System] Retrieving context from sources: {selected_sources}")
     
-    retrieved_context = ""
+    fetchers = {
+        "vector_database": lambda: rag(query, n_results=retrieval_k),
+        "shop_database": lambda: get_shop_directory().context_for(shop_query, state.get("user_location")),
+        "internet_search": lambda: search_internet(query),
+    }
     
-    # Retrieve from vector database (products)
-    if "vector_database" in selected_sources:
-        try:
-            product_rag_results = rag(query)
-            retrieved_context += f"Product Information:\n{product_rag_results}\n\n"
-            print(f"[System] Retrieved product information")
-        except Exception as e:
-            print(f"[System] Error retrieving product info: {e}")
+    turn_remaining = time_left(state)
+    started = time.monotonic()
+    futures = {
+        name: retrieval_pool.submit(contextvars.copy_context().run, fetch)
+        for name, fetch in fetchers.items()
+        if name in selected_sources
+    }
+    
+    updates: Dict[str, Any] = {}
+    results = []
+    timed_out_sources = []
     
-    # Retrieve from shop database
-    if "shop_database" in selected_sources:
+    # Collect in a fixed order so the context layout stays stable
+    for name, future in futures.items():
+        field, heading = RETRIEVAL_SOURCES[name]
+        
         try:
-            shop_info_rag_results = shop_information_rag()
-            shop_info_text = "\n".join([
-                f"Address: {shop['address']}, Hours: {shop['opening_hours']}, Maps: {shop['maps_url']}"
-                for shop in shop_info_rag_results
-            ])
-            retrieved_context += f"Shop Information:\n{shop_info_text}\n\n"
-            print(f"[System] Retrieved shop information")
+            result = future.result(timeout=source_timeout(name, time.monotonic() - started, turn_remaining))
+            updates[field] = result
+            results.append((name, heading, result))
+            print(f"[System] Retrieved {heading.lower()}")
+        except FuturesTimeoutError:
+            timed_out_sources.append(name)
+            print(f"[System] {name} timed out, continuing without it")
         except Exception as e:
-            print(f"[System] Error retrieving shop info: {e}")
+            print(f"[System] Error retrieving {name}: {e}")
+    
+    print(f"[System] Retrieval finished in {time.monotonic() - started:.2f}s")
     
-    # Retrieve from internet search
-    if "internet_search" in selected_sources:
+    updates.update(budget_context(state, results))
+    updates["timed_out_sources"] = timed_out_sources
+    return updates
+
+async def aretrieve_context(state: AgentState):
+    """Async variant of retrieve_context
+
+    Sources run as tasks on the event loop; late ones are cancelled rather
+    than left running in a thread.
+    """
+    query = state["current_query"]
+    selected_sources = state["selected_sources"]
+    # Area names may be dropped by the rewrite, so match stores on both queries
+    shop_query = f"{state['original_query']} {query}"
+    retrieval_k = state.get("retrieval_k") or RETRIEVAL_K
+    
+    print(f"[System] Retrieving context from sources: {selected_sources}")
+    
+    async def fetch_shop_information():
+        return get_shop_directory().context_for(shop_query, state.get("user_location"))
+    
+    fetchers = {
+        "vector_database": lambda: arag(query, n_results=retrieval_k),
+        "shop_database": fetch_shop_information,
+        "internet_search": lambda: asearch_internet(query),
+    }
+    
+    turn_remaining = time_left(state)
+    started = time.monotonic()
+    tasks = {
+        name: asyncio.ensure_future(fetch())
+        for name, fetch in fetchers.items()
+        if name in selected_sources
+    }
+    
+    updates: Dict[str, Any] = {}
+    results = []
+    timed_out_sources = []
+    
+    for name, task in tasks.items():
+        field, heading = RETRIEVAL_SOURCES[name]
+        
         try:
-            internet_search_results = search_internet(query)
-            retrieved_context += f"Internet Search Results:\n{internet_search_results}\n\n"
-            print(f"[System] Retrieved internet search results")
+            result = await asyncio.wait_for(task, timeout=source_timeout(name, time.monotonic() - started, turn_remaining))
+            updates[field] = result
+            results.append((name, heading, result))
+            print(f"[System] Retrieved {heading.lower()}")
+        except asyncio.TimeoutError:
+            timed_out_sources.append(name)
+            print(f"[System] {name} timed out, continuing without it")
         except Exception as e:
-            print(f"[System] Error with internet search: {e}")
+            print(f"[System] Error retrieving {name}: {e}")
     
-    return {
-        "retrieved_context": retrieved_context
-    }
+    print(f"[System] Retrieval finished in {time.monotonic() - started:.2f}s")
+    
+    updates.update(budget_context(state, results))
+    updates["timed_out_sources"] = timed_out_sources
+    return updates
 
-def generate_response(state: AgentState):
+def generate_response_steps(state: AgentState):
     """Generate response based on routing decision and available context"""
     query = state["current_query"]
     routing_decision = state["routing_decision"]
@@ -246,6 +740,7 @@ def generate_response(state: AgentState):
     prompt = f"""
     {instruction}
     
+    {history_section(state)}
     User query: {query}
     Language: {language}
     
@@ -254,8 +749,8 @@ def generate_response(state: AgentState):
     Provide a helpful and accurate response in {language}.
     """
     
-    response = model.generate_content(prompt)
-    generated_response = response.text.strip()
+    response_text = yield LLMCall(prompt, stream=state.get("stream_response", False))
+    generated_response = response_text.strip()
     
     print(f"[System] Generated response")
     
@@ -263,7 +758,7 @@ def generate_response(state: AgentState):
         "response": generated_response
     }
 
-def evaluate_response(state: AgentState):
+def evaluate_response_steps(state: AgentState):
     """Evaluate if the response adequately answers the query"""
     query = state["current_query"]
     response = state["response"]
@@ -288,8 +783,8 @@ def evaluate_response(state: AgentState):
     Respond with just: "yes" or "no"
     """
     
-    evaluation_response = model.generate_content(prompt)
-    response_quality_good = evaluation_response.text.strip().lower() == "yes"
+    evaluation_text = yield LLMCall(prompt)
+    response_quality_good = evaluation_text.strip().lower() == "yes"
     
     print(f"[System] Response quality good: {response_quality_good}")
     
@@ -297,15 +792,145 @@ def evaluate_response(state: AgentState):
         "response_quality_good": response_quality_good
     }
 
+def internet_search_available() -> bool:
+    """Whether adding internet search on a retry could return anything"""
+    client = get_search_client()
+    return bool(client.api_key) and client.breaker.state != "open"
+
+def plan_retry(state: AgentState):
+    """Pick the cheapest stage to redo after a poor evaluation
+
+    In order of preference: fetch context for an answer that had none, widen
+    product retrieval and add internet search, rewrite the query once, and
+    finally regenerate from the same context. Each retry uses one iteration
+    of the caller's budget (rewrite_query counts its own).
+    """
+    stages = list(state.get("retry_stages") or [])
+    sources = list(state.get("selected_sources") or [])
+    retrieval_k = state.get("retrieval_k") or RETRIEVAL_K
+    update: Dict[str, Any] = {}
+
+    if not state.get("needs_additional_info") or not sources:
+        stage = "retrieve"
+        update["needs_additional_info"] = True
+        update["selected_sources"] = ["vector_database"] if state.get("routing_decision") == "product" else ["shop_database"]
+    elif ("vector_database" in sources and retrieval_k < RETRIEVAL_MAX_K) or (
+        "internet_search" not in sources and internet_search_available()
+    ):
+        stage = "retrieve"
+        if "vector_database" in sources:
+            update["retrieval_k"] = min(retrieval_k * 2, RETRIEVAL_MAX_K)
+        if "internet_search" not in sources and internet_search_available():
+            update["selected_sources"] = sources + ["internet_search"]
+    elif "rewrite" not in stages:
+        stage = "rewrite"
+    else:
+        stage = "regenerate"
+
+    if stage != "rewrite":
+        update["current_iteration"] = state["current_iteration"] + 1
+    update["retry_stages"] = stages + [stage]
+
+    changes = ", ".join(f"{key}={value}" for key, value in update.items() if key not in ("retry_stages", "current_iteration"))
+    print(f"[System] Retrying stage: {stage}" + (f" ({changes})" if changes else ""))
+    return update
+
+def evaluate_in_background(state: AgentState) -> None:
+    """Score an already delivered response off the critical path
+
+    The turn has been recorded by the time this runs, so its spans go to a
+    trace of their own, linked back through turn_trace_id.
+    """
+    trace_id = uuid.uuid4().hex
+
+    def run():
+        try:
+            with span("evaluate_in_background", "node", trace_id, turn_trace_id=state.get("trace_id")):
+                result = run_steps(evaluate_response_steps(state))
+                evaluation_stats.record("good" if result["response_quality_good"] else "poor")
+                if result["response_quality_good"]:
+                    cache_response(state)
+        except Exception as e:
+            print(f"[System] Background evaluation failed: {e}")
+            evaluation_stats.record("failed")
+        finally:
+            get_tracer().discard_turn(trace_id)
+    
+    # A fresh context: the caller's open node span must not become the parent
+    evaluation_pool.submit(contextvars.Context().run, run)
+
+def _should_cache_response(state: AgentState) -> bool:
+    """Whether a finished answer may be cached: complete context, and not itself a cache hit"""
+    if not RESPONSE_CACHE or state.get("response_cache_hit") or not state.get("response"):
+        return False
+    return response_cacheable(state) and not state.get("timed_out_sources")
+
+def cache_response(state: AgentState) -> None:
+    """Store a finished answer in the response cache unless it was built from partial context"""
+    if not _should_cache_response(state):
+        return
+    
+    query = state["original_query"]
+    try:
+        # Usually an embedding cache hit from the lookup at the start of the turn
+        embedding = embed_texts([query_key(query)])[0]
+        get_response_cache().put(query, embedding, state["response"], state.get("language"), state.get("routing_decision"))
+    except Exception as e:
+        print(f"[System] Could not cache response: {e}")
+
+async def acache_response(state: AgentState) -> None:
+    """Async variant of cache_response"""
+    if not _should_cache_response(state):
+        return
+    
+    query = state["original_query"]
+    try:
+        embedding = (await aembed_texts([query_key(query)]))[0]
+        await asyncio.to_thread(
+            get_response_cache().put, query, embedding, state["response"], state.get("language"), state.get("routing_decision")
+        )
+    except Exception as e:
+        print(f"[System] Could not cache response: {e}")
+
+def _finalize_action(state: AgentState) -> Optional[str]:
+    """"evaluate" in the background, "cache" the answer now, or None"""
+    # Streamed answers skip inline evaluation unless configured otherwise
+    streamed_unevaluated = state.get("stream_response") and STREAMING_EVALUATION != "inline"
+    if streamed_unevaluated and STREAMING_EVALUATION == "background":
+        return "evaluate"
+    if streamed_unevaluated or state.get("response_quality_good"):
+        return "cache"
+    return None
+
 def finalize_response(state: AgentState):
     """Finalize the response"""
     print(f"[System] Finalizing response")
     
+    action = _finalize_action(state)
+    if action == "evaluate":
+        evaluate_in_background(state)
+    elif action == "cache":
+        cache_response(state)
+    
     return {
         "final_response": state["response"]
     }
 
-def handle_no_context_response(state: AgentState):
+async def afinalize_response(state: AgentState):
+    """Async variant of finalize_response; embedding and cache writes stay off the event loop"""
+    print(f"[System] Finalizing response")
+    
+    action = _finalize_action(state)
+    if action == "evaluate":
+        evaluate_in_background(state)
+    elif action == "cache":
+        await acache_response(state)
+    
+    return {
+        "final_response": state["response"]
+    }
+
+def handle_no_context_response_steps(state: AgentState):
     """Handle direct response without additional context"""
     query = state["current_query"]
     routing_decision = state["routing_decision"]
@@ -321,20 +946,123 @@ def handle_no_context_response(state: AgentState):
     prompt = f"""
     {instruction}
     
+    {history_section(state)}
     User query: {query}
     Language: {language}
     
     Provide a helpful response based on general knowledge. Answer in {language}.
     """
     
-    response = model.generate_content(prompt)
-    generated_response = response.text.strip()
+    response_text = yield LLMCall(prompt, stream=state.get("stream_response", False))
+    generated_response = response_text.strip()
     
     return {
         "response": generated_response
     }
 
+# Blocking and async node functions built from the shared step generators
+def plan_query(state: AgentState):
+    return run_steps(plan_query_steps(state))
+
+async def aplan_query(state: AgentState):
+    return await arun_steps(plan_query_steps(state))
+
+def detect_language(state: AgentState):
+    return run_steps(detect_language_steps(state))
+
+async def adetect_language(state: AgentState):
+    return await arun_steps(detect_language_steps(state))
+
+def rewrite_query(state: AgentState):
+    return run_steps(rewrite_query_steps(state))
+
+async def arewrite_query(state: AgentState):
+    return await arun_steps(rewrite_query_steps(state))
+
+def determine_agent_and_context_need(state: AgentState):
+    return run_steps(determine_agent_and_context_need_steps(state))
+
+async def adetermine_agent_and_context_need(state: AgentState):
+    return await arun_steps(determine_agent_and_context_need_steps(state))
+
+def select_information_sources(state: AgentState):
+    return run_steps(select_information_sources_steps(state))
+
+async def aselect_information_sources(state: AgentState):
+    return await arun_steps(select_information_sources_steps(state))
+
+def generate_response(state: AgentState):
+    return run_steps(generate_response_steps(state))
+
+async def agenerate_response(state: AgentState):
+    return await arun_steps(generate_response_steps(state))
+
+def evaluate_response(state: AgentState):
+    return run_steps(evaluate_response_steps(state))
+
+async def aevaluate_response(state: AgentState):
+    return await arun_steps(evaluate_response_steps(state))
+
+async def aplan_retry(state: AgentState):
+    # Checking the search client's circuit breaker takes its lock
+    return await asyncio.to_thread(plan_retry, state)
+
+def handle_no_context_response(state: AgentState):
+    return run_steps(handle_no_context_response_steps(state))
+
+async def ahandle_no_context_response(state: AgentState):
+    return await arun_steps(handle_no_context_response_steps(state))
+
+def _record_finished_turn(state: AgentState, update: Dict[str, Any]) -> None:
+    """Emit the turn span once a node has produced the final response"""
+    if not update.get("final_response"):
+        return
+    finished = {**state, **update}
+    record_turn(
+        finished,
+        response_cache_hit=bool(finished.get("response_cache_hit")),
+        response_quality_good=finished.get("response_quality_good"),
+    )
+
+def graph_node(name: str, func, afunc, ends_turn: bool = False) -> RunnableLambda:
+    """Traced node with a blocking implementation for invoke/stream and a native one for ainvoke/astream
+
+    With ends_turn, the turn span is recorded after the node's own span has
+    closed, so the node counts towards the turn's totals.
+    """
+    traced, atraced = traced_node(name, func), atraced_node(name, afunc)
+    if not ends_turn:
+        return RunnableLambda(traced, afunc=atraced, name=name)
+
+    def run(state):
+        update = traced(state)
+        _record_finished_turn(state, update)
+        return update
+
+    async def arun(state):
+        update = await atraced(state)
+        if update.get("final_response"):
+            await asyncio.to_thread(_record_finished_turn, state, update)
+        return update
+
+    return RunnableLambda(run, afunc=arun, name=name)
+
 # Routing functions
+def route_entry(state: AgentState) -> str:
+    """End on a response cache hit, else start with the single-call planner when fast planner mode is on"""
+    if state.get("response_cache_hit"):
+        return "cached"
+    return "plan" if FAST_PLANNER else "detect_language"
+
+def route_plan_result(state: AgentState) -> str:
+    """Skip straight to retrieval or generation when the planner produced a valid plan"""
+    if not state.get("planner_used"):
+        return "fallback"
+    elif state["needs_additional_info"]:
+        return "retrieve"
+    else:
+        return "generate_direct"
+
 def route_context_need(state: AgentState) -> str:
     """Route based on whether additional context is needed"""
     if state["needs_additional_info"]:
@@ -342,15 +1070,45 @@ def route_context_need(state: AgentState) -> str:
     else:
         return "generate_direct"
 
+def route_generated_response(state: AgentState) -> str:
+    """Streamed answers are already on screen, so evaluate them only if configured inline
+
+    Past the turn deadline the answer is delivered as is.
+    """
+    if state.get("stream_response") and STREAMING_EVALUATION != "inline":
+        return "finalize"
+    elif time_left(state) <= 0:
+        return "finalize"
+    else:
+        return "evaluate"
+
 def route_response_evaluation(state: AgentState) -> str:
-    """Route based on response quality and iteration count"""
+    """Route based on response quality, iteration budget and time left in the turn"""
     if state["response_quality_good"]:
         return "finalize"
     elif state["current_iteration"] >= state["max_iterations"]:
         return "finalize"  # Stop after max iterations
+    elif time_left(state) < RETRY_MIN_REMAINING:
+        return "finalize"  # Not enough time for another attempt
     else:
         return "retry"
 
+def route_retry_stage(state: AgentState) -> str:
+    """Jump to the stage chosen by plan_retry"""
+    stage = state["retry_stages"][-1]
+    if stage == "regenerate":
+        return "regenerate" if state.get("retrieved_context") else "generate_direct"
+    return stage
+
+def route_after_rewrite(state: AgentState) -> str:
+    """A retry rewrite keeps the route and sources; a first-pass rewrite goes on to routing"""
+    if not state.get("retry_stages"):
+        return "route"
+    elif state.get("needs_additional_info"):
+        return "retrieve"
+    else:
+        return "generate_direct"
+
 def route_agent_type(state: AgentState) -> str:
     """Route to appropriate agent based on routing decision"""
     routing_decision = state.get("routing_decision", "").lower()
@@ -365,20 +1123,56 @@ def route_agent_type(state: AgentState) -> str:
 agent_graph = StateGraph(AgentState)
 
 # Add nodes
-agent_graph.add_node("detect_language", detect_language)
-agent_graph.add_node("rewrite_query", rewrite_query)
-agent_graph.add_node("determine_agent_and_context_need", determine_agent_and_context_need)
-agent_graph.add_node("select_information_sources", select_information_sources)
-agent_graph.add_node("retrieve_context", retrieve_context)
-agent_graph.add_node("generate_response", generate_response)
-agent_graph.add_node("generate_direct_response", handle_no_context_response)
-agent_graph.add_node("evaluate_response", evaluate_response)
-agent_graph.add_node("finalize_response", finalize_response)
+agent_graph.add_node("check_response_cache", graph_node("check_response_cache", check_response_cache, acheck_response_cache, ends_turn=True))
+agent_graph.add_node("plan_query", graph_node("plan_query", plan_query, aplan_query))
+agent_graph.add_node("detect_language", graph_node("detect_language", detect_language, adetect_language))
+agent_graph.add_node("rewrite_query", graph_node("rewrite_query", rewrite_query, arewrite_query))
+agent_graph.add_node("determine_agent_and_context_need", graph_node("determine_agent_and_context_need", determine_agent_and_context_need, adetermine_agent_and_context_need))
+agent_graph.add_node("select_information_sources", graph_node("select_information_sources", select_information_sources, aselect_information_sources))
+agent_graph.add_node("retrieve_context", graph_node("retrieve_context", retrieve_context, aretrieve_context))
+agent_graph.add_node("generate_response", graph_node("generate_response", generate_response, agenerate_response))
+agent_graph.add_node("generate_direct_response", graph_node("generate_direct_response", handle_no_context_response, ahandle_no_context_response))
+agent_graph.add_node("evaluate_response", graph_node("evaluate_response", evaluate_response, aevaluate_response))
+agent_graph.add_node("plan_retry", graph_node("plan_retry", plan_retry, aplan_retry))
+agent_graph.add_node("finalize_response", graph_node("finalize_response", finalize_response, afinalize_response, ends_turn=True))
 
 # Define the flow
-agent_graph.add_edge(START, "detect_language")
+agent_graph.add_edge(START, "check_response_cache")
+
+# A cached answer ends the turn without any LLM call
+agent_graph.add_conditional_edges(
+    "check_response_cache",
+    route_entry,
+    {
+        "cached": END,
+        "plan": "plan_query",
+        "detect_language": "detect_language"
+    }
+)
+
+# A valid plan skips the step-by-step nodes; an invalid one falls back to them
+agent_graph.add_conditional_edges(
+    "plan_query",
+    route_plan_result,
+    {
+        "retrieve": "retrieve_context",
+        "generate_direct": "generate_direct_response",
+        "fallback": "detect_language"
+    }
+)
+
 agent_graph.add_edge("detect_language", "rewrite_query")
-agent_graph.add_edge("rewrite_query", "determine_agent_and_context_need")
+
+# A retry rewrite skips routing and source selection
+agent_graph.add_conditional_edges(
+    "rewrite_query",
+    route_after_rewrite,
+    {
+        "route": "determine_agent_and_context_need",
+        "retrieve": "retrieve_context",
+        "generate_direct": "generate_direct_response"
+    }
+)
 
 # Add conditional branching for context need
 agent_graph.add_conditional_edges(
@@ -394,9 +1188,16 @@ agent_graph.add_conditional_edges(
 agent_graph.add_edge("select_information_sources", "retrieve_context")
 agent_graph.add_edge("retrieve_context", "generate_response")
 
-# Both paths lead to response evaluation
-agent_graph.add_edge("generate_response", "evaluate_response")
-agent_graph.add_edge("generate_direct_response", "evaluate_response")
+# Both paths lead to response evaluation, unless a streamed answer skips it
+for generation_node in ["generate_response", "generate_direct_response"]:
+    agent_graph.add_conditional_edges(
+        generation_node,
+        route_generated_response,
+        {
+            "evaluate": "evaluate_response",
+            "finalize": "finalize_response"
+        }
+    )
 
 # Add conditional branching for response evaluation
 agent_graph.add_conditional_edges(
@@ -404,20 +1205,149 @@ agent_graph.add_conditional_edges(
     route_response_evaluation,
     {
         "finalize": "finalize_response",
-        "retry": "rewrite_query"  # Go back to rewrite query
+        "retry": "plan_retry"
+    }
+)
+
+# Redo only the stage plan_retry picked
+agent_graph.add_conditional_edges(
+    "plan_retry",
+    route_retry_stage,
+    {
+        "retrieve": "retrieve_context",
+        "rewrite": "rewrite_query",
+        "regenerate": "generate_response",
+        "generate_direct": "generate_direct_response"
     }
 )
 
 # Final edge
 agent_graph.add_edge("finalize_response", END)
 
-# Compile the graph
+# Compile the graph; invoke/stream run the blocking nodes, ainvoke/astream the async ones
 compiled_graph = agent_graph.compile()
 
+def initial_state(
+    user_input: str,
+    conversation_history: Optional[List[Dict[str, Any]]] = None,
+    max_iterations: int = 3,
+    stream_response: bool = False,
+    user_location: Optional[Dict[str, float]] = None,
+    turn_deadline: float = TURN_DEADLINE,
+    history: Optional[str] = None
+) -> AgentState:
+    """Input state for one conversation turn; the turn deadline starts counting now
+
+    Prompts see `history` (e.g. from the conversation store) or, when it is
+    omitted, the newest conversation_history messages that fit the history
+    token cap, so prompt size does not grow with the conversation.
+    """
+    conversation_history = conversation_history or []
+    if history is None:
+        history = history_block("", conversation_history)
+    return {
+        "original_query": user_input,
+        "rewritten_query": "",
+        "current_query": user_input,
+        "language": "en",
+        "max_iterations": max_iterations,
+        "current_iteration": 0,
+        "deadline_at": time.time() + turn_deadline if turn_deadline > 0 else None,
+        "trace_id": uuid.uuid4().hex,
+        "turn_started_at": time.time(),
+        "retry_stages": [],
+        "messages": conversation_history + [{"role": "user", "content": user_input}],
+        "history": history,
+        "routing_decision": None,
+        "needs_additional_info": False,
+        "selected_sources": [],
+        "product_rag_results": None,
+        "shop_info_rag_results": None,
+        "internet_search_results": None,
+        "retrieved_context": None,
+        "timed_out_sources": [],
+        "context_tokens": 0,
+        "retrieval_k": RETRIEVAL_K,
+        "response": None,
+        "response_quality_good": False,
+        "final_response": None,
+        "planner_used": False,
+        "stream_response": stream_response,
+        "response_cache_hit": False,
+        "user_location": user_location
+    }
+
+async def ainvoke(user_input: str, conversation_history: Optional[List[Dict[str, Any]]] = None, max_iterations: int = 3) -> Dict[str, Any]:
+    """Run one turn through the graph without blocking the event loop"""
+    return await compiled_graph.ainvoke(initial_state(user_input, conversation_history, max_iterations))
+
+class NodeEvent(NamedTuple):
+    """A graph node starting or finishing, timed in seconds from the start of the turn"""
+    node: str
+    # "started", "finished" or "failed"
+    status: str
+    started_at: float
+    finished_at: Optional[float] = None
+
+    @property
+    def duration(self) -> Optional[float]:
+        return None if self.finished_at is None else self.finished_at - self.started_at
+
+def _node_event(chunk: Dict[str, Any], turn_started: float, running: Dict[str, float]) -> NodeEvent:
+    """NodeEvent for a "tasks" stream chunk; running maps task ids to their start offsets"""
+    now = time.perf_counter() - turn_started
+    if "input" in chunk:
+        running[chunk["id"]] = now
+        return NodeEvent(chunk["name"], "started", now)
+    started_at = running.pop(chunk["id"], now)
+    return NodeEvent(chunk["name"], "failed" if chunk.get("error") else "finished", started_at, now)
+
+def _stream_modes(node_events: bool) -> List[str]:
+    return ["custom", "values", "tasks"] if node_events else ["custom", "values"]
+
+def stream_turn(input_state: AgentState, node_events: bool = False) -> Iterator[Tuple[str, Any]]:
+    """Run one turn, yielding ("token", text) as the answer streams and then ("result", final_state)
+
+    Set stream_response in the input state to get tokens; otherwise only the
+    result is yielded. With node_events, ("node", NodeEvent) is also yielded
+    as each graph node starts and finishes.
+    """
+    final_state = None
+    turn_started = time.perf_counter()
+    running: Dict[str, float] = {}
+    for mode, chunk in compiled_graph.stream(input_state, stream_mode=_stream_modes(node_events)):
+        if mode == "custom" and chunk.get("event") == "token":
+            yield "token", chunk["text"]
+        elif mode == "tasks":
+            yield "node", _node_event(chunk, turn_started, running)
+        elif mode == "values":
+            final_state = chunk
+    yield "result", final_state
+
+async def astream_turn(input_state: AgentState, node_events: bool = False) -> AsyncIterator[Tuple[str, Any]]:
+    """Async variant of stream_turn"""
+    final_state = None
+    turn_started = time.perf_counter()
+    running: Dict[str, float] = {}
+    graph_stream = compiled_graph.astream(input_state, stream_mode=_stream_modes(node_events))
+    try:
+        async for mode, chunk in graph_stream:
+            if mode == "custom" and chunk.get("event") == "token":
+                yield "token", chunk["text"]
+            elif mode == "tasks":
+                yield "node", _node_event(chunk, turn_started, running)
+            elif mode == "values":
+                final_state = chunk
+    finally:
+        # Also runs when the caller closes this generator early
+        await graph_stream.aclose()
+    yield "result", final_state
+
 def main():
     
-    # Set up conversation history
-    conversation_history = []
+    # Conversation memory: a running summary plus the most recent turns
+    store = get_conversation_store()
+    store.clear(CLI_SESSION_ID)
     
     while True:
         # Get user input
@@ -429,36 +1359,34 @@ def main():
             break
         
         # Prepare the input state for the graph
-        input_state = {
-            "original_query": user_input,
-            "rewritten_query": "",
-            "current_query": user_input,
-            "language": "en",
-            "max_iterations": 3,
-            "current_iteration": 0,
-            "messages": conversation_history + [{"role": "user", "content": user_input}],
-            "routing_decision": None,
-            "needs_additional_info": False,
-            "selected_sources": [],
-            "product_rag_results": None,
-            "shop_info_rag_results": None,
-            "internet_search_results": None,
-            "retrieved_context": None,
-            "response": None,
-            "response_quality_good": False,
-            "final_response": None
-        }
+        input_state = initial_state(user_input, history=store.history(CLI_SESSION_ID), stream_response=STREAM_RESPONSES)
         
         try:
-            # Invoke the graph with the input state
-            result = compiled_graph.invoke(input_state)
+            if STREAM_RESPONSES:
+                # Print tokens as they arrive
+                result = None
+                streamed = False
+                for kind, payload in stream_turn(input_state):
+                    if kind == "token":
+                        if not streamed:
+                            print("\nAssistant: ", end="", flush=True)
+                            streamed = True
+                        print(payload, end="", flush=True)
+                    else:
+                        result = payload
+                print()
+            else:
+                # Invoke the graph with the input state
+                result = compiled_graph.invoke(input_state)
             
-            # Update conversation history
             final_response = result.get("final_response", "I'm sorry, I couldn't process your request.")
-            conversation_history = input_state["messages"] + [{"role": "assistant", "content": final_response}]
             
             # Display the assistant's response
-            print(f"\nAssistant: {final_response}")
+            if not STREAM_RESPONSES:
+                print(f"\nAssistant: {final_response}")
+            
+            # Update conversation history once the answer is out
+            store.append(CLI_SESSION_ID, user_input, final_response)
             
         except Exception as e:
             print(f"\nAssistant: I apologize, but I encountered an error: {str(e)}")
@@ -0,0 +1,345 @@
+"""Answer a file of queries offline through compiled_graph
+
+Reads queries from CSV or JSONL and writes one JSON result per line, as
+turns finish:
+
+    python batch.py faq.csv --output answers.jsonl --concurrency 8 --requests-per-second 4
+
+Queries are matched to results by id (the --id-field column, or the row
+number). Ids already answered in the output file are skipped, so an
+interrupted run picks up where it stopped when started again with the same
+arguments; failed queries are retried on the next run.
+
+Query embeddings are batched: the response cache keys of all queries are
+embedded up front in a few multi-text requests, and the retrieval embeddings
+of the rewritten queries that turns in flight ask for are coalesced into
+shared requests. Model calls from all turns share one --requests-per-second
+budget.
+"""
+
+import argparse
+import asyncio
+import csv
+import json
+import os
+import time
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Set, Tuple
+
+from embedding_pipeline import EMBED_BATCH_SIZE, TokenBucket
+
+
+def load_queries(path: str, query_field: str = "query", id_field: str = "id") -> List[Dict[str, str]]:
+    """{"id", "query"} records from a CSV file with a header row, or from JSONL"""
+    records = []
+    with open(path, encoding="utf-8", newline="") as f:
+        if path.endswith(".jsonl"):
+            rows = (json.loads(line) for line in f if line.strip())
+        else:
+            rows = csv.DictReader(f)
+        for number, row in enumerate(rows, start=1):
+            query = str(row.get(query_field) or "").strip()
+            if not query:
+                continue
+            records.append({"id": str(row.get(id_field) or number), "query": query})
+    return records
+
+
+def repair_checkpoint(path: str) -> None:
+    """Drop a last line left unfinished by a killed run, so new results start on a line of their own"""
+    if not os.path.exists(path):
+        return
+    with open(path, "rb+") as f:
+        size = f.seek(0, os.SEEK_END)
+        if size == 0:
+            return
+        f.seek(size - 1)
+        if f.read(1) == b"\n":
+            return
+        # Scan back to the last complete line
+        position = size
+        while position > 0:
+            step = min(65536, position)
+            f.seek(position - step)
+            newline = f.read(step).rfind(b"\n")
+            if newline >= 0:
+                position = position - step + newline + 1
+                break
+            position -= step
+        f.truncate(position)
+    print(f"[Batch] Dropped an unfinished last line from {path}")
+
+
+def answered_ids(path: str) -> Set[str]:
+    """Ids with a successful result in an earlier run's output"""
+    done: Set[str] = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                # A line cut off when the previous run was killed
+                continue
+            if not result.get("error"):
+                done.add(str(result["id"]))
+    return done
+
+
+def prime_embeddings(queries: List[str], batch_size: int = EMBED_BATCH_SIZE) -> None:
+    """Embed the response cache keys of all queries in batched requests
+
+    check_response_cache then finds them in the embedding cache. Retrieval
+    embeds the rewritten query, which is not known yet; those requests are
+    batched by CoalescingEmbeddings instead.
+    """
+    from embedding_pipeline import embed_texts_batched
+    from embeddings import embed_texts, get_embedding_provider
+    from response_cache import RESPONSE_CACHE, query_key
+
+    if not RESPONSE_CACHE:
+        return
+    texts = list(dict.fromkeys(query_key(query) for query in queries))
+    provider = get_embedding_provider()
+    embed_texts(texts, batch_embedder=lambda missing: embed_texts_batched(missing, provider.embed, batch_size=batch_size))
+
+
+class CoalescingEmbeddings:
+    """Merges the async embedding requests of concurrent turns into shared multi-text requests
+
+    A request waits at most `window` seconds for others to join it; a batch is
+    sent early once it holds `batch_size` texts. Blocking embed() calls go
+    straight to the wrapped provider. Call aclose() before the event loop
+    ends so no batch is left in flight.
+    """
+
+    def __init__(self, provider, batch_size: int = EMBED_BATCH_SIZE, window: float = 0.02):
+        self.provider = provider
+        self.model = provider.model
+        self.batch_size = batch_size
+        self.window = window
+        self._pending: List[Tuple[List[str], asyncio.Future]] = []
+        self._pending_texts = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # The loop only keeps weak references to tasks; these keep batches in flight alive
+        self._tasks: Set[asyncio.Task] = set()
+        self.requests = 0
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        return self.provider.embed(texts)
+
+    async def aembed(self, texts: List[str]) -> List[List[float]]:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((texts, future))
+        self._pending_texts += len(texts)
+        if self._pending_texts >= self.batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending, self._pending_texts = self._pending, [], 0
+        if batch:
+            task = asyncio.ensure_future(self._send(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch: List[Tuple[List[str], asyncio.Future]]) -> None:
+        self.requests += 1
+        try:
+            vectors = await self.provider.aembed([text for texts, _ in batch for text in texts])
+        except asyncio.CancelledError:
+            for _, future in batch:
+                future.cancel()
+            raise
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        position = 0
+        for texts, future in batch:
+            if not future.done():
+                future.set_result(vectors[position:position + len(texts)])
+            position += len(texts)
+
+    async def aclose(self, cancel: bool = False) -> None:
+        """Send the queued requests and wait for batches in flight, or cancel them"""
+        if cancel:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            for _, future in self._pending:
+                future.cancel()
+            self._pending, self._pending_texts = [], 0
+            for task in self._tasks:
+                task.cancel()
+        else:
+            self._flush()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+def install_embedding_coalescing(batch_size: int) -> CoalescingEmbeddings:
+    """Route the turns' async embedding requests through one CoalescingEmbeddings"""
+    from embeddings import EmbeddingProvider, get_embedding_provider, set_embedding_provider
+
+    coalescing = CoalescingEmbeddings(get_embedding_provider(), batch_size)
+
+    class CoalescedEmbeddings(EmbeddingProvider):
+        model = coalescing.model
+
+        def embed(self, texts: List[str]) -> List[List[float]]:
+            return coalescing.embed(texts)
+
+        async def aembed(self, texts: List[str]) -> List[List[float]]:
+            return await coalescing.aembed(texts)
+
+    set_embedding_provider(CoalescedEmbeddings())
+    return coalescing
+
+
+def install_rate_limit(requests_per_second: float) -> None:
+    """Wrap the configured LLM provider so all turns share one request rate"""
+    from llm_provider import LLMProvider, get_llm_provider, set_llm_provider
+
+    llm = get_llm_provider()
+    bucket = TokenBucket(requests_per_second)
+
+    class RateLimitedLLM(LLMProvider):
+        name = llm.name
+
+        def generate(self, prompt: str, json_mode: bool = False) -> str:
+            bucket.acquire()
+            return llm.generate(prompt, json_mode)
+
+        async def agenerate(self, prompt: str, json_mode: bool = False) -> str:
+            await bucket.aacquire()
+            return await llm.agenerate(prompt, json_mode)
+
+        def stream(self, prompt: str) -> Iterator[str]:
+            bucket.acquire()
+            return llm.stream(prompt)
+
+        async def astream(self, prompt: str) -> AsyncIterator[str]:
+            await bucket.aacquire()
+            async for chunk in llm.astream(prompt):
+                yield chunk
+
+    set_llm_provider(RateLimitedLLM())
+
+
+async def answer(record: Dict[str, str], max_iterations: int, turn_deadline: Optional[float]) -> Dict[str, Any]:
+    from app import TURN_DEADLINE, compiled_graph, initial_state
+
+    started = time.perf_counter()
+    result: Dict[str, Any] = {"id": record["id"], "query": record["query"]}
+    try:
+        state = await compiled_graph.ainvoke(initial_state(
+            record["query"],
+            max_iterations=max_iterations,
+            turn_deadline=TURN_DEADLINE if turn_deadline is None else turn_deadline,
+        ))
+        result.update({
+            "response": state.get("final_response"),
+            "language": state.get("language"),
+            "route": state.get("routing_decision"),
+            "response_cache_hit": bool(state.get("response_cache_hit")),
+            "response_quality_good": bool(state.get("response_quality_good")),
+            "retry_stages": state.get("retry_stages") or [],
+            "timed_out_sources": state.get("timed_out_sources") or [],
+            "trace_id": state.get("trace_id"),
+            "error": None if state.get("final_response") else "empty response",
+        })
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    result["turn_time"] = round(time.perf_counter() - started, 4)
+    return result
+
+
+async def run_batch(
+    records: List[Dict[str, str]],
+    output: str,
+    concurrency: int,
+    max_iterations: int,
+    turn_deadline: Optional[float],
+    coalescing: Optional[CoalescingEmbeddings] = None,
+) -> Dict[str, int]:
+    """Answer the records with at most `concurrency` turns in flight, appending results as they finish"""
+    semaphore = asyncio.Semaphore(concurrency)
+    counts = {"answered": 0, "failed": 0}
+
+    async def bounded(record: Dict[str, str]) -> Dict[str, Any]:
+        async with semaphore:
+            return await answer(record, max_iterations, turn_deadline)
+
+    repair_checkpoint(output)
+    completed = False
+    try:
+        with open(output, "a", encoding="utf-8") as out:
+            tasks = [asyncio.ensure_future(bounded(record)) for record in records]
+            for finished in asyncio.as_completed(tasks):
+                result = await finished
+                # One flushed line per result is the checkpoint a rerun resumes from
+                out.write(json.dumps(result, ensure_ascii=False) + "\n")
+                out.flush()
+                counts["failed" if result["error"] else "answered"] += 1
+                done = counts["answered"] + counts["failed"]
+                if done % 10 == 0 or done == len(records):
+                    print(f"[Batch] {done}/{len(records)} done, {counts['failed']} failed")
+        completed = True
+    finally:
+        if coalescing is not None:
+            # An interrupted run cancels the batches it no longer waits for
+            await coalescing.aclose(cancel=not completed)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer a CSV or JSONL file of queries through the agent graph")
+    parser.add_argument("input", help="CSV with a header row, or JSONL with one object per line")
+    parser.add_argument("--output", default="batch_results.jsonl", help="JSONL results file, appended to and used to resume")
+    parser.add_argument("--query-field", default="query", help="column or key holding the query")
+    parser.add_argument("--id-field", default="id", help="column or key identifying each query (default: row number)")
+    parser.add_argument("--concurrency", type=int, default=4, help="turns in flight at once")
+    parser.add_argument("--requests-per-second", type=float, default=0, help="LLM requests per second across all turns (0 = unlimited)")
+    parser.add_argument("--max-iterations", type=int, default=3, help="rewrite/retry iterations per turn")
+    parser.add_argument("--turn-deadline", type=float, default=None, help="seconds per turn (default TURN_DEADLINE, 0 = none)")
+    parser.add_argument("--embed-batch-size", type=int, default=EMBED_BATCH_SIZE, help="texts per batched embedding request")
+    parser.add_argument("--no-prime", action="store_true", help="skip embedding the response cache keys up front")
+    args = parser.parse_args()
+
+    records = load_queries(args.input, args.query_field, args.id_field)
+    done = answered_ids(args.output)
+    pending = [record for record in records if record["id"] not in done]
+    print(f"[Batch] {len(records)} queries, {len(records) - len(pending)} already answered, {len(pending)} to run")
+    if not pending:
+        return
+
+    if args.requests_per_second > 0:
+        install_rate_limit(args.requests_per_second)
+
+    if not args.no_prime:
+        started = time.perf_counter()
+        try:
+            prime_embeddings([record["query"] for record in pending], args.embed_batch_size)
+            print(f"[Batch] Embedded queries in {time.perf_counter() - started:.2f}s")
+        except Exception as e:
+            # Turns embed their own queries if priming fails
+            print(f"[Batch] Could not pre-embed queries: {e}")
+    coalescing = install_embedding_coalescing(args.embed_batch_size)
+
+    started = time.perf_counter()
+    counts = asyncio.run(run_batch(pending, args.output, args.concurrency, args.max_iterations, args.turn_deadline, coalescing))
+    print(f"\n[Batch] {counts['answered']} answered, {counts['failed']} failed in {time.perf_counter() - started:.2f}s")
+    print(f"[Batch] {coalescing.requests} batched embedding requests during turns")
+    print(f"[Batch] Results appended to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+"""Offline end-to-end latency benchmark
+
+Replays a query corpus through compiled_graph and reports turn latency
+percentiles, LLM and embedding calls per turn and retrieval time. By default
+it uses the stub LLM and embedding providers, so it runs without API quota:
+
+    python benchmark.py --llm-latency 0.3 --output results.json
+    python benchmark.py --compare results.json
+
+The response cache and decision memo are off unless --keep-caches is given,
+so repeated queries still take the full path.
+"""
+
+import argparse
+import asyncio
+import contextvars
+import json
+import os
+import platform
+import time
+from collections import Counter
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+import numpy as np
+
+# Per-turn call counters, visible to the graph nodes run for that turn
+_turn_calls: contextvars.ContextVar[Optional[Counter]] = contextvars.ContextVar("turn_calls", default=None)
+
+
+def _count(kind: str) -> None:
+    calls = _turn_calls.get()
+    if calls is not None:
+        calls[kind] += 1
+
+
+def load_queries(path: str) -> List[str]:
+    """Queries from a text file (one per line) or JSONL ({"query": ...} per line)"""
+    queries = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            queries.append(json.loads(line)["query"] if path.endswith(".jsonl") else line)
+    return queries
+
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "mean": None, "max": None}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {
+        "p50": round(float(p50), 4),
+        "p95": round(float(p95), 4),
+        "p99": round(float(p99), 4),
+        "mean": round(float(np.mean(values)), 4),
+        "max": round(float(np.max(values)), 4),
+    }
+
+
+def configure_environment(args: argparse.Namespace) -> None:
+    """Set provider and cache settings before the app modules read them"""
+    os.environ["LLM_PROVIDER"] = args.provider
+    os.environ["STUB_LLM_LATENCY"] = str(args.llm_latency)
+    os.environ["STUB_LLM_TOKEN_LATENCY"] = str(args.token_latency)
+    os.environ["STUB_EMBEDDING_LATENCY"] = str(args.embedding_latency)
+    if args.provider == "stub":
+        os.environ["EMBEDDING_BACKEND"] = "stub"
+    if not args.keep_caches:
+        os.environ["RESPONSE_CACHE"] = "false"
+        os.environ["DECISION_MEMO"] = "false"
+
+
+def install_call_counters() -> None:
+    """Wrap the configured providers so each turn counts its LLM and embedding calls"""
+    from embeddings import EmbeddingProvider, get_embedding_provider, set_embedding_provider
+    from llm_provider import LLMProvider, get_llm_provider, set_llm_provider
+
+    llm = get_llm_provider()
+    embedder = get_embedding_provider()
+
+    class CountingLLM(LLMProvider):
+        name = llm.name
+
+        def generate(self, prompt: str, json_mode: bool = False) -> str:
+            _count("llm")
+            return llm.generate(prompt, json_mode)
+
+        async def agenerate(self, prompt: str, json_mode: bool = False) -> str:
+            _count("llm")
+            return await llm.agenerate(prompt, json_mode)
+
+        def stream(self, prompt: str) -> Iterator[str]:
+            _count("llm")
+            return llm.stream(prompt)
+
+        def astream(self, prompt: str) -> AsyncIterator[str]:
+            _count("llm")
+            return llm.astream(prompt)
+
+    class CountingEmbeddings(EmbeddingProvider):
+        model = embedder.model
+
+        def embed(self, texts: List[str]) -> List[List[float]]:
+            _count("embedding")
+            return embedder.embed(texts)
+
+        async def aembed(self, texts: List[str]) -> List[List[float]]:
+            _count("embedding")
+            return await embedder.aembed(texts)
+
+    set_llm_provider(CountingLLM())
+    set_embedding_provider(CountingEmbeddings())
+
+
+async def run_turn(query: str, stream: bool) -> Dict[str, Any]:
+    from app import astream_turn, initial_state
+
+    calls: Counter = Counter()
+    _turn_calls.set(calls)
+    node_times: Dict[str, float] = {}
+    time_to_first_token = None
+    error = None
+    started = time.perf_counter()
+    try:
+        async for kind, payload in astream_turn(initial_state(query, stream_response=stream), node_events=True):
+            if kind == "node" and payload.status != "started":
+                node_times[payload.node] = node_times.get(payload.node, 0.0) + payload.duration
+            elif kind == "token" and time_to_first_token is None:
+                time_to_first_token = time.perf_counter() - started
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+
+    return {
+        "query": query,
+        "turn_time": time.perf_counter() - started,
+        "time_to_first_token": time_to_first_token,
+        "llm_calls": calls["llm"],
+        "embedding_calls": calls["embedding"],
+        "retrieval_time": node_times.get("retrieve_context"),
+        "node_times": node_times,
+        "error": error,
+    }
+
+
+async def run_benchmark(queries: List[str], repeat: int, concurrency: int, warmup: int, stream: bool) -> List[Dict[str, Any]]:
+    for query in queries[:warmup]:
+        await run_turn(query, stream)
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded(query: str) -> Dict[str, Any]:
+        async with semaphore:
+            return await run_turn(query, stream)
+
+    # gather runs each turn in its own task with its own context, so call counters do not mix
+    return await asyncio.gather(*(bounded(query) for _ in range(repeat) for query in queries))
+
+
+def summarize(turns: List[Dict[str, Any]], config: Dict[str, Any], wall_time: float) -> Dict[str, Any]:
+    completed = [turn for turn in turns if turn["error"] is None]
+    node_names = sorted({name for turn in completed for name in turn["node_times"]})
+    return {
+        "config": config,
+        "turns": len(turns),
+        "errors": len(turns) - len(completed),
+        "wall_time": round(wall_time, 4),
+        "throughput": round(len(completed) / wall_time, 4) if wall_time else None,
+        "turn_latency": percentiles([turn["turn_time"] for turn in completed]),
+        "time_to_first_token": percentiles([
+            turn["time_to_first_token"] for turn in completed if turn["time_to_first_token"] is not None
+        ]),
+        "llm_calls_per_turn": percentiles([turn["llm_calls"] for turn in completed]),
+        "embedding_calls_per_turn": percentiles([turn["embedding_calls"] for turn in completed]),
+        "retrieval_time": percentiles([
+            turn["retrieval_time"] for turn in completed if turn["retrieval_time"] is not None
+        ]),
+        "node_time": {
+            name: percentiles([turn["node_times"][name] for turn in completed if name in turn["node_times"]])
+            for name in node_names
+        },
+        "error_samples": [turn["error"] for turn in turns if turn["error"]][:5],
+    }
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any]) -> List[str]:
+    """Lines describing how the headline metrics moved against a baseline result"""
+    lines = []
+    for metric in ["turn_latency", "retrieval_time", "llm_calls_per_turn"]:
+        for stat in ["p50", "p95", "p99"]:
+            new = current.get(metric, {}).get(stat)
+            old = baseline.get(metric, {}).get(stat)
+            if new is None or old is None:
+                continue
+            change = f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+            lines.append(f"{metric}.{stat}: {old} -> {new} ({change})")
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a query corpus through the agent graph and report latency")
+    parser.add_argument("--queries", default="benchmark_queries.txt", help="text file with one query per line, or JSONL with a query field")
+    parser.add_argument("--provider", default="stub", choices=["stub", "gemini"], help="LLM provider (stub also uses stub embeddings)")
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="stub seconds per LLM call before the first token")
+    parser.add_argument("--token-latency", type=float, default=0.01, help="stub seconds per generated word")
+    parser.add_argument("--embedding-latency", type=float, default=0.05, help="stub seconds per embedding request")
+    parser.add_argument("--repeat", type=int, default=1, help="times to replay the corpus")
+    parser.add_argument("--concurrency", type=int, default=1, help="turns in flight at once")
+    parser.add_argument("--warmup", type=int, default=1, help="queries run first and left out of the results")
+    parser.add_argument("--stream", action="store_true", help="stream answers and report time to first token")
+    parser.add_argument("--keep-caches", action="store_true", help="leave the response cache and decision memo on")
+    parser.add_argument("--output", default="benchmark_results.json", help="where to write the JSON results")
+    parser.add_argument("--compare", help="earlier results JSON to compare against")
+    args = parser.parse_args()
+
+    configure_environment(args)
+    install_call_counters()
+
+    queries = load_queries(args.queries)
+    config = {
+        "queries": args.queries,
+        "query_count": len(queries),
+        "provider": args.provider,
+        "llm_latency": args.llm_latency,
+        "token_latency": args.token_latency,
+        "embedding_latency": args.embedding_latency,
+        "repeat": args.repeat,
+        "concurrency": args.concurrency,
+        "stream": args.stream,
+        "keep_caches": args.keep_caches,
+        "fast_planner": os.getenv("FAST_PLANNER", "false"),
+        "python": platform.python_version(),
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+    started = time.perf_counter()
+    turns = asyncio.run(run_benchmark(queries, args.repeat, args.concurrency, args.warmup, args.stream))
+    results = summarize(turns, config, time.perf_counter() - started)
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+
+    latency = results["turn_latency"]
+    print(f"\n{results['turns']} turns, {results['errors']} errors, {results['wall_time']:.2f}s wall time")
+    print(f"Turn latency p50/p95/p99: {latency['p50']}s / {latency['p95']}s / {latency['p99']}s")
+    print(f"LLM calls per turn (mean): {results['llm_calls_per_turn']['mean']}")
+    print(f"Retrieval time p50: {results['retrieval_time']['p50']}s")
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        print(f"\nCompared with {args.compare}:")
+        for line in compare(results, baseline):
+            print(f"- {line}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,36 +1,44 @@
 import os
 import pandas as pd
-import google.generativeai as genai
 from dotenv import load_dotenv
 import re
 import chromadb
-import uuid
 import ast
-import time
+import hashlib
+
+from embedding_pipeline import embed_texts_batched
+from embeddings import EMBEDDING_MODEL, batch_embed, embed_texts, fallback_embedding
+from lexical_index import LEXICAL_INDEX_FILE, LexicalIndex
+from numpy_index import VECTORS_FILE, write_numpy_index
+from retriever import (
+    CHROMA_DB_PATH,
+    LEXICAL_INDEX_PATH,
+    NUMPY_INDEX_PATH,
+    PRODUCT_COLLECTION,
+    SPEC_INDEX_PATH,
+    bump_index_version
+)
+from spec_index import SPEC_INDEX_FILE, SpecIndex, extract_attributes
 
 load_dotenv()
 
-# Configure Gemini API
-genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+# Bump when the metadata written for each product changes
+METADATA_VERSION = "2"
+
+# Also export the index for the in-process NumPy backend
+EXPORT_NUMPY_INDEX = os.getenv("EXPORT_NUMPY_INDEX", "true").lower() == "true"
 
 # ChromaDB setup
-chroma_client = chromadb.PersistentClient("db")
+chroma_client = chromadb.PersistentClient(CHROMA_DB_PATH)
 
 def get_embedding(text: str) -> list[float]:
     """Generate embeddings using Gemini API"""
     try:
-        result = genai.embed_content(
-            model="models/text-embedding-004",
-            content=text
-        )
-        return result['embedding']
+        return embed_texts([text])[0]
     except Exception as e:
         print(f"Error generating embedding for text: {e}")
-        # Fallback: create a simple hash-based embedding
-        import hashlib
-        hash_object = hashlib.md5(text.encode())
-        # Convert to a simple numeric representation (not recommended for production)
-        return [float(ord(c)) for c in hash_object.hexdigest()[:384]]  # 384 dimensions
+        # Fallback: deterministic offline n-gram embedding
+        return fallback_embedding(text)
 
 def sanitize_collection_name(name: str) -> str:
     """Sanitize collection name to be ChromaDB-compatible."""
@@ -83,6 +91,65 @@ def join_string(row):
 
     return final_string
 
+def content_hash(text: str) -> str:
+    """Hash the searchable text so changed rows can be detected between builds
+
+    METADATA_VERSION and the embedding model are mixed in so a change to the
+    stored metadata layout or a switch of embedding backend refreshes every row.
+    """
+    return hashlib.sha256(f"{METADATA_VERSION}\0{EMBEDDING_MODEL}\0{text}".encode("utf-8")).hexdigest()
+
+def document_id(row) -> str:
+    """Stable document id taken from the CSV _id column"""
+    doc_id = row.get('_id', '')
+    if pd.isna(doc_id) or not str(doc_id).strip():
+        # Rows without an _id fall back to their content
+        return f"row-{content_hash(row['information'])[:24]}"
+    return str(doc_id).strip()
+
+def plan_index_sync(existing: dict, incoming: dict) -> dict:
+    """Compare indexed and incoming {id: content_hash} maps
+
+    Returns the ids to add, update, remove and leave alone.
+    """
+    plan = {"added": [], "updated": [], "removed": [], "unchanged": []}
+    
+    for doc_id, digest in incoming.items():
+        if doc_id not in existing:
+            plan["added"].append(doc_id)
+        elif existing[doc_id] != digest:
+            plan["updated"].append(doc_id)
+        else:
+            plan["unchanged"].append(doc_id)
+    
+    plan["removed"] = [doc_id for doc_id in existing if doc_id not in incoming]
+    return plan
+
+def export_numpy_index(collection, path: str) -> None:
+    """Write every vector in the Chroma collection to a NumPy index"""
+    print("Exporting NumPy index...")
+    data = collection.get(include=["embeddings", "metadatas"])
+    if len(data["ids"]) == 0:
+        print("Collection is empty, skipping NumPy export")
+        return
+    write_numpy_index(path, data["ids"], data["embeddings"], data["metadatas"])
+    print(f"Exported {len(data['ids'])} vectors to {path}")
+
+def export_lexical_index(collection, path: str) -> None:
+    """Build the BM25 inverted index over every product's searchable text"""
+    print("Building lexical index...")
+    data = collection.get(include=["metadatas"])
+    texts = [(metadata or {}).get("information", "") for metadata in data["metadatas"]]
+    LexicalIndex.build(data["ids"], texts, data["metadatas"]).save(path)
+    print(f"Indexed {len(data['ids'])} documents for keyword search in {path}")
+
+def export_spec_index(collection, path: str) -> None:
+    """Write the typed price/spec columns used for structured filters"""
+    print("Building spec index...")
+    data = collection.get(include=["metadatas"])
+    SpecIndex.build(data["ids"], [metadata or {} for metadata in data["metadatas"]]).save(path)
+    print(f"Indexed attributes of {len(data['ids'])} products in {path}")
+
 def main():
     """Main function to build vector search database"""
     print("Starting vector search database build...")
@@ -112,77 +179,120 @@ def main():
         df = df.head(50)
         print(f"Using first {len(df)} records for vector database")
         
-        # Generate embeddings
-        print("Generating embeddings...")
-        embeddings = []
-        
-        for idx, row in df.iterrows():
-            try:
-                embedding = get_embedding(row['information'])
-                embeddings.append(embedding)
-                
-                if (idx + 1) % 5 == 0:
-                    print(f"Generated embeddings for {idx + 1}/{len(df)} records")
-                    time.sleep(1)  # Rate limiting
-                    
-            except Exception as e:
-                print(f"Error generating embedding for row {idx}: {e}")
-                # Use a zero vector as fallback
-                embeddings.append([0.0] * 384)
-        
-        df['embedding'] = embeddings
-        
-        # Prepare metadata
-        print("Preparing metadata...")
-        metadatas = []
-        for _, row in df.iterrows():
-            metadata = {
-                "information": row["information"],
-                "title": str(row.get("title", "")),
-                "current_price": str(row.get("current_price", "")),
-                "product_specs": str(row.get("product_specs", ""))[:500]  # Limit length
-            }
-            metadatas.append(metadata)
-        
-        # Generate unique IDs
-        ids = [str(uuid.uuid4()) for _ in range(len(df))]
+        # Stable ids and content hashes
+        df['doc_id'] = df.apply(document_id, axis=1)
+        df = df.drop_duplicates(subset='doc_id', keep='last')
+        df['content_hash'] = df['information'].map(content_hash)
         
         # ChromaDB setup
         print("Setting up ChromaDB...")
-        collection_name = sanitize_collection_name("products")
+        collection_name = sanitize_collection_name(PRODUCT_COLLECTION)
+        collection = chroma_client.get_or_create_collection(name=collection_name)
         
-        # Delete existing collection if it exists
-        try:
-            chroma_client.delete_collection(name=collection_name)
-            print("Deleted existing collection")
-        except:
-            pass
+        # Compare against what is already indexed
+        existing = collection.get(include=["metadatas"])
+        existing_hashes = {
+            doc_id: (metadata or {}).get("content_hash", "")
+            for doc_id, metadata in zip(existing["ids"], existing["metadatas"])
+        }
+        incoming_hashes = dict(zip(df['doc_id'], df['content_hash']))
+        plan = plan_index_sync(existing_hashes, incoming_hashes)
         
-        # Create new collection
-        collection = chroma_client.get_or_create_collection(name=collection_name)
+        print(
+            f"Index changes: {len(plan['added'])} to add, {len(plan['updated'])} to update, "
+            f"{len(plan['removed'])} to remove, {len(plan['unchanged'])} unchanged"
+        )
         
-        # Insert data in batches
-        print("Inserting data into ChromaDB...")
-        batch_size = 10
+        # Only embed new or changed rows
+        changed_ids = set(plan['added']) | set(plan['updated'])
+        changed_df = df[df['doc_id'].isin(changed_ids)]
         
-        for i in range(0, len(df), batch_size):
-            end_idx = min(i + batch_size, len(df))
-            batch_embeddings = embeddings[i:end_idx]
-            batch_metadatas = metadatas[i:end_idx]
-            batch_ids = ids[i:end_idx]
-            
-            collection.add(
-                ids=batch_ids,
-                embeddings=batch_embeddings,
-                metadatas=batch_metadatas
+        if len(changed_df) > 0:
+            print("Generating embeddings...")
+            # Cached vectors are reused; only misses go through the batched pipeline
+            embeddings = embed_texts(
+                changed_df['information'].tolist(),
+                batch_embedder=lambda texts: embed_texts_batched(
+                    texts,
+                    batch_embed,
+                    on_progress=lambda done, total: print(f"Generated embeddings for {done}/{total} records")
+                )
             )
             
-            print(f"Inserted batch {i//batch_size + 1}/{(len(df) + batch_size - 1)//batch_size}")
+            # Prepare metadata
+            print("Preparing metadata...")
+            metadatas = []
+            for _, row in changed_df.iterrows():
+                metadata = {
+                    "doc_id": row["doc_id"],
+                    "information": row["information"],
+                    "title": str(row.get("title", "")),
+                    "current_price": str(row.get("current_price", "")),
+                    "product_specs": str(row.get("product_specs", ""))[:500],  # Limit length
+                    "content_hash": row["content_hash"]
+                }
+                # Typed price/spec columns for structured filters
+                metadata.update(extract_attributes(
+                    row.get("title", ""),
+                    row.get("current_price", ""),
+                    row.get("product_specs", "")
+                ))
+                metadatas.append(metadata)
+            
+            ids = changed_df['doc_id'].tolist()
+            
+            # Upsert data in batches
+            print("Upserting data into ChromaDB...")
+            batch_size = 10
+            
+            for i in range(0, len(ids), batch_size):
+                end_idx = min(i + batch_size, len(ids))
+                
+                collection.upsert(
+                    ids=ids[i:end_idx],
+                    embeddings=embeddings[i:end_idx],
+                    metadatas=metadatas[i:end_idx]
+                )
+                
+                print(f"Upserted batch {i//batch_size + 1}/{(len(ids) + batch_size - 1)//batch_size}")
+        
+        # Drop rows that are no longer in the catalog
+        if plan['removed']:
+            collection.delete(ids=plan['removed'])
+            print(f"Deleted {len(plan['removed'])} removed records")
+        
+        index_changed = bool(changed_ids or plan['removed'])
+        
+        # Export the full collection to the NumPy backend
+        numpy_missing = not os.path.exists(os.path.join(NUMPY_INDEX_PATH, VECTORS_FILE))
+        if EXPORT_NUMPY_INDEX and (index_changed or numpy_missing):
+            export_numpy_index(collection, NUMPY_INDEX_PATH)
+            index_changed = True
+        
+        # Rebuild the keyword index used for hybrid search
+        lexical_missing = not os.path.exists(os.path.join(LEXICAL_INDEX_PATH, LEXICAL_INDEX_FILE))
+        if index_changed or lexical_missing:
+            export_lexical_index(collection, LEXICAL_INDEX_PATH)
+            index_changed = True
+        
+        # Rebuild the typed attribute index used for filters
+        spec_missing = not os.path.exists(os.path.join(SPEC_INDEX_PATH, SPEC_INDEX_FILE))
+        if index_changed or spec_missing:
+            export_spec_index(collection, SPEC_INDEX_PATH)
+            index_changed = True
+        
+        # Let running retrievers know the index changed
+        if index_changed:
+            bump_index_version(CHROMA_DB_PATH)
         
         print(f"\nSuccessfully built vector search database!")
-        print(f"- Total documents: {len(df)}")
+        print(f"- Total documents: {collection.count()}")
+        print(f"- Added: {len(plan['added'])}")
+        print(f"- Updated: {len(plan['updated'])}")
+        print(f"- Removed: {len(plan['removed'])}")
+        print(f"- Unchanged: {len(plan['unchanged'])}")
         print(f"- Collection name: {collection.name}")
-        print(f"- Database location: ./db")
+        print(f"- Database location: {CHROMA_DB_PATH}")
         
         # Test the database
         print("\nTesting the database...")
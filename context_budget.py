@@ -0,0 +1,144 @@
+import math
+import os
+import re
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Approximate token budget for retrieved context in the answer prompt; 0 disables truncation
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+
+# Rough characters-per-token ratio; good enough for budgeting without an API call
+CHARS_PER_TOKEN = 4
+
+# Fields inside a chunk (see rag.compact_product_text)
+SEGMENT_SEPARATOR = " | "
+
+# Weight of a source's chunks relative to the source matching the route
+SECONDARY_SOURCE_WEIGHT = 0.7
+INTERNET_SOURCE_WEIGHT = 0.5
+
+
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN) if text else 0
+
+
+class ContextChunk(NamedTuple):
+    source: str
+    rank: int
+    text: str
+    score: float
+
+
+class ContextAssembly(NamedTuple):
+    text: str
+    tokens_used: int
+    token_budget: int
+    chunks_used: int
+    chunks_dropped: int
+
+
+def split_chunks(text: str) -> List[str]:
+    """Blank-line separated chunks of a source result, best first"""
+    return [chunk.strip() for chunk in re.split(r"\n\s*\n", text or "") if chunk.strip()]
+
+
+def _normalize(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+def _truncate(text: str, max_tokens: int) -> str:
+    """Cut text to about max_tokens at a word boundary"""
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+    cut = text[:max(0, max_chars - 2)].rsplit(" ", 1)[0]
+    return cut + " …"
+
+
+def _dedupe_segments(text: str, seen: set) -> str:
+    """Replace fields already stated by a better-ranked chunk with a back-reference"""
+    segments = []
+    for segment in text.split(SEGMENT_SEPARATOR):
+        key = _normalize(segment)
+        if len(key) > 40 and key in seen:
+            label, separator, _ = segment.partition(": ")
+            if separator and len(label) <= 30:
+                segments.append(f"{label}: (same as above)")
+            continue
+        seen.add(key)
+        segments.append(segment)
+    return SEGMENT_SEPARATOR.join(segments)
+
+
+def assemble_context(
+    results: Sequence[Tuple[str, str, str]],
+    primary_source: Optional[str] = None,
+    token_budget: int = CONTEXT_TOKEN_BUDGET,
+) -> ContextAssembly:
+    """Build the retrieved-context block from (source, heading, text) results
+
+    Each result is split into chunks, whose order within a source is their
+    rank. Chunks are scored by rank, weighted towards the primary source (the
+    one matching the route). Duplicate chunks are dropped and repeated fields
+    collapsed, then chunks are added best first while they fit the token
+    budget. The best chunk is always kept, truncated if it alone exceeds the
+    budget. The output keeps the source order and, within a source, rank order.
+    """
+    chunks: List[ContextChunk] = []
+    for source, _, text in results:
+        if source == primary_source or primary_source is None:
+            weight = 1.0
+        elif source == "internet_search":
+            weight = INTERNET_SOURCE_WEIGHT
+        else:
+            weight = SECONDARY_SOURCE_WEIGHT
+        for rank, chunk in enumerate(split_chunks(text)):
+            chunks.append(ContextChunk(source, rank, chunk, weight / (rank + 1)))
+
+    headings = {source: heading for source, heading, _ in results}
+    seen_chunks: set = set()
+    seen_segments: set = set()
+    selected: Dict[str, List[ContextChunk]] = {}
+    used = 0
+    dropped = 0
+    unlimited = token_budget <= 0
+
+    for chunk in sorted(chunks, key=lambda c: -c.score):
+        key = _normalize(chunk.text)
+        if key in seen_chunks:
+            dropped += 1
+            continue
+        seen_chunks.add(key)
+
+        text = _dedupe_segments(chunk.text, seen_segments)
+        cost = estimate_tokens(text)
+        if chunk.source not in selected:
+            cost += estimate_tokens(f"{headings[chunk.source]}:")
+
+        if not unlimited and used + cost > token_budget:
+            if selected:
+                dropped += 1
+                continue
+            # Never drop the top-ranked facts entirely
+            text = _truncate(text, token_budget - (cost - estimate_tokens(text)))
+            cost = token_budget
+
+        selected.setdefault(chunk.source, []).append(chunk._replace(text=text))
+        used += cost
+
+    retrieved_context = ""
+    for source, heading, _ in results:
+        if source in selected:
+            body = "\n\n".join(chunk.text for chunk in sorted(selected[source], key=lambda c: c.rank))
+            retrieved_context += f"{heading}:\n{body}\n\n"
+
+    return ContextAssembly(
+        retrieved_context,
+        used,
+        token_budget,
+        sum(len(source_chunks) for source_chunks in selected.values()),
+        dropped,
+    )
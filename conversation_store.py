@@ -0,0 +1,278 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+from dotenv import load_dotenv
+
+from context_budget import CHARS_PER_TOKEN, estimate_tokens
+from llm_provider import get_llm_provider
+from prompt import HISTORY_SUMMARIZER_INSTRUCTION
+from tracing import span
+
+load_dotenv()
+
+# Empty keeps conversations in memory only
+CONVERSATION_STORE_PATH = os.getenv("CONVERSATION_STORE_PATH", "")
+CONVERSATION_MEMORY_SESSIONS = int(os.getenv("CONVERSATION_MEMORY_SESSIONS", "1000"))
+CONVERSATION_MAX_SESSIONS = int(os.getenv("CONVERSATION_MAX_SESSIONS", "100000"))
+# Token caps for the verbatim recent turns and for the running summary of older ones
+CONVERSATION_HISTORY_TOKENS = int(os.getenv("CONVERSATION_HISTORY_TOKENS", "600"))
+CONVERSATION_SUMMARY_TOKENS = int(os.getenv("CONVERSATION_SUMMARY_TOKENS", "200"))
+# "llm" summarizes evicted turns with the model; "extractive" keeps their first words
+CONVERSATION_SUMMARIZER = os.getenv("CONVERSATION_SUMMARIZER", "llm").lower()
+
+ROLE_LABELS = {"user": "User", "assistant": "Assistant"}
+
+
+class Conversation(NamedTuple):
+    session_id: str
+    # Running summary of turns no longer kept verbatim
+    summary: str
+    # Recent messages as {"role", "content"}, oldest first
+    messages: List[Dict[str, str]]
+    updated_at: float
+
+
+def _clip(text: str, max_tokens: int) -> str:
+    """Keep about max_tokens of text, from the start, at a word boundary"""
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+    return text[:max(0, max_chars - 2)].rsplit(" ", 1)[0] + " …"
+
+
+def _clip_start(text: str, max_tokens: int) -> str:
+    """Keep about the last max_tokens of text, dropping the oldest words"""
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+    cut = text[-max(0, max_chars - 2):]
+    return "… " + cut.split(" ", 1)[-1]
+
+
+def render_messages(messages: List[Dict[str, str]], max_tokens: int = CONVERSATION_HISTORY_TOKENS) -> str:
+    """Lines like "User: ..." for the newest messages that fit max_tokens"""
+    lines: List[str] = []
+    used = 0
+    # A single long answer may not crowd out everything else
+    per_message = max(1, max_tokens // 2)
+    for message in reversed(messages):
+        label = ROLE_LABELS.get(message.get("role"), message.get("role", "user").title())
+        line = f"{label}: {_clip(str(message.get('content', '')).strip(), per_message)}"
+        cost = estimate_tokens(line)
+        if lines and used + cost > max_tokens:
+            break
+        lines.append(line)
+        used += cost
+    return "\n".join(reversed(lines))
+
+
+def history_block(summary: str, messages: List[Dict[str, str]], max_tokens: int = CONVERSATION_HISTORY_TOKENS) -> str:
+    """Compact history for prompts: the running summary and the newest messages"""
+    parts = []
+    if summary:
+        parts.append(f"Summary of earlier conversation: {summary}")
+    recent = render_messages(messages, max_tokens)
+    if recent:
+        parts.append(recent)
+    return "\n".join(parts)
+
+
+def extractive_summary(summary: str, messages: List[Dict[str, str]], max_tokens: int = CONVERSATION_SUMMARY_TOKENS) -> str:
+    """Running summary without a model call: the first words of each evicted message"""
+    lines = [summary] if summary else []
+    for message in messages:
+        label = ROLE_LABELS.get(message.get("role"), "User")
+        lines.append(f"{label}: {_clip(str(message.get('content', '')).strip(), 30)}")
+    return _clip_start(" ".join(lines), max_tokens)
+
+
+def llm_summary(summary: str, messages: List[Dict[str, str]], max_tokens: int = CONVERSATION_SUMMARY_TOKENS) -> str:
+    """Fold evicted messages into the running summary with the model"""
+    prompt = f"""
+    {HISTORY_SUMMARIZER_INSTRUCTION}
+
+    Earlier summary: {summary or "(none)"}
+
+    New turns:
+    {render_messages(messages, max_tokens * 4)}
+    """
+    try:
+        with span("summarize_history", "llm"):
+            return _clip_start(get_llm_provider().generate(prompt).strip(), max_tokens)
+    except Exception as e:
+        print(f"[System] History summarization failed, keeping an extractive summary: {e}")
+        return extractive_summary(summary, messages, max_tokens)
+
+
+Summarizer = Callable[[str, List[Dict[str, str]], int], str]
+
+
+class ConversationStore:
+    """Conversation history per session: in-memory LRU over an optional SQLite tier
+
+    Each session keeps its newest messages verbatim up to history_tokens.
+    Older messages are folded, a turn at a time, into a running summary capped
+    at summary_tokens. The prompt history block therefore stays the same size
+    however long the chat runs.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = CONVERSATION_STORE_PATH,
+        memory_sessions: int = CONVERSATION_MEMORY_SESSIONS,
+        max_sessions: int = CONVERSATION_MAX_SESSIONS,
+        history_tokens: int = CONVERSATION_HISTORY_TOKENS,
+        summary_tokens: int = CONVERSATION_SUMMARY_TOKENS,
+        summarizer: Optional[Summarizer] = None,
+    ):
+        self.path = path
+        self.memory_sessions = memory_sessions
+        self.max_sessions = max_sessions
+        self.history_tokens = history_tokens
+        self.summary_tokens = summary_tokens
+        self.summarizer = summarizer or (extractive_summary if CONVERSATION_SUMMARIZER == "extractive" else llm_summary)
+        self._memory: "OrderedDict[str, Conversation]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        self._writes_since_trim = 0
+
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS conversations (
+                    session_id TEXT PRIMARY KEY,
+                    summary TEXT NOT NULL,
+                    messages TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS conversations_updated_at ON conversations (updated_at)"
+            )
+            self._conn.commit()
+
+    def _remember(self, conversation: Conversation) -> None:
+        self._memory[conversation.session_id] = conversation
+        self._memory.move_to_end(conversation.session_id)
+        while len(self._memory) > self.memory_sessions:
+            self._memory.popitem(last=False)
+
+    def _load(self, session_id: str) -> Conversation:
+        conversation = self._memory.get(session_id)
+        if conversation is not None:
+            self._memory.move_to_end(session_id)
+            return conversation
+
+        if self._conn is not None:
+            row = self._conn.execute(
+                "SELECT summary, messages, updated_at FROM conversations WHERE session_id = ?", (session_id,)
+            ).fetchone()
+            if row is not None:
+                conversation = Conversation(session_id, row[0], json.loads(row[1]), row[2])
+                self._remember(conversation)
+                return conversation
+
+        return Conversation(session_id, "", [], time.time())
+
+    def _save(self, conversation: Conversation) -> None:
+        self._remember(conversation)
+        if self._conn is None:
+            return
+
+        self._conn.execute(
+            "INSERT OR REPLACE INTO conversations (session_id, summary, messages, updated_at) VALUES (?, ?, ?, ?)",
+            (conversation.session_id, conversation.summary, json.dumps(conversation.messages, ensure_ascii=False), conversation.updated_at),
+        )
+        self._writes_since_trim += 1
+
+        # Drop the least recently active sessions beyond the cap
+        if self._writes_since_trim >= max(1, self.max_sessions // 100):
+            self._writes_since_trim = 0
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM conversations").fetchone()
+            if count > self.max_sessions:
+                self._conn.execute(
+                    """
+                    DELETE FROM conversations WHERE session_id IN (
+                        SELECT session_id FROM conversations ORDER BY updated_at ASC LIMIT ?
+                    )
+                    """,
+                    (count - self.max_sessions,),
+                )
+        self._conn.commit()
+
+    def get(self, session_id: str) -> Conversation:
+        with self._lock:
+            return self._load(session_id)
+
+    def history(self, session_id: str) -> str:
+        """Compact history block for the session's next prompt ("" for a new session)"""
+        conversation = self.get(session_id)
+        return history_block(conversation.summary, conversation.messages, self.history_tokens)
+
+    def append(self, session_id: str, user_message: str, assistant_message: str) -> Conversation:
+        """Record a finished turn, folding the oldest turns into the summary once over the cap
+
+        Call it after the answer has been delivered: folding may make a model call.
+        """
+        with self._lock:
+            conversation = self._load(session_id)
+            summary = conversation.summary
+            messages = conversation.messages + [
+                {"role": "user", "content": user_message},
+                {"role": "assistant", "content": assistant_message},
+            ]
+
+        # Fold whole turns (user + assistant) until the recent messages fit
+        evicted: List[Dict[str, str]] = []
+        while len(messages) > 2 and estimate_tokens(render_messages(messages, 10 ** 9)) > self.history_tokens:
+            evicted += messages[:2]
+            messages = messages[2:]
+        if evicted:
+            summary = self.summarizer(summary, evicted, self.summary_tokens)
+
+        with self._lock:
+            # Keep turns appended by a concurrent call for the same session
+            latest = self._load(session_id)
+            concurrent = latest.messages[len(conversation.messages):]
+            updated = Conversation(session_id, summary, messages + concurrent, time.time())
+            self._save(updated)
+            return updated
+
+    def clear(self, session_id: str) -> None:
+        with self._lock:
+            self._memory.pop(session_id, None)
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM conversations WHERE session_id = ?", (session_id,))
+                self._conn.commit()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            stored = None
+            if self._conn is not None:
+                (stored,) = self._conn.execute("SELECT COUNT(*) FROM conversations").fetchone()
+            return {"memory_sessions": len(self._memory), "stored_sessions": stored if stored is not None else len(self._memory)}
+
+
+_default_store: Optional[ConversationStore] = None
+_default_store_lock = threading.Lock()
+
+
+def get_conversation_store() -> ConversationStore:
+    """Process-wide conversation store"""
+    global _default_store
+    if _default_store is None:
+        with _default_store_lock:
+            if _default_store is None:
+                _default_store = ConversationStore()
+    return _default_store
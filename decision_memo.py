@@ -0,0 +1,160 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import Dict, Optional
+
+from dotenv import load_dotenv
+
+from embedding_cache import normalize_text
+
+load_dotenv()
+
+DECISION_MEMO = os.getenv("DECISION_MEMO", "true").lower() == "true"
+# Empty keeps the memo in memory only
+DECISION_MEMO_PATH = os.getenv("DECISION_MEMO_PATH", "")
+DECISION_MEMO_MAX_ENTRIES = int(os.getenv("DECISION_MEMO_MAX_ENTRIES", "50000"))
+DECISION_MEMO_MEMORY_ENTRIES = int(os.getenv("DECISION_MEMO_MEMORY_ENTRIES", "2048"))
+
+
+def memo_key(node: str, template_version: str, prompt: str) -> str:
+    """Key for a (node, prompt template version, normalized prompt) triple
+
+    The rendered prompt carries the node's inputs (query, language, route),
+    so normalizing it normalizes the inputs too.
+    """
+    normalized = normalize_text(prompt).lower()
+    return hashlib.sha256(f"{node}\0{template_version}\0{normalized}".encode("utf-8")).hexdigest()
+
+
+class DecisionMemo:
+    """Memo of deterministic LLM decisions: in-memory LRU over an optional SQLite tier"""
+
+    def __init__(
+        self,
+        path: Optional[str] = DECISION_MEMO_PATH,
+        max_entries: int = DECISION_MEMO_MAX_ENTRIES,
+        memory_entries: int = DECISION_MEMO_MEMORY_ENTRIES,
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self._memory: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        self._writes_since_trim = 0
+
+        self.hits: Counter = Counter()
+        self.misses: Counter = Counter()
+
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS decisions (
+                    key TEXT PRIMARY KEY,
+                    node TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    last_access REAL NOT NULL
+                )
+                """
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS decisions_last_access ON decisions (last_access)"
+            )
+            self._conn.commit()
+
+    def _remember(self, key: str, value: str) -> None:
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, node: str, template_version: str, prompt: str) -> Optional[str]:
+        """Previous model output for this node and prompt, or None"""
+        key = memo_key(node, template_version, prompt)
+
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+            elif self._conn is not None:
+                row = self._conn.execute("SELECT value FROM decisions WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    value = row[0]
+                    self._conn.execute(
+                        "UPDATE decisions SET last_access = ? WHERE key = ?", (time.time(), key)
+                    )
+                    self._conn.commit()
+                    self._remember(key, value)
+
+            if value is None:
+                self.misses[node] += 1
+            else:
+                self.hits[node] += 1
+            return value
+
+    def put(self, node: str, template_version: str, prompt: str, value: str) -> None:
+        key = memo_key(node, template_version, prompt)
+
+        with self._lock:
+            self._remember(key, value)
+
+            if self._conn is None:
+                return
+
+            self._conn.execute(
+                "INSERT OR REPLACE INTO decisions (key, node, value, last_access) VALUES (?, ?, ?, ?)",
+                (key, node, value, time.time()),
+            )
+            self._writes_since_trim += 1
+
+            # Enforce the size cap, evicting least recently used rows
+            if self._writes_since_trim >= max(1, self.max_entries // 100):
+                self._writes_since_trim = 0
+                (count,) = self._conn.execute("SELECT COUNT(*) FROM decisions").fetchone()
+                if count > self.max_entries:
+                    self._conn.execute(
+                        """
+                        DELETE FROM decisions WHERE key IN (
+                            SELECT key FROM decisions ORDER BY last_access ASC LIMIT ?
+                        )
+                        """,
+                        (count - self.max_entries,),
+                    )
+            self._conn.commit()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM decisions")
+                self._conn.commit()
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Hit and miss counters per node since startup"""
+        with self._lock:
+            return {
+                node: {"hits": self.hits[node], "misses": self.misses[node]}
+                for node in sorted(set(self.hits) | set(self.misses))
+            }
+
+
+_default_memo: Optional[DecisionMemo] = None
+_default_memo_lock = threading.Lock()
+
+
+def get_decision_memo() -> DecisionMemo:
+    """Process-wide decision memo"""
+    global _default_memo
+    if _default_memo is None:
+        with _default_memo_lock:
+            if _default_memo is None:
+                _default_memo = DecisionMemo()
+    return _default_memo
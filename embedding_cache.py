@@ -0,0 +1,234 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "./cache/embeddings.sqlite3")
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "200000"))
+EMBEDDING_CACHE_MEMORY_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MEMORY_ENTRIES", "4096"))
+
+# Access times are written to SQLite in batches: at the next put, after this
+# many seconds, or once this many are pending
+ACCESS_FLUSH_INTERVAL = 30.0
+ACCESS_FLUSH_ENTRIES = 1024
+
+
+def normalize_text(text: str) -> str:
+    """Normalize text so trivially different inputs share a cache entry"""
+    text = unicodedata.normalize("NFC", text)
+    return " ".join(text.split())
+
+
+def cache_key(model: str, text: str) -> str:
+    """Cache key for a (model, normalized text) pair"""
+    return hashlib.sha256(f"{model}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """Two-tier embedding cache: in-memory LRU in front of a size-capped SQLite store
+
+    Vectors are stored on disk as packed float32 blobs. Pass path=None to keep
+    the cache in memory only. Lookups only read from SQLite; the access times
+    that drive eviction are kept in memory and written in batches.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = EMBEDDING_CACHE_PATH,
+        max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES,
+        memory_entries: int = EMBEDDING_CACHE_MEMORY_ENTRIES,
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self._memory: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        self._writes_since_trim = 0
+        # key -> last access time not yet written to SQLite
+        self._pending_access: Dict[str, float] = {}
+        self._access_flushed_at = time.monotonic()
+
+        self.hits = 0
+        self.misses = 0
+
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    key TEXT PRIMARY KEY,
+                    model TEXT NOT NULL,
+                    dim INTEGER NOT NULL,
+                    vector BLOB NOT NULL,
+                    last_access REAL NOT NULL
+                )
+                """
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS embeddings_last_access ON embeddings (last_access)"
+            )
+            self._conn.commit()
+
+    def _remember(self, key: str, vector: List[float]) -> None:
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _flush_access(self) -> None:
+        """Write pending access times; the caller commits"""
+        if self._pending_access:
+            self._conn.executemany(
+                "UPDATE embeddings SET last_access = ? WHERE key = ?",
+                [(accessed, key) for key, accessed in self._pending_access.items()],
+            )
+            self._pending_access.clear()
+        self._access_flushed_at = time.monotonic()
+
+    def get_many(self, model: str, texts: List[str]) -> Dict[int, List[float]]:
+        """Look up texts, returning {position: vector} for the hits"""
+        found: Dict[int, List[float]] = {}
+        keys = [cache_key(model, text) for text in texts]
+
+        with self._lock:
+            missing = []
+            for i, key in enumerate(keys):
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    found[i] = self._memory[key]
+                else:
+                    missing.append(i)
+
+            if missing and self._conn is not None:
+                wanted = {keys[i] for i in missing}
+                rows = {}
+                wanted_list = list(wanted)
+                # Stay under SQLite's bound-parameter limit
+                for start in range(0, len(wanted_list), 500):
+                    chunk = wanted_list[start:start + 500]
+                    placeholders = ",".join("?" * len(chunk))
+                    for key, blob in self._conn.execute(
+                        f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", chunk
+                    ):
+                        rows[key] = array("f", blob).tolist()
+
+                for i in missing:
+                    vector = rows.get(keys[i])
+                    if vector is not None:
+                        found[i] = vector
+                        self._remember(keys[i], vector)
+
+            if found and self._conn is not None:
+                now = time.time()
+                for i in found:
+                    self._pending_access[keys[i]] = now
+                if (
+                    len(self._pending_access) >= ACCESS_FLUSH_ENTRIES
+                    or time.monotonic() - self._access_flushed_at >= ACCESS_FLUSH_INTERVAL
+                ):
+                    self._flush_access()
+                    self._conn.commit()
+
+            self.hits += len(found)
+            self.misses += len(texts) - len(found)
+
+        return found
+
+    def put_many(self, model: str, texts: List[str], vectors: List[List[float]]) -> None:
+        """Store vectors for texts"""
+        keys = [cache_key(model, text) for text in texts]
+
+        with self._lock:
+            for key, vector in zip(keys, vectors):
+                self._remember(key, list(vector))
+
+            if self._conn is None:
+                return
+
+            now = time.time()
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, model, dim, vector, last_access) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (key, model, len(vector), array("f", vector).tobytes(), now)
+                    for key, vector in zip(keys, vectors)
+                ],
+            )
+            self._writes_since_trim += len(keys)
+            # Recent reads count before eviction picks the oldest rows
+            self._flush_access()
+
+            # Enforce the size cap, evicting least recently used rows
+            if self._writes_since_trim >= max(1, self.max_entries // 100):
+                self._writes_since_trim = 0
+                (count,) = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+                if count > self.max_entries:
+                    self._conn.execute(
+                        """
+                        DELETE FROM embeddings WHERE key IN (
+                            SELECT key FROM embeddings ORDER BY last_access ASC LIMIT ?
+                        )
+                        """,
+                        (count - self.max_entries,),
+                    )
+            self._conn.commit()
+
+    def get_or_compute(self, model: str, texts: List[str], embed_fn) -> List[List[float]]:
+        """Return vectors for texts, calling embed_fn only for cache misses"""
+        found = self.get_many(model, texts)
+        missing = [i for i in range(len(texts)) if i not in found]
+
+        if missing:
+            # Embed each distinct normalized text once
+            unique: "OrderedDict[str, str]" = OrderedDict()
+            for i in missing:
+                unique.setdefault(normalize_text(texts[i]), texts[i])
+            computed = embed_fn(list(unique.values()))
+            if len(computed) != len(unique):
+                raise ValueError(f"Embedder returned {len(computed)} vectors for {len(unique)} texts")
+
+            self.put_many(model, list(unique.values()), computed)
+            by_text = dict(zip(unique.keys(), computed))
+            for i in missing:
+                found[i] = list(by_text[normalize_text(texts[i])])
+
+        return [found[i] for i in range(len(texts))]
+
+    def flush(self) -> None:
+        """Write pending access times to SQLite now"""
+        with self._lock:
+            if self._conn is not None:
+                self._flush_access()
+                self._conn.commit()
+
+    def stats(self) -> Dict[str, int]:
+        """Hit and miss counters since startup"""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "memory_entries": len(self._memory)}
+
+
+_default_cache: Optional[EmbeddingCache] = None
+_default_cache_lock = threading.Lock()
+
+
+def get_embedding_cache() -> EmbeddingCache:
+    """Process-wide cache shared by the indexer and the query path"""
+    global _default_cache
+    if _default_cache is None:
+        with _default_cache_lock:
+            if _default_cache is None:
+                _default_cache = EmbeddingCache(EMBEDDING_CACHE_PATH or None)
+    return _default_cache
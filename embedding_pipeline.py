@@ -0,0 +1,133 @@
+import asyncio
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# An embedder takes a list of texts and returns one vector per text, in order
+BatchEmbedder = Callable[[List[str]], List[List[float]]]
+
+# Defaults (overridable through .env)
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "50"))
+EMBED_MAX_CONCURRENCY = int(os.getenv("EMBED_MAX_CONCURRENCY", "4"))
+EMBED_REQUESTS_PER_SECOND = float(os.getenv("EMBED_REQUESTS_PER_SECOND", "5"))
+EMBED_MAX_RETRIES = int(os.getenv("EMBED_MAX_RETRIES", "5"))
+
+
+class TokenBucket:
+    """Thread-safe token-bucket rate limiter"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _take(self, tokens: float) -> float:
+        """Take the tokens if available and return 0, else return seconds to wait"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0.0
+
+            return (tokens - self._tokens) / self.rate
+
+    def acquire(self, tokens: float = 1.0) -> None:
+        """Block until the requested number of tokens is available"""
+        while True:
+            wait = self._take(tokens)
+            if not wait:
+                return
+            time.sleep(wait)
+
+    async def aacquire(self, tokens: float = 1.0) -> None:
+        """Wait for the tokens without blocking the event loop or a worker thread"""
+        while True:
+            wait = self._take(tokens)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+
+def embed_with_retry(
+    embed_fn: BatchEmbedder,
+    texts: List[str],
+    max_retries: int = EMBED_MAX_RETRIES,
+    base_delay: float = 1.0,
+    max_delay: float = 30.0,
+    rate_limiter: Optional[TokenBucket] = None,
+) -> List[List[float]]:
+    """Embed one batch, retrying with exponential backoff and jitter"""
+    attempt = 0
+    while True:
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+        try:
+            embeddings = embed_fn(texts)
+            if len(embeddings) != len(texts):
+                raise ValueError(f"Embedder returned {len(embeddings)} vectors for {len(texts)} texts")
+            return embeddings
+        except Exception as e:
+            attempt += 1
+            if attempt > max_retries:
+                raise
+            delay = min(max_delay, base_delay * (2 ** (attempt - 1)))
+            delay = delay * (0.5 + random.random() / 2)
+            print(f"[System] Embedding batch failed ({e}), retry {attempt}/{max_retries} in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def embed_texts_batched(
+    texts: List[str],
+    embed_fn: BatchEmbedder,
+    batch_size: int = EMBED_BATCH_SIZE,
+    max_concurrency: int = EMBED_MAX_CONCURRENCY,
+    requests_per_second: float = EMBED_REQUESTS_PER_SECOND,
+    max_retries: int = EMBED_MAX_RETRIES,
+    on_progress: Optional[Callable[[int, int], None]] = None,
+) -> List[List[float]]:
+    """Embed texts as multi-text requests, running several batches concurrently
+
+    Returns one vector per input text in the original order. Raises the last
+    error if a batch still fails after all retries.
+    """
+    if not texts:
+        return []
+
+    batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+    rate_limiter = TokenBucket(requests_per_second) if requests_per_second > 0 else None
+
+    done = 0
+    done_lock = threading.Lock()
+
+    def run_batch(batch: List[str]) -> List[List[float]]:
+        nonlocal done
+        embeddings = embed_with_retry(
+            embed_fn,
+            batch,
+            max_retries=max_retries,
+            rate_limiter=rate_limiter,
+        )
+        if on_progress is not None:
+            with done_lock:
+                done += len(batch)
+                on_progress(done, len(texts))
+        return embeddings
+
+    with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+        results = list(executor.map(run_batch, batches))
+
+    return [embedding for batch_embeddings in results for embedding in batch_embeddings]
@@ -0,0 +1,173 @@
+import asyncio
+import os
+import threading
+import time
+from typing import Callable, List, Optional
+
+import google.generativeai as genai
+from dotenv import load_dotenv
+
+from embedding_cache import get_embedding_cache
+from local_embedding import LOCAL_EMBEDDING_DIM, LOCAL_EMBEDDING_MODEL, embed_text, local_embed
+from tracing import annotate, span
+
+load_dotenv()
+
+# Configure Gemini API
+genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+
+# "gemini" calls the embedding API; "local" uses the offline n-gram embedder;
+# "stub" is the local embedder with a simulated API round trip
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "gemini").lower()
+STUB_EMBEDDING_LATENCY = float(os.getenv("STUB_EMBEDDING_LATENCY", "0.05"))
+
+if EMBEDDING_BACKEND in ("local", "stub"):
+    EMBEDDING_MODEL = f"{LOCAL_EMBEDDING_MODEL}-{LOCAL_EMBEDDING_DIM}"
+else:
+    EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "models/text-embedding-004")
+
+
+def gemini_embed(texts: List[str], model: str = EMBEDDING_MODEL) -> List[List[float]]:
+    """Generate embeddings for several texts in one Gemini API request"""
+    result = genai.embed_content(
+        model=model,
+        content=texts
+    )
+    return result['embedding']
+
+
+async def gemini_aembed(texts: List[str], model: str = EMBEDDING_MODEL) -> List[List[float]]:
+    """Async variant of gemini_embed"""
+    result = await genai.embed_content_async(
+        model=model,
+        content=texts
+    )
+    return result['embedding']
+
+
+class EmbeddingProvider:
+    """Embedding backend; model names the vector space and keys the embedding cache"""
+
+    model = ""
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        raise NotImplementedError
+
+    async def aembed(self, texts: List[str]) -> List[List[float]]:
+        return await asyncio.to_thread(self.embed, texts)
+
+
+class GeminiEmbeddings(EmbeddingProvider):
+    def __init__(self, model: str = EMBEDDING_MODEL):
+        self.model = model
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        return gemini_embed(texts, self.model)
+
+    async def aembed(self, texts: List[str]) -> List[List[float]]:
+        return await gemini_aembed(texts, self.model)
+
+
+class LocalEmbeddings(EmbeddingProvider):
+    model = f"{LOCAL_EMBEDDING_MODEL}-{LOCAL_EMBEDDING_DIM}"
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        return local_embed(texts)
+
+    async def aembed(self, texts: List[str]) -> List[List[float]]:
+        return local_embed(texts)
+
+
+class StubEmbeddings(LocalEmbeddings):
+    """Local embeddings that wait `latency` seconds per batch, like an API call
+
+    Shares the local model name, so an index built with EMBEDDING_BACKEND=local
+    serves it.
+    """
+
+    def __init__(self, latency: float = STUB_EMBEDDING_LATENCY):
+        self.latency = latency
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        time.sleep(self.latency)
+        return local_embed(texts)
+
+    async def aembed(self, texts: List[str]) -> List[List[float]]:
+        await asyncio.sleep(self.latency)
+        return local_embed(texts)
+
+
+def create_embedding_provider(name: str = EMBEDDING_BACKEND) -> EmbeddingProvider:
+    if name == "local":
+        return LocalEmbeddings()
+    if name == "stub":
+        return StubEmbeddings()
+    if name == "gemini":
+        return GeminiEmbeddings()
+    raise ValueError(f"Unknown embedding backend: {name}")
+
+
+_provider: Optional[EmbeddingProvider] = None
+_provider_lock = threading.Lock()
+
+
+def get_embedding_provider() -> EmbeddingProvider:
+    """Process-wide embedding provider, chosen by EMBEDDING_BACKEND on first use"""
+    global _provider
+    if _provider is None:
+        with _provider_lock:
+            if _provider is None:
+                _provider = create_embedding_provider()
+    return _provider
+
+
+def set_embedding_provider(provider: EmbeddingProvider) -> None:
+    """Replace the process-wide embedding provider"""
+    global _provider
+    with _provider_lock:
+        _provider = provider
+
+
+def batch_embed(texts: List[str]) -> List[List[float]]:
+    """Uncached batch embedding with the configured provider"""
+    return get_embedding_provider().embed(texts)
+
+
+def embed_texts(
+    texts: List[str],
+    batch_embedder: Optional[Callable[[List[str]], List[List[float]]]] = None,
+) -> List[List[float]]:
+    """Embed texts, only sending cache misses to the embedding backend"""
+    provider = get_embedding_provider()
+    embed = batch_embedder or provider.embed
+
+    def embed_missing(missing: List[str]) -> List[List[float]]:
+        annotate(cache_hits=len(texts) - len(missing), cache_misses=len(missing))
+        return embed(missing)
+
+    with span("embed_content", "embedding", texts=len(texts), cache_hits=len(texts), model=provider.model):
+        return get_embedding_cache().get_or_compute(provider.model, texts, embed_missing)
+
+
+async def aembed_texts(texts: List[str]) -> List[List[float]]:
+    """Async variant of embed_texts; cache misses are embedded without blocking the event loop"""
+    provider = get_embedding_provider()
+    cache = get_embedding_cache()
+
+    with span("embed_content", "embedding", texts=len(texts), model=provider.model):
+        found = cache.get_many(provider.model, texts)
+        missing = [position for position in range(len(texts)) if position not in found]
+        annotate(cache_hits=len(found), cache_misses=len(missing))
+
+        if missing:
+            missing_texts = [texts[position] for position in missing]
+            vectors = await provider.aembed(missing_texts)
+            cache.put_many(provider.model, missing_texts, vectors)
+            found.update(zip(missing, vectors))
+
+    return [found[position] for position in range(len(texts))]
+
+
+def fallback_embedding(text: str, dimension: int = LOCAL_EMBEDDING_DIM) -> List[float]:
+    """Offline embedding of the given dimension, used when the embedding API fails"""
+    return embed_text(text, dimension).tolist()
@@ -0,0 +1,100 @@
+import heapq
+import json
+import math
+import os
+import re
+import unicodedata
+from collections import Counter
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+LEXICAL_INDEX_FILE = "lexical_index.json"
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+(?:\.[0-9]+)?")
+
+
+def fold_diacritics(text: str) -> str:
+    """Strip Vietnamese diacritics so "điện thoại" and "dien thoai" match"""
+    text = text.replace("đ", "d").replace("Đ", "D")
+    decomposed = unicodedata.normalize("NFD", text)
+    return "".join(c for c in decomposed if unicodedata.category(c) != "Mn")
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase, diacritic-folded tokens; keeps model names and sizes like "a05s" or "128gb" intact"""
+    return _TOKEN_RE.findall(fold_diacritics(text).lower())
+
+
+class LexicalIndex:
+    """BM25 scorer over a precomputed inverted index
+
+    Per-posting BM25 weights are computed once at build time, so scoring a
+    query is a sum over the postings of its terms.
+    """
+
+    def __init__(self, ids: List[str], metadatas: List[Dict[str, Any]], postings: Dict[str, List[List[float]]]):
+        self.ids = ids
+        self.metadatas = metadatas
+        self.postings = postings
+
+    @classmethod
+    def build(
+        cls,
+        ids: Sequence[str],
+        texts: Sequence[str],
+        metadatas: Sequence[Dict[str, Any]],
+        k1: float = 1.5,
+        b: float = 0.75,
+    ) -> "LexicalIndex":
+        """Build the inverted index from the searchable product texts"""
+        term_counts = [Counter(tokenize(text)) for text in texts]
+        doc_lengths = [sum(counts.values()) for counts in term_counts]
+        n_docs = len(texts)
+        avg_length = (sum(doc_lengths) / n_docs) if n_docs else 0.0
+
+        document_frequency: Counter = Counter()
+        for counts in term_counts:
+            document_frequency.update(counts.keys())
+
+        postings: Dict[str, List[List[float]]] = {}
+        for doc, counts in enumerate(term_counts):
+            norm = k1 * (1 - b + b * doc_lengths[doc] / avg_length) if avg_length else k1
+            for term, tf in counts.items():
+                df = document_frequency[term]
+                idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+                weight = idf * tf * (k1 + 1) / (tf + norm)
+                postings.setdefault(term, []).append([doc, round(weight, 6)])
+
+        return cls(list(ids), list(metadatas), postings)
+
+    def save(self, path: str) -> None:
+        os.makedirs(path, exist_ok=True)
+        tmp_path = os.path.join(path, LEXICAL_INDEX_FILE + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {"ids": self.ids, "metadatas": self.metadatas, "postings": self.postings},
+                f,
+                ensure_ascii=False,
+            )
+        os.replace(tmp_path, os.path.join(path, LEXICAL_INDEX_FILE))
+
+    @classmethod
+    def load(cls, path: str) -> "LexicalIndex":
+        with open(os.path.join(path, LEXICAL_INDEX_FILE), encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data["ids"], data["metadatas"], data["postings"])
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def search(self, query: str, k: int = 5, allowed_ids: Optional[Set[str]] = None) -> List[Tuple[int, float]]:
+        """Return (document position, BM25 score) pairs, best first
+
+        If allowed_ids is given, only those documents are considered.
+        """
+        scores: Dict[int, float] = {}
+        for term in set(tokenize(query)):
+            for doc, weight in self.postings.get(term, ()):
+                scores[doc] = scores.get(doc, 0.0) + weight
+        if allowed_ids is not None:
+            scores = {doc: score for doc, score in scores.items() if self.ids[doc] in allowed_ids}
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
@@ -0,0 +1,247 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from typing import AsyncIterator, Iterator, List, Optional
+
+import google.generativeai as genai
+from dotenv import load_dotenv
+
+from context_budget import estimate_tokens
+from prompt import (
+    CONTEXT_EVALUATOR_INSTRUCTION,
+    HISTORY_SUMMARIZER_INSTRUCTION,
+    MANAGER_INSTRUCTION,
+    QUERY_PLANNER_INSTRUCTION,
+    QUERY_REWRITER_INSTRUCTION,
+    RESPONSE_EVALUATOR_INSTRUCTION,
+    SOURCE_SELECTOR_INSTRUCTION,
+)
+from tracing import annotate
+
+load_dotenv()
+
+# "gemini" calls the API; "stub" answers locally (see StubLLMProvider)
+LLM_PROVIDER = os.getenv("LLM_PROVIDER", "gemini").lower()
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.0-flash")
+
+# Simulated latency of the stub: seconds before the first token, then per token
+STUB_LLM_LATENCY = float(os.getenv("STUB_LLM_LATENCY", "0.3"))
+STUB_LLM_TOKEN_LATENCY = float(os.getenv("STUB_LLM_TOKEN_LATENCY", "0.01"))
+# Words of retrieved context echoed back in a stub answer
+STUB_ANSWER_WORDS = int(os.getenv("STUB_ANSWER_WORDS", "60"))
+
+
+class LLMProvider:
+    """Text generation backend used by the graph nodes
+
+    generate/agenerate return the whole response text; stream/astream yield
+    it in chunks as they are produced.
+    """
+
+    name = "base"
+
+    def generate(self, prompt: str, json_mode: bool = False) -> str:
+        raise NotImplementedError
+
+    async def agenerate(self, prompt: str, json_mode: bool = False) -> str:
+        raise NotImplementedError
+
+    def stream(self, prompt: str) -> Iterator[str]:
+        raise NotImplementedError
+
+    def astream(self, prompt: str) -> AsyncIterator[str]:
+        raise NotImplementedError
+
+
+def _annotate_usage(response) -> None:
+    """Record the token counts Gemini reports on the current trace span"""
+    usage = getattr(response, "usage_metadata", None)
+    if usage:
+        annotate(tokens_in=usage.prompt_token_count, tokens_out=usage.candidates_token_count)
+
+
+def _chunk_text(chunk) -> str:
+    # Chunks without text parts (e.g. the final one carrying only the finish reason) raise
+    try:
+        return chunk.text
+    except ValueError:
+        return ""
+
+
+class GeminiProvider(LLMProvider):
+    """Google Gemini through google-generativeai"""
+
+    name = "gemini"
+
+    def __init__(self, model_name: str = GEMINI_MODEL, api_key: Optional[str] = None):
+        genai.configure(api_key=api_key or os.getenv("GEMINI_API_KEY"))
+        self.model = genai.GenerativeModel(model_name)
+
+    @staticmethod
+    def _generation_config(json_mode: bool):
+        return {"response_mime_type": "application/json"} if json_mode else None
+
+    def generate(self, prompt: str, json_mode: bool = False) -> str:
+        response = self.model.generate_content(prompt, generation_config=self._generation_config(json_mode))
+        _annotate_usage(response)
+        return response.text
+
+    async def agenerate(self, prompt: str, json_mode: bool = False) -> str:
+        response = await self.model.generate_content_async(prompt, generation_config=self._generation_config(json_mode))
+        _annotate_usage(response)
+        return response.text
+
+    def stream(self, prompt: str) -> Iterator[str]:
+        # The last chunk carries the usage totals
+        for chunk in self.model.generate_content(prompt, stream=True):
+            _annotate_usage(chunk)
+            text = _chunk_text(chunk)
+            if text:
+                yield text
+
+    async def astream(self, prompt: str) -> AsyncIterator[str]:
+        async for chunk in await self.model.generate_content_async(prompt, stream=True):
+            _annotate_usage(chunk)
+            text = _chunk_text(chunk)
+            if text:
+                yield text
+
+
+_QUERY_LINE = re.compile(r"^\s*(?:User query|Original query|Query):\s*(.*)$", re.MULTILINE)
+_SHOP_WORDS = ("cửa hàng", "địa chỉ", "giờ mở", "chi nhánh", "shop", "store", "address", "open")
+
+
+class StubLLMProvider(LLMProvider):
+    """Deterministic offline stand-in for benchmarks and development
+
+    Each prompt is recognized by the instruction it embeds and answered the
+    way the node expects (a plan, a language code, a route, "yes", ...).
+    Answers echo the first STUB_ANSWER_WORDS words of the retrieved context so
+    their length tracks the prompt. Every call waits `latency` seconds plus
+    `token_latency` per word, so turn timings resemble a remote model. Token
+    counts are estimated from the text length.
+    """
+
+    name = "stub"
+
+    def __init__(
+        self,
+        latency: float = STUB_LLM_LATENCY,
+        token_latency: float = STUB_LLM_TOKEN_LATENCY,
+        answer_words: int = STUB_ANSWER_WORDS,
+    ):
+        self.latency = latency
+        self.token_latency = token_latency
+        self.answer_words = answer_words
+
+    @staticmethod
+    def _query(prompt: str) -> str:
+        match = _QUERY_LINE.search(prompt)
+        return match.group(1).strip() if match else ""
+
+    @staticmethod
+    def _language(query: str) -> str:
+        return "en" if query.isascii() else "vi"
+
+    @staticmethod
+    def _route(text: str) -> str:
+        folded = text.lower()
+        return "shop_information" if any(word in folded for word in _SHOP_WORDS) else "product"
+
+    def respond(self, prompt: str) -> str:
+        """The stub's full answer to a prompt"""
+        query = self._query(prompt)
+        route = self._route(query)
+        sources = ["shop_database"] if route == "shop_information" else ["vector_database"]
+
+        if QUERY_PLANNER_INSTRUCTION in prompt:
+            return json.dumps({
+                "language": self._language(query),
+                "rewritten_query": query,
+                "route": route,
+                "needs_additional_info": True,
+                "sources": sources,
+            }, ensure_ascii=False)
+        if "Detect the language" in prompt:
+            return self._language(query)
+        if QUERY_REWRITER_INSTRUCTION in prompt:
+            return query
+        if MANAGER_INSTRUCTION in prompt:
+            return route
+        if CONTEXT_EVALUATOR_INSTRUCTION in prompt or RESPONSE_EVALUATOR_INSTRUCTION in prompt:
+            return "yes"
+        if SOURCE_SELECTOR_INSTRUCTION in prompt:
+            agent_type = re.search(r"Agent type:\s*(\S+)", prompt)
+            if agent_type and "shop" in agent_type.group(1):
+                return "shop_database"
+            return "vector_database"
+        if HISTORY_SUMMARIZER_INSTRUCTION in prompt:
+            _, _, turns = prompt.partition("New turns:")
+            return " ".join(turns.split()[:self.answer_words])
+
+        _, _, context = prompt.partition("Retrieved Context:")
+        digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:8]
+        words = context.split()[:self.answer_words]
+        return f"[stub {digest}] {query} " + " ".join(words)
+
+    def _chunks(self, prompt: str) -> List[str]:
+        text = self.respond(prompt)
+        annotate(tokens_in=estimate_tokens(prompt), tokens_out=estimate_tokens(text))
+        return [word + " " for word in text.split()]
+
+    def generate(self, prompt: str, json_mode: bool = False) -> str:
+        text = self.respond(prompt)
+        annotate(tokens_in=estimate_tokens(prompt), tokens_out=estimate_tokens(text))
+        time.sleep(self.latency + self.token_latency * len(text.split()))
+        return text
+
+    async def agenerate(self, prompt: str, json_mode: bool = False) -> str:
+        text = self.respond(prompt)
+        annotate(tokens_in=estimate_tokens(prompt), tokens_out=estimate_tokens(text))
+        await asyncio.sleep(self.latency + self.token_latency * len(text.split()))
+        return text
+
+    def stream(self, prompt: str) -> Iterator[str]:
+        time.sleep(self.latency)
+        for chunk in self._chunks(prompt):
+            time.sleep(self.token_latency)
+            yield chunk
+
+    async def astream(self, prompt: str) -> AsyncIterator[str]:
+        await asyncio.sleep(self.latency)
+        for chunk in self._chunks(prompt):
+            await asyncio.sleep(self.token_latency)
+            yield chunk
+
+
+def create_llm_provider(name: str = LLM_PROVIDER) -> LLMProvider:
+    if name == "stub":
+        return StubLLMProvider()
+    if name == "gemini":
+        return GeminiProvider()
+    raise ValueError(f"Unknown LLM provider: {name}")
+
+
+_provider: Optional[LLMProvider] = None
+_provider_lock = threading.Lock()
+
+
+def get_llm_provider() -> LLMProvider:
+    """Process-wide LLM provider, chosen by LLM_PROVIDER on first use"""
+    global _provider
+    if _provider is None:
+        with _provider_lock:
+            if _provider is None:
+                _provider = create_llm_provider()
+    return _provider
+
+
+def set_llm_provider(provider: LLMProvider) -> None:
+    """Replace the process-wide LLM provider (e.g. with a stub or a wrapper)"""
+    global _provider
+    with _provider_lock:
+        _provider = provider
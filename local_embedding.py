@@ -0,0 +1,73 @@
+import os
+import zlib
+from typing import List
+
+import numpy as np
+from dotenv import load_dotenv
+
+from lexical_index import fold_diacritics, tokenize
+
+load_dotenv()
+
+# text-embedding-004 produces 768-dimensional vectors
+LOCAL_EMBEDDING_DIM = int(os.getenv("LOCAL_EMBEDDING_DIM", "768"))
+LOCAL_EMBEDDING_MODEL = "local-ngram-hash-v1"
+
+NGRAM_SIZES = (3, 4, 5)
+_FNV_PRIME = np.uint64(1099511628211)
+_MIX = np.uint64(0x9E3779B97F4A7C15)
+
+
+def _ngram_hashes(data: np.ndarray, n: int) -> np.ndarray:
+    """Rolling polynomial hash of every n-byte window (uint64, wraps on overflow)"""
+    count = len(data) - n + 1
+    hashes = np.zeros(count, dtype=np.uint64)
+    for offset in range(n):
+        hashes = hashes * _FNV_PRIME + data[offset:offset + count]
+    return (hashes ^ np.uint64(n)) * _MIX
+
+
+def embed_text(text: str, dimension: int = LOCAL_EMBEDDING_DIM) -> np.ndarray:
+    """Deterministic offline embedding from hashed character n-grams and words
+
+    Each feature is hashed to a bucket and a sign in a vector of the requested
+    dimension (signed feature hashing), then the vector is L2-normalized. Texts
+    sharing many n-grams get high cosine similarity, which is enough to keep
+    retrieval working when the embedding API is unavailable.
+    """
+    folded = " " + " ".join(fold_diacritics(text).lower().split()) + " "
+    data = np.frombuffer(folded.encode("utf-8"), dtype=np.uint8).astype(np.uint64)
+    vector = np.zeros(dimension, dtype=np.float64)
+
+    for n in NGRAM_SIZES:
+        if len(data) < n:
+            continue
+        hashes = _ngram_hashes(data, n)
+        buckets = ((hashes >> np.uint64(32)) % np.uint64(dimension)).astype(np.int64)
+        signs = np.where((hashes >> np.uint64(7)) & np.uint64(1), 1.0, -1.0)
+        vector += np.bincount(buckets, weights=signs, minlength=dimension)
+
+    # Whole tokens carry extra weight so exact model names dominate
+    tokens = tokenize(text)
+    if tokens:
+        hashes = np.array([zlib.crc32(token.encode("utf-8")) for token in tokens], dtype=np.uint64) * _MIX
+        buckets = ((hashes >> np.uint64(32)) % np.uint64(dimension)).astype(np.int64)
+        signs = np.where((hashes >> np.uint64(7)) & np.uint64(1), 1.0, -1.0)
+        vector += 2.0 * np.bincount(buckets, weights=signs, minlength=dimension)
+
+    norm = np.linalg.norm(vector)
+    if norm > 0:
+        vector /= norm
+    return vector.astype(np.float32)
+
+
+def embed_texts(texts: List[str], dimension: int = LOCAL_EMBEDDING_DIM) -> np.ndarray:
+    """Embed several texts into an (n, dimension) float32 matrix"""
+    if not texts:
+        return np.zeros((0, dimension), dtype=np.float32)
+    return np.stack([embed_text(text, dimension) for text in texts])
+
+
+def local_embed(texts: List[str]) -> List[List[float]]:
+    """Batch embedder with the same interface as embeddings.gemini_embed"""
+    return embed_texts(texts).tolist()
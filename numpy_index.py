@@ -0,0 +1,110 @@
+import json
+import os
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+VECTORS_FILE = "vectors.npy"
+METADATA_FILE = "metadata.json"
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    """L2-normalize each row, leaving zero rows untouched"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def write_numpy_index(
+    path: str,
+    ids: Sequence[str],
+    embeddings: Sequence[Sequence[float]],
+    metadatas: Sequence[Dict[str, Any]],
+) -> None:
+    """Write a normalized float32 matrix plus its ids and metadata to disk"""
+    if not (len(ids) == len(embeddings) == len(metadatas)):
+        raise ValueError("ids, embeddings and metadatas must have the same length")
+
+    os.makedirs(path, exist_ok=True)
+    matrix = np.ascontiguousarray(normalize_rows(np.asarray(embeddings, dtype=np.float32)))
+
+    # Write to temporary files first so readers never see a half-written index
+    vectors_tmp = os.path.join(path, VECTORS_FILE + ".tmp")
+    with open(vectors_tmp, "wb") as f:
+        np.save(f, matrix)
+
+    metadata_tmp = os.path.join(path, METADATA_FILE + ".tmp")
+    with open(metadata_tmp, "w", encoding="utf-8") as f:
+        json.dump({"ids": list(ids), "metadatas": list(metadatas)}, f, ensure_ascii=False)
+
+    os.replace(vectors_tmp, os.path.join(path, VECTORS_FILE))
+    os.replace(metadata_tmp, os.path.join(path, METADATA_FILE))
+
+
+class NumpyVectorIndex:
+    """Brute-force cosine-similarity index over a memory-mapped float32 matrix"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.matrix = np.load(os.path.join(path, VECTORS_FILE), mmap_mode="r")
+        with open(os.path.join(path, METADATA_FILE), encoding="utf-8") as f:
+            data = json.load(f)
+        self.ids: List[str] = data["ids"]
+        self.metadatas: List[Dict[str, Any]] = data["metadatas"]
+
+        if self.matrix.ndim != 2 or self.matrix.shape[0] != len(self.ids):
+            raise ValueError(f"Numpy index at {path} is inconsistent: {self.matrix.shape} vs {len(self.ids)} ids")
+
+        self.positions = {doc_id: position for position, doc_id in enumerate(self.ids)}
+
+    @property
+    def dimension(self) -> int:
+        return self.matrix.shape[1]
+
+    def __len__(self) -> int:
+        return self.matrix.shape[0]
+
+    def search(
+        self,
+        query_embeddings,
+        k: int = 5,
+        allowed_ids: Optional[Set[str]] = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Return (indices, scores) of the top-k rows for each query, best first
+
+        Accepts a single vector or a batch of vectors; results are always 2-D.
+        If allowed_ids is given, only those rows are searched.
+        """
+        queries = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+        if queries.shape[1] != self.dimension:
+            raise ValueError(
+                f"Query embedding has dimension {queries.shape[1]}, index expects {self.dimension}"
+            )
+
+        if allowed_ids is not None:
+            rows = np.array(sorted(self.positions[i] for i in allowed_ids if i in self.positions), dtype=np.int64)
+            matrix = self.matrix[rows]
+        else:
+            rows = None
+            matrix = self.matrix
+
+        n = matrix.shape[0]
+        k = min(k, n)
+        if k <= 0:
+            empty = np.empty((queries.shape[0], 0))
+            return empty.astype(np.int64), empty.astype(np.float32)
+
+        scores = normalize_rows(queries) @ matrix.T
+
+        if k < n:
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        else:
+            top = np.tile(np.arange(n), (queries.shape[0], 1))
+
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        if rows is not None:
+            top = rows[top]
+        return top, np.take_along_axis(top_scores, order, axis=1)
@@ -0,0 +1,241 @@
+import csv
+import os
+import re
+import threading
+from collections import Counter
+from typing import Dict, Optional, Set, Tuple
+
+from dotenv import load_dotenv
+
+from lexical_index import tokenize
+
+load_dotenv()
+
+PRODUCT_CSV_PATH = os.getenv("PRODUCT_CSV_PATH", "./hoanghamobile.csv")
+RULE_CLASSIFIER = os.getenv("RULE_CLASSIFIER", "true").lower() == "true"
+RULE_CLASSIFIER_THRESHOLD = float(os.getenv("RULE_CLASSIFIER_THRESHOLD", "0.85"))
+
+# Letters that only appear in Vietnamese text
+_VIETNAMESE_CHARS = re.compile(
+    "[ăâđêôơưàảãáạằẳẵắặầẩẫấậèẻẽéẹềểễếệìỉĩíịòỏõóọồổỗốộờởỡớợùủũúụừửữứựỳỷỹýỵ]",
+    re.IGNORECASE,
+)
+
+# Common words of unaccented Vietnamese and of English (diacritic-folded)
+VIETNAMESE_WORDS = {
+    "gia", "bao", "nhieu", "dien", "thoai", "cua", "hang", "dau", "mua", "con",
+    "khong", "co", "may", "tot", "re", "nao", "gio", "mo", "cho", "toi", "minh",
+    "sao", "duoc", "nhu", "loai", "mau", "moi", "nhat",
+}
+ENGLISH_WORDS = {
+    "the", "what", "is", "are", "price", "how", "much", "where", "store", "phone",
+    "do", "does", "you", "have", "which", "best", "open", "of", "for", "and", "in",
+    "your", "can", "i", "buy", "cheap", "latest", "colors", "come", "when", "near",
+}
+
+# Unaccented words in catalog titles that are product types or everyday words
+# rather than brand, series or model names
+CATALOG_STOPWORDS = {
+    "tai", "nghe", "thay", "chinh", "hang", "sim", "mah", "test", "hot", "key", "find", "design",
+    "nothing", "fit", "flip", "gold", "white", "red", "star", "rock", "magic",
+    "joy", "classic", "vision", "pearl", "tiger", "bundle", "phone", "pin",
+}
+
+# Diacritic-folded phrases that point at each route
+SHOP_PHRASES = [
+    "cua hang", "chi nhanh", "dia chi", "o dau", "gio mo cua", "mo cua", "dong cua",
+    "bao hanh", "sua chua", "giao hang", "doi tra", "so dien thoai", "hotline",
+    "lien he", "store", "shop", "address", "location", "hours", "open", "warranty",
+    "repair", "delivery", "return", "contact", "branch",
+]
+PRODUCT_PHRASES = [
+    "gia", "bao nhieu tien", "price", "cost", "cau hinh", "thong so", "ram", "pin",
+    "man hinh", "camera", "mau sac", "color", "specs", "specification", "dien thoai",
+    "phone", "smartphone", "tra gop", "so sanh", "compare", "moi nhat", "latest",
+]
+
+
+# Words and openings that point back at earlier turns ("nó", "cái đó", "what
+# about", "the cheaper one"); Vietnamese ones are matched with their diacritics
+# so "nó" and "đó" are not confused with English "no" and "do"
+_FOLLOW_UP = re.compile(
+    r"(?:^|\s)(?:nó|chúng|cái (?:đó|này|kia|ấy)|máy (?:đó|này|kia|ấy)|con (?:đó|này|kia|ấy)|"
+    r"mẫu (?:đó|này|kia|ấy)|loại (?:đó|này|kia|ấy)|sản phẩm (?:đó|này|trên)|như trên|ở trên|"
+    r"(?:rẻ|đắt|tốt) hơn(?!\s*\d)|hơn không|còn (?:cái|máy|con|mẫu|loại|màu|bản)|thế còn|vậy còn)(?=$|[\s?.,!])"
+    r"|\b(?:it|its|it's|they|them|their|those|these|that one|this one|the other|the cheaper|"
+    r"the cheapest one|the same|what about|how about|and the|compared to that|cheaper one|bigger one)\b",
+    re.IGNORECASE,
+)
+# An opening "còn", "and" or "what about" with little else is an ellipsis
+_ELLIPSIS_START = re.compile(r"^\s*(?:còn|thế còn|vậy còn|and|what about|how about)\b", re.IGNORECASE)
+
+
+def refers_to_history(query: str) -> bool:
+    """Whether a query only makes sense with the earlier turns (pronouns, ellipsis)
+
+    Self-contained questions can be answered, and cached, as if the
+    conversation had just started.
+    """
+    text = " ".join(query.lower().split())
+    return bool(_FOLLOW_UP.search(text) or _ELLIPSIS_START.search(text))
+
+
+class ClassifierStats:
+    """Thread-safe counters of short-circuited and escalated decisions"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts: Counter = Counter()
+
+    def record(self, decision: str, short_circuited: bool) -> None:
+        with self._lock:
+            self._counts[f"{decision}_{'short_circuited' if short_circuited else 'escalated'}"] += 1
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._counts)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counts.clear()
+
+
+stats = ClassifierStats()
+
+
+def _count_phrases(folded: str, phrases) -> int:
+    padded = f" {folded} "
+    return sum(1 for phrase in phrases if f" {phrase} " in padded)
+
+
+def _name_tokens(title: str) -> Set[str]:
+    """Folded tokens of a title, leaving out words written with Vietnamese diacritics
+
+    Brands, series and model numbers are never spelled with diacritics, while
+    words like "máy", "màn hình" or "người già" always are.
+    """
+    return {
+        token
+        for word in title.split()
+        if not _VIETNAMESE_CHARS.search(word)
+        for token in tokenize(word)
+    }
+
+
+def load_catalog_terms(csv_path: str = PRODUCT_CSV_PATH, max_share: float = 0.3) -> Set[str]:
+    """Brand, series and model tokens from the catalog titles
+
+    Words spelled with Vietnamese diacritics, everyday Vietnamese and English
+    words, tokens that appear in more than max_share of titles and tokens of
+    shop phrases are dropped, so only names like "galaxy", "redmi" or "a05s"
+    count as product evidence.
+    """
+    titles = []
+    try:
+        with open(csv_path, encoding="utf-8-sig", newline="") as f:
+            titles = [row.get("title", "") or "" for row in csv.DictReader(f)]
+    except OSError as e:
+        print(f"[System] Could not load catalog titles for the query classifier: {e}")
+        return set()
+
+    frequency: Counter = Counter()
+    for title in titles:
+        frequency.update(_name_tokens(title))
+
+    common = VIETNAMESE_WORDS | ENGLISH_WORDS | CATALOG_STOPWORDS
+    shop_tokens = {token for phrase in SHOP_PHRASES for token in phrase.split()}
+    limit = max(1, int(len(titles) * max_share))
+    return {
+        token for token, count in frequency.items()
+        if count <= limit and token not in shop_tokens and token not in common and (len(token) > 2 or (len(token) == 2 and any(c.isdigit() for c in token)))
+    }
+
+
+class QueryClassifier:
+    """Microsecond keyword classifier for query language and agent route
+
+    Each decision returns (label, confidence); callers escalate to the LLM
+    when the confidence is below their threshold.
+    """
+
+    def __init__(self, catalog_terms: Optional[Set[str]] = None):
+        self._catalog_terms = catalog_terms
+        self._lock = threading.Lock()
+
+    @property
+    def catalog_terms(self) -> Set[str]:
+        if self._catalog_terms is None:
+            with self._lock:
+                if self._catalog_terms is None:
+                    self._catalog_terms = load_catalog_terms()
+        return self._catalog_terms
+
+    def detect_language(self, query: str) -> Tuple[Optional[str], float]:
+        if _VIETNAMESE_CHARS.search(query):
+            return "vi", 0.99
+
+        tokens = tokenize(query)
+        if not tokens:
+            return None, 0.0
+
+        vietnamese = sum(1 for token in tokens if token in VIETNAMESE_WORDS)
+        english = sum(1 for token in tokens if token in ENGLISH_WORDS)
+
+        if english >= 2 and vietnamese == 0:
+            return "en", 0.9
+        if vietnamese >= 2 and english == 0:
+            return "vi", 0.9
+        if english > vietnamese:
+            return "en", 0.6
+        if vietnamese > english:
+            return "vi", 0.6
+        return None, 0.0
+
+    def route(self, query: str) -> Tuple[Optional[str], float]:
+        folded = " ".join(tokenize(query))
+        shop_score = _count_phrases(folded, SHOP_PHRASES)
+        product_score = _count_phrases(folded, PRODUCT_PHRASES)
+        product_score += sum(1 for token in set(folded.split()) if token in self.catalog_terms)
+
+        if shop_score == 0 and product_score == 0:
+            return None, 0.0
+
+        label = "shop_information" if shop_score > product_score else "product"
+        if shop_score == 0 or product_score == 0:
+            return label, min(0.99, 0.8 + 0.05 * max(shop_score, product_score))
+
+        margin = abs(shop_score - product_score) / (shop_score + product_score)
+        return label, 0.5 + 0.4 * margin
+
+
+_classifier: Optional[QueryClassifier] = None
+_classifier_lock = threading.Lock()
+
+
+def get_query_classifier() -> QueryClassifier:
+    global _classifier
+    if _classifier is None:
+        with _classifier_lock:
+            if _classifier is None:
+                _classifier = QueryClassifier()
+    return _classifier
+
+
+def fast_detect_language(query: str, threshold: float = RULE_CLASSIFIER_THRESHOLD) -> Optional[str]:
+    """Language code if the rule classifier is confident enough, else None (escalate)"""
+    if not RULE_CLASSIFIER:
+        return None
+    language, confidence = get_query_classifier().detect_language(query)
+    short_circuited = language is not None and confidence >= threshold
+    stats.record("language", short_circuited)
+    return language if short_circuited else None
+
+
+def fast_route(query: str, threshold: float = RULE_CLASSIFIER_THRESHOLD) -> Optional[str]:
+    """Route if the rule classifier is confident enough, else None (escalate)"""
+    if not RULE_CLASSIFIER:
+        return None
+    route, confidence = get_query_classifier().route(query)
+    short_circuited = route is not None and confidence >= threshold
+    stats.record("route", short_circuited)
+    return route if short_circuited else None
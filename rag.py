@@ -1,64 +1,206 @@
-import google.generativeai as genai
 from dotenv import load_dotenv
-import requests
+import asyncio
 import os
 import numpy as np
-import chromadb
 import json
+from typing import Any, Dict, List, Optional, Set, Tuple
 
-chroma_client = chromadb.PersistentClient("db")
-collection_name = 'products'
+from embeddings import aembed_texts, embed_texts, fallback_embedding
+from local_embedding import LOCAL_EMBEDDING_DIM
+from retriever import get_lexical_retriever, get_retriever, get_spec_retriever, reciprocal_rank_fusion
+from shop_directory import get_shop_directory
+from search_client import CircuitOpenError, SearchError, get_search_client
+from spec_index import has_numeric_filters, parse_query_filters, parse_specs
+from tracing import span
 
 load_dotenv()
 
-# Configure Gemini API
-genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-model = genai.GenerativeModel('gemini-2.0-flash')
+# Fuse BM25 keyword matches with vector search results
+HYBRID_SEARCH = os.getenv("HYBRID_SEARCH", "true").lower() == "true"
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "20"))
+
+def index_dimension() -> int:
+    """Embedding dimension of the product index, falling back to the configured default"""
+    try:
+        return get_retriever().dimension() or LOCAL_EMBEDDING_DIM
+    except Exception as e:
+        print(f"[System] Could not read index dimension: {e}")
+        return LOCAL_EMBEDDING_DIM
 
 def get_embedding(text: str) -> list[float]:
     """Generate embeddings using Gemini API"""
     try:
-        # Use Gemini's embedding model
-        result = genai.embed_content(
-            model="models/text-embedding-004",
-            content=text
-        )
-        return result['embedding']
+        # Use Gemini's embedding model, reusing cached vectors
+        return embed_texts([text])[0]
     except Exception as e:
         print(f"Error generating embedding: {e}")
-        # Fallback to a simple hash-based embedding (not recommended for production)
-        import hashlib
-        hash_object = hashlib.md5(text.encode())
-        # Convert to a simple numeric representation
-        return [float(ord(c)) for c in hash_object.hexdigest()[:100]]
-
-def rag(query: str) -> str:
-    """Retrieve relevant product information using RAG"""
+        # Fall back to the offline n-gram embedder at the index's dimension
+        return fallback_embedding(text, index_dimension())
+
+async def aget_embedding(text: str) -> list[float]:
+    """Async variant of get_embedding"""
     try:
-        collection = chroma_client.get_collection(name=collection_name)
-        query_embedding = get_embedding(query)
+        return (await aembed_texts([text]))[0]
+    except Exception as e:
+        print(f"Error generating embedding: {e}")
+        return fallback_embedding(text, await asyncio.to_thread(index_dimension))
+
+def compact_product_text(metadata: Dict[str, Any]) -> str:
+    """One product as " | "-separated fields, each stated once
+
+    The indexed information string runs title, promotion, specs, price and
+    colors together (with "nan" for a missing promotion); this splits it back
+    into labelled fields so repeated ones can be collapsed across products.
+    """
+    information = " ".join(str(metadata.get('information') or '').split())
+    title = " ".join(str(metadata.get('title') or '').split())
+    if not information:
+        return 'No text available'
+    if not title or not information.startswith(title):
+        return information
+    
+    rest = information[len(title):]
+    colors = price = ""
+    if " có màu sắc: " in rest:
+        rest, colors = rest.rsplit(" có màu sắc: ", 1)
+    if " có giá: " in rest:
+        rest, price = rest.rsplit(" có giá: ", 1)
+    
+    # Specs start at the first spec label; anything before it is the promotion
+    promotion, specs = "", rest
+    first_label = next(iter(parse_specs(metadata.get('product_specs'))), None)
+    if first_label and first_label in rest:
+        position = rest.index(first_label)
+        promotion, specs = rest[:position], rest[position:]
+    
+    fields = [title]
+    if price.strip():
+        fields.append(f"Giá: {price.strip()}")
+    if specs.strip():
+        fields.append(f"Thông số: {specs.strip()}")
+    if promotion.strip() and promotion.strip().lower() != "nan":
+        fields.append(f"Khuyến mãi: {promotion.strip()}")
+    if colors.strip():
+        fields.append(f"Màu sắc: {colors.strip()}")
+    return " | ".join(fields)
+
+def format_product_results(search_results: Dict[str, Any]) -> str:
+    """Render retrieved product metadata as numbered context text, best match first"""
+    metadatas = search_results.get('metadatas', [])
+    search_result = ""
+    
+    for metadata_list in metadatas:
+        if isinstance(metadata_list, list):
+            for j, metadata in enumerate(metadata_list):
+                if isinstance(metadata, dict):
+                    search_result += f"{j + 1}). {compact_product_text(metadata)}\n\n"
+    
+    return search_result if search_result else "No relevant product information found."
+
+def _resolve_filters(query: str, filters: Optional[Dict[str, Any]], n_results: int) -> Tuple[Optional[Set[str]], Optional[str]]:
+    """Resolve structured filters to (allowed_ids, early_answer)
+
+    early_answer is set when the spec index alone answers the query: a price
+    or spec constraint with no matches, or with few enough matches to skip
+    vector search. A brand alone only narrows the vector search, which still
+    ranks the brand's models against the query.
+    """
+    if filters is None:
+        filters = parse_query_filters(query)
+    
+    # Resolve structured filters with the spec index first
+    allowed_ids = None
+    if filters:
+        try:
+            with span("spec_filter", "retrieval"):
+                allowed_ids = get_spec_retriever().matching_ids(filters)
+            print(f"[System] Filters {filters} matched {len(allowed_ids)} products")
+        except Exception as e:
+            print(f"[System] Spec index unavailable, ignoring filters: {e}")
+        
+        if not has_numeric_filters(filters):
+            # An unknown brand should not hide the rest of the catalog
+            return (allowed_ids or None), None
+        
+        if allowed_ids is not None and len(allowed_ids) == 0:
+            return allowed_ids, "No relevant product information found matching the requested price or specifications."
         
-        # Normalize the embedding
-        query_embedding = np.array(query_embedding)
-        query_embedding = query_embedding / np.linalg.norm(query_embedding)
+        # Few enough matches to answer without a vector search
+        if allowed_ids is not None and len(allowed_ids) <= n_results:
+            with span("spec_query", "retrieval", n_results=n_results):
+                return allowed_ids, format_product_results(get_spec_retriever().query(filters, n_results=n_results))
+    
+    return allowed_ids, None
 
-        # Perform vector search
-        search_results = collection.query(
+def _search_products(query: str, query_embedding: List[float], allowed_ids: Optional[Set[str]], n_results: int) -> str:
+    """Vector (plus lexical) search for an already embedded query"""
+    # A vector of the wrong size would make the query fail outright
+    expected_dimension = index_dimension()
+    if len(query_embedding) != expected_dimension:
+        print(f"[System] Query embedding has {len(query_embedding)} dimensions, index expects {expected_dimension}; using offline embedding")
+        query_embedding = fallback_embedding(query, expected_dimension)
+    
+    # Normalize the embedding
+    query_embedding = np.array(query_embedding)
+    query_embedding = query_embedding / np.linalg.norm(query_embedding)
+
+    # Perform vector search
+    retriever = get_retriever()
+    with span("collection.query", "retrieval", backend=retriever.name, n_results=n_results):
+        search_results = retriever.query(
             query_embeddings=query_embedding.tolist(), 
-            n_results=5  # Increased for better context
+            n_results=max(HYBRID_CANDIDATES, n_results) if HYBRID_SEARCH else n_results,
+            allowed_ids=allowed_ids
         )
+    
+    # Fuse with exact-token matches (model names, SKUs, sizes)
+    if HYBRID_SEARCH:
+        try:
+            with span("lexical_query", "retrieval", n_results=n_results):
+                lexical_results = get_lexical_retriever().query(
+                    query,
+                    n_results=max(HYBRID_CANDIDATES, n_results),
+                    allowed_ids=allowed_ids
+                )
+        except Exception as e:
+            print(f"[System] Lexical search unavailable, using vector results only: {e}")
+            lexical_results = None
+        search_results = reciprocal_rank_fusion([search_results, lexical_results], n_results=n_results)
+
+    return format_product_results(search_results)
 
-        metadatas = search_results.get('metadatas', [])
-        search_result = ""
+def rag(query: str, filters: Optional[Dict[str, Any]] = None, n_results: int = 5) -> str:
+    """Retrieve relevant product information using RAG
+
+    Structured filters (price range, minimum RAM/storage, brand, ...) are
+    parsed from the query unless passed explicitly; pass {} to disable them.
+    Matching products are resolved from the spec index before vector search.
+    n_results is the number of products returned.
+    """
+    try:
+        allowed_ids, early_answer = _resolve_filters(query, filters, n_results)
+        if early_answer is not None:
+            return early_answer
+        
+        return _search_products(query, get_embedding(query), allowed_ids, n_results)
         
-        for i, metadata_list in enumerate(metadatas):
-            if isinstance(metadata_list, list):
-                for j, metadata in enumerate(metadata_list):
-                    if isinstance(metadata, dict):
-                        combined_text = metadata.get('information', 'No text available').strip()
-                        search_result += f"{i + 1}). {combined_text}\n\n"
+    except Exception as e:
+        print(f"Error in RAG: {e}")
+        return "Unable to retrieve product information at the moment."
+
+async def arag(query: str, filters: Optional[Dict[str, Any]] = None, n_results: int = 5) -> str:
+    """Async variant of rag
+
+    The query embedding is awaited; the local index lookups run in a worker
+    thread so the event loop stays free.
+    """
+    try:
+        allowed_ids, early_answer = await asyncio.to_thread(_resolve_filters, query, filters, n_results)
+        if early_answer is not None:
+            return early_answer
         
-        return search_result if search_result else "No relevant product information found."
+        query_embedding = await aget_embedding(query)
+        return await asyncio.to_thread(_search_products, query, query_embedding, allowed_ids, n_results)
         
     except Exception as e:
         print(f"Error in RAG: {e}")
@@ -66,79 +208,65 @@ def rag(query: str) -> str:
 
 def shop_information_rag():
     """Return shop information"""
-    return [
-        {
-            "address": "89 Đ. Tam Trinh, Mai Động, Hoàng Mai, Hà Nội 100000, Vietnam",
-            "maps_url": "https://maps.app.goo.gl/SitTbiYwUpu8jpeRA",
-            "opening_hours": "8:30 AM–9:30 PM",
-            "phone": "+84 24 1234 5678",
-            "services": ["Product consultation", "Warranty support", "Technical support"]
-        },
-        {
-            "address": "27A Nguyễn Công Trứ, Phạm Đình Hổ, Hai Bà Trưng, Hà Nội 100000, Vietnam",
-            "maps_url": "https://maps.app.goo.gl/3L7iSHpbHawsEaTx9",
-            "opening_hours": "8:30 AM–9:30 PM",
-            "phone": "+84 24 1234 5679",
-            "services": ["Product consultation", "Warranty support", "Repair services"]
-        },
-        {
-            "address": "392 Đ. Trương Định, Tương Mai, Hoàng Mai, Hà Nội, Vietnam",
-            "maps_url": "https://maps.app.goo.gl/torAE2bHddW6nMPq9",
-            "opening_hours": "8:30 AM–9:30 PM",
-            "phone": "+84 24 1234 5680",
-            "services": ["Product consultation", "Express delivery", "Installation support"]
-        }
-    ]
+    return get_shop_directory().records
+
+def format_search_results(data: Dict[str, Any]) -> str:
+    """Render a SerpAPI response as numbered results"""
+    search_results = ""
+    organic_results = data.get('organic_results', [])
+    
+    for i, result in enumerate(organic_results[:3]):  # Top 3 results
+        title = result.get('title', 'No title')
+        snippet = result.get('snippet', 'No description')
+        link = result.get('link', '')
+        
+        search_results += f"{i + 1}. {title}\n"
+        search_results += f"   {snippet}\n"
+        search_results += f"   Source: {link}\n\n"
+    
+    # Also include answer box if available
+    answer_box = data.get('answer_box', {})
+    if answer_box:
+        answer = answer_box.get('answer', '')
+        if answer:
+            search_results = f"Quick Answer: {answer}\n\n" + search_results
+    
+    return search_results if search_results else "No relevant information found on the internet."
 
 def search_internet(query: str) -> str:
     """Search the internet using SerpAPI"""
     try:
-        serpapi_key = os.getenv("SERPAPI_API_KEY")
+        client = get_search_client()
         
-        if not serpapi_key:
+        if not client.api_key:
             return "Internet search is not available. Please configure SERPAPI_API_KEY."
         
-        # SerpAPI endpoint
-        url = "https://serpapi.com/search"
+        return format_search_results(client.search(query))
         
-        params = {
-            "q": query,
-            "api_key": serpapi_key,
-            "engine": "google",
-            "num": 5,  # Number of results
-            "hl": "vi",  # Language
-            "gl": "vn"   # Country
-        }
+    except CircuitOpenError:
+        print("[System] Internet search skipped: circuit open after repeated failures")
+        return "Internet search is temporarily unavailable."
+    except SearchError as e:
+        return f"Internet search failed with status code: {e.status_code}"
+    except Exception as e:
+        print(f"Error in internet search: {e}")
+        return "Unable to perform internet search at the moment."
+
+async def asearch_internet(query: str) -> str:
+    """Async variant of search_internet"""
+    try:
+        client = get_search_client()
         
-        response = requests.get(url, params=params)
+        if not client.api_key:
+            return "Internet search is not available. Please configure SERPAPI_API_KEY."
         
-        if response.status_code == 200:
-            data = response.json()
-            
-            search_results = ""
-            organic_results = data.get('organic_results', [])
-            
-            for i, result in enumerate(organic_results[:3]):  # Top 3 results
-                title = result.get('title', 'No title')
-                snippet = result.get('snippet', 'No description')
-                link = result.get('link', '')
-                
-                search_results += f"{i + 1}. {title}\n"
-                search_results += f"   {snippet}\n"
-                search_results += f"   Source: {link}\n\n"
-            
-            # Also include answer box if available
-            answer_box = data.get('answer_box', {})
-            if answer_box:
-                answer = answer_box.get('answer', '')
-                if answer:
-                    search_results = f"Quick Answer: {answer}\n\n" + search_results
-            
-            return search_results if search_results else "No relevant information found on the internet."
-            
-        else:
-            return f"Internet search failed with status code: {response.status_code}"
-            
+        return format_search_results(await client.asearch(query))
+        
+    except CircuitOpenError:
+        print("[System] Internet search skipped: circuit open after repeated failures")
+        return "Internet search is temporarily unavailable."
+    except SearchError as e:
+        return f"Internet search failed with status code: {e.status_code}"
     except Exception as e:
         print(f"Error in internet search: {e}")
         return "Unable to perform internet search at the moment."
@@ -160,9 +288,10 @@ def rag_with_fallback(query: str, search_type: str = "product") -> str:
                 
         elif search_type == "shop":
             # For shop information, combine local data with internet search
-            local_info = shop_information_rag()
+            directory = get_shop_directory()
+            local_info = directory.find_by_area(query) or directory.shops
             local_info_text = "\n".join([
-                f"Store {i+1}: {shop['address']}, Hours: {shop['opening_hours']}, Phone: {shop['phone']}"
+                f"Store {i+1}: {shop.summary}"
                 for i, shop in enumerate(local_info)
             ])
             
@@ -0,0 +1,261 @@
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, FrozenSet, List, NamedTuple, Optional
+
+import numpy as np
+from dotenv import load_dotenv
+
+from embedding_cache import normalize_text
+from numpy_index import normalize_rows
+from retriever import read_index_version
+from spec_index import BRAND_ALIASES
+
+load_dotenv()
+
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "true").lower() == "true"
+RESPONSE_CACHE_THRESHOLD = float(os.getenv("RESPONSE_CACHE_THRESHOLD", "0.95"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1000"))
+
+
+def query_key(query: str) -> str:
+    """Lowercased words of the query, ignoring punctuation and spacing
+
+    Used both as the exact-match key and as the text that gets embedded, so
+    "Cửa hàng ở đâu?" and "cửa hàng ở đâu" share an entry.
+    """
+    return " ".join(re.findall(r"\w+", normalize_text(query).lower()))
+
+
+# Words that tell apart models sharing a number ("iPhone 15" vs "iPhone 15 Pro")
+MODEL_VARIANT_WORDS = {"pro", "max", "ultra", "plus", "mini", "lite", "fe", "se", "prime", "neo", "note", "fold", "flip"}
+
+
+def identity_tokens(query: str) -> FrozenSet[str]:
+    """Tokens that must agree for two queries to share an answer
+
+    Numbers and model codes ("14", "a05s", "256gb", "5 triệu"), model variants
+    and brands. Embeddings of "iPhone 14 giá" and "iPhone 15 giá" are nearly
+    identical, but their answers are not.
+    """
+    tokens = set()
+    for token in query_key(query).split():
+        if any(c.isdigit() for c in token) or token in MODEL_VARIANT_WORDS:
+            tokens.add(token)
+        elif token in BRAND_ALIASES:
+            tokens.add(BRAND_ALIASES[token])
+    return frozenset(tokens)
+
+
+class CachedResponse(NamedTuple):
+    query: str
+    response: str
+    language: Optional[str]
+    routing_decision: Optional[str]
+    created_at: float
+
+
+class ResponseCache:
+    """Semantic cache of final answers keyed by query embedding
+
+    A lookup returns the stored answer of the most similar earlier query when
+    the cosine similarity reaches the threshold, both queries name the same
+    numbers, models and brands (see identity_tokens), and the entry has not
+    expired. Exact repeats (see query_key) are answered without comparing
+    vectors. Entries are evicted least recently used first, and the whole
+    cache is dropped when the product index version changes, since answers
+    quote prices and stock from the index.
+    """
+
+    def __init__(
+        self,
+        threshold: float = RESPONSE_CACHE_THRESHOLD,
+        ttl: float = RESPONSE_CACHE_TTL,
+        max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+        version_fn: Optional[Callable[[], str]] = None,
+    ):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._version_fn = version_fn
+        self._version: Optional[str] = None
+        self._lock = threading.Lock()
+
+        # key -> slot in the vector matrix, in LRU order
+        self._slots: "OrderedDict[str, int]" = OrderedDict()
+        self._entries: Dict[int, CachedResponse] = {}
+        self._keys: Dict[int, str] = {}
+        self._vectors: Optional[np.ndarray] = None
+        self._valid: Optional[np.ndarray] = None
+        self._free: List[int] = []
+
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.invalidations = 0
+
+    def _check_version(self) -> None:
+        if self._version_fn is None:
+            return
+        version = self._version_fn()
+        if self._version is None:
+            self._version = version
+        elif version != self._version:
+            self._version = version
+            self._clear()
+            self.invalidations += 1
+
+    def _clear(self) -> None:
+        self._slots.clear()
+        self._entries.clear()
+        self._keys.clear()
+        self._vectors = None
+        self._valid = None
+        self._free = []
+
+    def _drop(self, key: str) -> None:
+        slot = self._slots.pop(key)
+        del self._entries[slot]
+        del self._keys[slot]
+        self._valid[slot] = False
+        self._free.append(slot)
+
+    def _alive(self, entry: CachedResponse, now: float) -> bool:
+        return self.ttl <= 0 or now - entry.created_at < self.ttl
+
+    def lookup_exact(self, query: str) -> Optional[CachedResponse]:
+        """Answer for a query seen before word for word, without embedding it
+
+        A miss here is not counted; follow up with lookup() on the embedding.
+        """
+        key = query_key(query)
+        with self._lock:
+            self._check_version()
+            slot = self._slots.get(key)
+            if slot is None:
+                return None
+            entry = self._entries[slot]
+            if not self._alive(entry, time.time()):
+                self._drop(key)
+                self.expired += 1
+                return None
+            self._slots.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def lookup(self, embedding: List[float], query: Optional[str] = None) -> Optional[CachedResponse]:
+        """Answer of the most similar cached query at or above the threshold
+
+        With the query text, entries whose identity tokens differ are skipped.
+        """
+        identity = identity_tokens(query) if query is not None else None
+        vector = normalize_rows(np.asarray(embedding, dtype=np.float32))
+        now = time.time()
+        with self._lock:
+            self._check_version()
+            if self._vectors is None or not self._slots or self._vectors.shape[1] != vector.shape[0]:
+                self.misses += 1
+                return None
+
+            scores = self._vectors @ vector
+            scores[~self._valid] = -np.inf
+
+            # Expired entries are dropped as they are found, then the next best is tried
+            while True:
+                slot = int(np.argmax(scores))
+                if scores[slot] < self.threshold:
+                    self.misses += 1
+                    return None
+                entry = self._entries[slot]
+                if identity is not None and identity_tokens(entry.query) != identity:
+                    # Similar wording about a different model or price
+                    scores[slot] = -np.inf
+                    continue
+                if self._alive(entry, now):
+                    self._slots.move_to_end(self._keys[slot])
+                    self.hits += 1
+                    return entry
+                self._drop(self._keys[slot])
+                self.expired += 1
+                scores[slot] = -np.inf
+
+    def put(
+        self,
+        query: str,
+        embedding: List[float],
+        response: str,
+        language: Optional[str] = None,
+        routing_decision: Optional[str] = None,
+    ) -> None:
+        key = query_key(query)
+        vector = normalize_rows(np.asarray(embedding, dtype=np.float32))
+        entry = CachedResponse(query, response, language, routing_decision, time.time())
+
+        with self._lock:
+            self._check_version()
+            if self._vectors is not None and self._vectors.shape[1] != vector.shape[0]:
+                # The embedding backend changed; old vectors are not comparable
+                self._clear()
+
+            if key in self._slots:
+                self._drop(key)
+            while len(self._slots) >= self.max_entries:
+                self._drop(next(iter(self._slots)))
+
+            if self._free:
+                slot = self._free.pop()
+            else:
+                slot = 0 if self._vectors is None else self._vectors.shape[0]
+                self._grow(slot + 1, vector.shape[0])
+
+            self._vectors[slot] = vector
+            self._valid[slot] = True
+            self._entries[slot] = entry
+            self._keys[slot] = key
+            self._slots[key] = slot
+
+    def _grow(self, size: int, dimension: int) -> None:
+        capacity = max(size, min(self.max_entries, max(16, 2 * (0 if self._vectors is None else self._vectors.shape[0]))))
+        vectors = np.zeros((capacity, dimension), dtype=np.float32)
+        valid = np.zeros(capacity, dtype=bool)
+        if self._vectors is not None:
+            vectors[:self._vectors.shape[0]] = self._vectors
+            valid[:self._valid.shape[0]] = self._valid
+        self._free.extend(range(size, capacity))
+        self._vectors = vectors
+        self._valid = valid
+
+    def clear(self) -> None:
+        with self._lock:
+            self._clear()
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._slots),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "expired": self.expired,
+            "invalidations": self.invalidations,
+        }
+
+
+_cache: Optional[ResponseCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> ResponseCache:
+    """Process-wide response cache, invalidated by product index rebuilds"""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ResponseCache(version_fn=read_index_version)
+    return _cache
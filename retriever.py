@@ -0,0 +1,317 @@
+import os
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Set
+
+import chromadb
+from chromadb.api.client import SharedSystemClient
+from dotenv import load_dotenv
+
+from tracing import annotate
+
+load_dotenv()
+
+CHROMA_DB_PATH = os.getenv("CHROMA_DB_PATH", "./db")
+PRODUCT_COLLECTION = "products"
+NUMPY_INDEX_PATH = os.getenv("NUMPY_INDEX_PATH", os.path.join(CHROMA_DB_PATH, "numpy_index"))
+LEXICAL_INDEX_PATH = os.getenv("LEXICAL_INDEX_PATH", os.path.join(CHROMA_DB_PATH, "lexical_index"))
+SPEC_INDEX_PATH = os.getenv("SPEC_INDEX_PATH", os.path.join(CHROMA_DB_PATH, "spec_index"))
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "chroma")
+INDEX_VERSION_FILE = "index_version"
+
+
+def index_version_path(db_path: str = CHROMA_DB_PATH) -> str:
+    return os.path.join(db_path, INDEX_VERSION_FILE)
+
+
+def read_index_version(db_path: str = CHROMA_DB_PATH) -> str:
+    """Return the current index version stamp, or an empty string if none was written"""
+    try:
+        with open(index_version_path(db_path), encoding="utf-8") as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+
+def bump_index_version(db_path: str = CHROMA_DB_PATH) -> str:
+    """Record that the index was rebuilt so running retrievers reopen it"""
+    os.makedirs(db_path, exist_ok=True)
+    version = f"{time.time_ns()}-{uuid.uuid4().hex[:8]}"
+    tmp_path = index_version_path(db_path) + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(version)
+    os.replace(tmp_path, index_version_path(db_path))
+    return version
+
+
+class RetrievalBackend:
+    """Base class for product retrieval backends
+
+    Subclasses open their index lazily in _open() and answer query() with a
+    Chroma-shaped result dict ({"ids", "metadatas", "distances"}, one list per
+    query embedding). The index is reopened whenever the index version stamp
+    changes. Instances are safe to share between threads and Streamlit sessions.
+    """
+
+    name = "base"
+
+    def __init__(self, db_path: str = CHROMA_DB_PATH):
+        self.db_path = db_path
+        self._handle = None
+        self._version: Optional[str] = None
+        self._version_mtime: Optional[int] = None
+        self._dimension: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def _stamp_mtime(self) -> Optional[int]:
+        try:
+            return os.stat(index_version_path(self.db_path)).st_mtime_ns
+        except OSError:
+            return None
+
+    def _open(self):
+        raise NotImplementedError
+
+    def handle(self):
+        """Return the cached index handle, reopening it if the index was rebuilt"""
+        handle = self._handle
+        if handle is not None and self._stamp_mtime() == self._version_mtime:
+            return handle
+
+        with self._lock:
+            if self._handle is None or self._stamp_mtime() != self._version_mtime:
+                if self._handle is not None:
+                    print(f"[System] Product index changed, reopening {self.name} index")
+                self._version_mtime = self._stamp_mtime()
+                self._version = read_index_version(self.db_path)
+                self._dimension = None
+                self._handle = self._open()
+            return self._handle
+
+    def reset(self) -> None:
+        """Drop the cached handle so the next call reopens it"""
+        with self._lock:
+            self._handle = None
+            self._dimension = None
+
+    def _read_dimension(self, handle) -> Optional[int]:
+        return None
+
+    def dimension(self) -> Optional[int]:
+        """Embedding dimension of the index, or None if it cannot be determined"""
+        handle = self.handle()
+        if self._dimension is None:
+            self._dimension = self._read_dimension(handle)
+        return self._dimension
+
+    @property
+    def version(self) -> Optional[str]:
+        return self._version
+
+    def query(self, query_embeddings, n_results: int = 5, allowed_ids: Optional[Set[str]] = None) -> Dict[str, Any]:
+        raise NotImplementedError
+
+
+class ChromaRetriever(RetrievalBackend):
+    """Lazily opened, cached handle to the product collection in ChromaDB"""
+
+    name = "chroma"
+
+    def __init__(self, db_path: str = CHROMA_DB_PATH, collection_name: str = PRODUCT_COLLECTION):
+        super().__init__(db_path)
+        self.collection_name = collection_name
+        self._client = None
+
+    def _open(self):
+        if self._client is not None:
+            # Chroma shares one System per path, and a new client would reuse it
+            # with the segments loaded before the rebuild; drop it first
+            SharedSystemClient.clear_system_cache()
+        print(f"[System] Opening ChromaDB at {self.db_path}")
+        self._client = chromadb.PersistentClient(self.db_path)
+        return self._client.get_collection(name=self.collection_name)
+
+    def collection(self):
+        return self.handle()
+
+    def _read_dimension(self, handle) -> Optional[int]:
+        sample = handle.get(limit=1, include=["embeddings"])
+        embeddings = sample.get("embeddings")
+        if embeddings is None or len(embeddings) == 0:
+            return None
+        return len(embeddings[0])
+
+    def query(
+        self,
+        query_embeddings,
+        n_results: int = 5,
+        allowed_ids: Optional[Set[str]] = None,
+        **kwargs
+    ) -> Dict[str, Any]:
+        """Run a vector query, reopening the collection once if the handle went stale"""
+        if allowed_ids is not None:
+            kwargs["where"] = {"doc_id": {"$in": sorted(allowed_ids)}}
+        try:
+            return self.handle().query(query_embeddings=query_embeddings, n_results=n_results, **kwargs)
+        except Exception as e:
+            print(f"[System] Collection query failed ({e}), reopening collection")
+            annotate(retries=1)
+            self.reset()
+            return self.handle().query(query_embeddings=query_embeddings, n_results=n_results, **kwargs)
+
+
+class NumpyRetriever(RetrievalBackend):
+    """In-process brute-force search over the exported NumPy index"""
+
+    name = "numpy"
+
+    def __init__(self, db_path: str = CHROMA_DB_PATH, index_path: str = NUMPY_INDEX_PATH):
+        super().__init__(db_path)
+        self.index_path = index_path
+
+    def _open(self):
+        from numpy_index import NumpyVectorIndex
+
+        print(f"[System] Loading NumPy index from {self.index_path}")
+        return NumpyVectorIndex(self.index_path)
+
+    def _read_dimension(self, handle) -> Optional[int]:
+        return handle.dimension
+
+    def query(self, query_embeddings, n_results: int = 5, allowed_ids: Optional[Set[str]] = None) -> Dict[str, Any]:
+        index = self.handle()
+        top, scores = index.search(query_embeddings, n_results, allowed_ids=allowed_ids)
+        return {
+            "ids": [[index.ids[i] for i in row] for row in top],
+            "metadatas": [[index.metadatas[i] for i in row] for row in top],
+            # Cosine distance, so lower is better as with Chroma
+            "distances": [[float(1.0 - score) for score in row] for row in scores],
+        }
+
+
+class LexicalRetriever(RetrievalBackend):
+    """BM25 keyword search over the lexical index exported at build time"""
+
+    name = "lexical"
+
+    def __init__(self, db_path: str = CHROMA_DB_PATH, index_path: str = LEXICAL_INDEX_PATH):
+        super().__init__(db_path)
+        self.index_path = index_path
+
+    def _open(self):
+        from lexical_index import LexicalIndex
+
+        print(f"[System] Loading lexical index from {self.index_path}")
+        return LexicalIndex.load(self.index_path)
+
+    def query(self, query_text: str, n_results: int = 5, allowed_ids: Optional[Set[str]] = None) -> Dict[str, Any]:
+        """Keyword query; distances are negated BM25 scores so lower is better"""
+        index = self.handle()
+        hits = index.search(query_text, n_results, allowed_ids=allowed_ids)
+        return {
+            "ids": [[index.ids[doc] for doc, _ in hits]],
+            "metadatas": [[index.metadatas[doc] for doc, _ in hits]],
+            "distances": [[-score for _, score in hits]],
+        }
+
+
+class SpecRetriever(RetrievalBackend):
+    """Typed price/spec attribute index used to pre-filter products"""
+
+    name = "spec"
+
+    def __init__(self, db_path: str = CHROMA_DB_PATH, index_path: str = SPEC_INDEX_PATH):
+        super().__init__(db_path)
+        self.index_path = index_path
+
+    def _open(self):
+        from spec_index import SpecIndex
+
+        print(f"[System] Loading spec index from {self.index_path}")
+        return SpecIndex.load(self.index_path)
+
+    def query(self, filters: Dict[str, Any], n_results: int = 5, allowed_ids: Optional[Set[str]] = None) -> Dict[str, Any]:
+        """Products matching the filters, cheapest first"""
+        index = self.handle()
+        positions = [
+            position for position in index.filter(filters)
+            if allowed_ids is None or index.ids[position] in allowed_ids
+        ][:n_results]
+        return {
+            "ids": [[index.ids[position] for position in positions]],
+            "metadatas": [[index.metadatas[position] for position in positions]],
+            "distances": [[0.0 for _ in positions]],
+        }
+
+    def matching_ids(self, filters: Dict[str, Any]) -> Set[str]:
+        index = self.handle()
+        return {index.ids[position] for position in index.filter(filters)}
+
+
+def reciprocal_rank_fusion(result_sets: List[Dict[str, Any]], n_results: int = 5, k: int = 60) -> Dict[str, Any]:
+    """Fuse ranked single-query results with reciprocal rank fusion
+
+    Each document scores sum(1 / (k + rank)) over the result sets it appears
+    in. Returns a Chroma-shaped result dict with the fused order, where
+    distances are negated fusion scores.
+    """
+    scores: Dict[str, float] = {}
+    metadatas: Dict[str, Any] = {}
+
+    for results in result_sets:
+        if not results or not results.get("ids"):
+            continue
+        for rank, (doc_id, metadata) in enumerate(zip(results["ids"][0], results["metadatas"][0]), start=1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank)
+            metadatas.setdefault(doc_id, metadata)
+
+    fused = sorted(scores, key=scores.get, reverse=True)[:n_results]
+    return {
+        "ids": [fused],
+        "metadatas": [[metadatas[doc_id] for doc_id in fused]],
+        "distances": [[-scores[doc_id] for doc_id in fused]],
+    }
+
+
+RETRIEVAL_BACKENDS = {
+    "chroma": ChromaRetriever,
+    "numpy": NumpyRetriever,
+}
+
+
+_shared: Dict[str, RetrievalBackend] = {}
+_shared_lock = threading.Lock()
+
+
+def _get_shared(key: str, factory) -> RetrievalBackend:
+    backend = _shared.get(key)
+    if backend is None:
+        with _shared_lock:
+            backend = _shared.get(key)
+            if backend is None:
+                backend = _shared[key] = factory()
+    return backend
+
+
+def create_retriever(backend: str = VECTOR_BACKEND) -> RetrievalBackend:
+    """Create a retrieval backend by name ("chroma" or "numpy")"""
+    try:
+        return RETRIEVAL_BACKENDS[backend.lower()]()
+    except KeyError:
+        raise ValueError(f"Unknown vector backend: {backend}. Choose from {', '.join(RETRIEVAL_BACKENDS)}")
+
+
+def get_retriever() -> RetrievalBackend:
+    """Process-wide vector retriever shared by all sessions, selected by VECTOR_BACKEND"""
+    return _get_shared("vector", create_retriever)
+
+
+def get_lexical_retriever() -> LexicalRetriever:
+    """Process-wide lexical retriever used for hybrid search"""
+    return _get_shared("lexical", LexicalRetriever)
+
+
+def get_spec_retriever() -> SpecRetriever:
+    """Process-wide spec index used for structured filters"""
+    return _get_shared("spec", SpecRetriever)
@@ -0,0 +1,262 @@
+import asyncio
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+import httpx
+import requests
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+
+from embedding_cache import normalize_text
+from tracing import span
+
+load_dotenv()
+
+# Point SERPAPI_URL at a local stand-in to exercise the client offline
+SERPAPI_URL = os.getenv("SERPAPI_URL", "https://serpapi.com/search")
+SEARCH_CONNECT_TIMEOUT = float(os.getenv("SEARCH_CONNECT_TIMEOUT", "2"))
+SEARCH_READ_TIMEOUT = float(os.getenv("SEARCH_READ_TIMEOUT", "3.5"))
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "900"))
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "512"))
+SEARCH_FAILURE_THRESHOLD = int(os.getenv("SEARCH_FAILURE_THRESHOLD", "3"))
+SEARCH_RESET_TIMEOUT = float(os.getenv("SEARCH_RESET_TIMEOUT", "30"))
+SEARCH_POOL_SIZE = int(os.getenv("SEARCH_POOL_SIZE", "16"))
+
+
+class SearchError(Exception):
+    """The search service answered with an error status"""
+
+    def __init__(self, status_code: int):
+        super().__init__(f"Search failed with status code: {status_code}")
+        self.status_code = status_code
+
+
+class CircuitOpenError(Exception):
+    """The search service failed repeatedly and is not being called for now"""
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker
+
+    After failure_threshold failures in a row the circuit opens and calls are
+    refused for reset_timeout seconds. Then one trial call is let through
+    (half-open): success closes the circuit, failure opens it again.
+    """
+
+    def __init__(self, failure_threshold: int = SEARCH_FAILURE_THRESHOLD, reset_timeout: float = SEARCH_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_in_flight = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                return "half_open"
+            return "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def release(self) -> None:
+        """Give up a call without an outcome, letting another trial through"""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+
+class SearchClient:
+    """SerpAPI client with a pooled keep-alive session, strict timeouts, a TTL cache and a circuit breaker
+
+    search() uses a shared requests.Session; asearch() uses one
+    httpx.AsyncClient per event loop. Both share the cache and the breaker.
+    """
+
+    def __init__(
+        self,
+        base_url: str = SERPAPI_URL,
+        api_key: Optional[str] = None,
+        connect_timeout: float = SEARCH_CONNECT_TIMEOUT,
+        read_timeout: float = SEARCH_READ_TIMEOUT,
+        cache_ttl: float = SEARCH_CACHE_TTL,
+        cache_max_entries: int = SEARCH_CACHE_MAX_ENTRIES,
+        breaker: Optional[CircuitBreaker] = None,
+        pool_size: int = SEARCH_POOL_SIZE,
+    ):
+        self.base_url = base_url
+        self._api_key = api_key
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.cache_ttl = cache_ttl
+        self.cache_max_entries = cache_max_entries
+        self.breaker = breaker or CircuitBreaker()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._pool_size = pool_size
+        self._async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = weakref.WeakKeyDictionary()
+
+        self._cache: "OrderedDict[Tuple[str, str, str], Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def api_key(self) -> Optional[str]:
+        return self._api_key or os.getenv("SERPAPI_API_KEY")
+
+    def _params(self, query: str, hl: str, gl: str, num: int) -> Dict[str, Any]:
+        return {
+            "q": query,
+            "api_key": self.api_key,
+            "engine": "google",
+            "num": num,
+            "hl": hl,
+            "gl": gl
+        }
+
+    def _cache_get(self, key: Tuple[str, str, str]) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None and time.monotonic() - cached[0] < self.cache_ttl:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return cached[1]
+            if cached is not None:
+                del self._cache[key]
+            self.misses += 1
+            return None
+
+    def _cache_put(self, key: Tuple[str, str, str], data: Dict[str, Any]) -> None:
+        with self._lock:
+            self._cache[key] = (time.monotonic(), data)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_max_entries:
+                self._cache.popitem(last=False)
+
+    def _before_call(self, query: str, hl: str, gl: str) -> Tuple[Tuple[str, str, str], Optional[Dict[str, Any]]]:
+        key = (normalize_text(query).lower(), hl, gl)
+        cached = self._cache_get(key)
+        if cached is None and not self.breaker.allow():
+            raise CircuitOpenError("Search circuit is open after repeated failures")
+        return key, cached
+
+    def search(self, query: str, hl: str = "vi", gl: str = "vn", num: int = 5) -> Dict[str, Any]:
+        """Return the parsed search response, from the cache when fresh"""
+        with span("serpapi", "search") as trace:
+            key, cached = self._before_call(query, hl, gl)
+            if trace is not None:
+                trace.set(cache_hit=cached is not None, circuit=self.breaker.state)
+            if cached is not None:
+                return cached
+            return self._search(key, query, hl, gl, num)
+
+    def _search(self, key: Tuple[str, str, str], query: str, hl: str, gl: str, num: int) -> Dict[str, Any]:
+        try:
+            response = self.session.get(
+                self.base_url,
+                params=self._params(query, hl, gl, num),
+                timeout=(self.connect_timeout, self.read_timeout)
+            )
+            if response.status_code != 200:
+                raise SearchError(response.status_code)
+            data = response.json()
+        except Exception:
+            self.breaker.record_failure()
+            raise
+
+        self.breaker.record_success()
+        self._cache_put(key, data)
+        return data
+
+    def _async_client(self) -> httpx.AsyncClient:
+        # httpx clients cannot be shared across event loops
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout),
+                limits=httpx.Limits(max_connections=self._pool_size, max_keepalive_connections=self._pool_size)
+            )
+            self._async_clients[loop] = client
+        return client
+
+    async def asearch(self, query: str, hl: str = "vi", gl: str = "vn", num: int = 5) -> Dict[str, Any]:
+        """Async variant of search"""
+        with span("serpapi", "search") as trace:
+            key, cached = self._before_call(query, hl, gl)
+            if trace is not None:
+                trace.set(cache_hit=cached is not None, circuit=self.breaker.state)
+            if cached is not None:
+                return cached
+            return await self._asearch(key, query, hl, gl, num)
+
+    async def _asearch(self, key: Tuple[str, str, str], query: str, hl: str, gl: str, num: int) -> Dict[str, Any]:
+        try:
+            response = await self._async_client().get(self.base_url, params=self._params(query, hl, gl, num))
+            if response.status_code != 200:
+                raise SearchError(response.status_code)
+            data = response.json()
+        except asyncio.CancelledError:
+            # Cancelled by the retrieval deadline, not a service failure
+            self.breaker.release()
+            raise
+        except Exception:
+            self.breaker.record_failure()
+            raise
+
+        self.breaker.record_success()
+        self._cache_put(key, data)
+        return data
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "cache_entries": len(self._cache),
+                "cache_hits": self.hits,
+                "cache_misses": self.misses,
+                "circuit": self.breaker.state,
+            }
+
+
+_client: Optional[SearchClient] = None
+_client_lock = threading.Lock()
+
+
+def get_search_client() -> SearchClient:
+    """Process-wide search client so the connection pool and cache are shared"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = SearchClient()
+    return _client
@@ -0,0 +1,359 @@
+"""HTTP/JSON serving API for the agent graph
+
+    uvicorn server:app --host 0.0.0.0 --port 8000
+
+Each process runs at most SERVER_MAX_CONCURRENCY turns at once. Up to
+SERVER_MAX_QUEUE more wait for a slot, for at most SERVER_QUEUE_TIMEOUT
+seconds; beyond that requests get 503 with Retry-After, so a load balancer
+can send them elsewhere. Processes share nothing but the on-disk index and
+caches, so the service scales by adding processes or hosts.
+"""
+
+import asyncio
+import json
+import os
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+import uvicorn
+from dotenv import load_dotenv
+from fastapi import BackgroundTasks, FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field
+from starlette.background import BackgroundTask
+
+from app import astream_turn, compiled_graph, initial_state
+from conversation_store import get_conversation_store
+from retriever import get_retriever
+from shop_directory import get_shop_directory
+from tracing import PrometheusSink, get_tracer
+
+load_dotenv()
+
+SERVER_HOST = os.getenv("SERVER_HOST", "0.0.0.0")
+SERVER_PORT = int(os.getenv("SERVER_PORT", "8000"))
+SERVER_MAX_CONCURRENCY = int(os.getenv("SERVER_MAX_CONCURRENCY", "8"))
+SERVER_MAX_QUEUE = int(os.getenv("SERVER_MAX_QUEUE", "32"))
+SERVER_QUEUE_TIMEOUT = float(os.getenv("SERVER_QUEUE_TIMEOUT", "10"))
+# Seconds a rejected client is told to wait before retrying
+SERVER_RETRY_AFTER = int(os.getenv("SERVER_RETRY_AFTER", "2"))
+# Minimum seconds between warm-up attempts started by /readyz after a failure
+SERVER_WARMUP_RETRY_INTERVAL = float(os.getenv("SERVER_WARMUP_RETRY_INTERVAL", "5"))
+
+
+class Overloaded(Exception):
+    """No turn slot is available within the queue limits"""
+
+
+class TurnLimiter:
+    """Caps concurrent turns, with a bounded wait queue in front
+
+    Requests beyond max_concurrency wait for a slot; when max_queue are
+    already waiting, or the wait exceeds queue_timeout, Overloaded is raised
+    instead of queueing without bound.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = SERVER_MAX_CONCURRENCY,
+        max_queue: int = SERVER_MAX_QUEUE,
+        queue_timeout: float = SERVER_QUEUE_TIMEOUT,
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.running = 0
+        self.waiting = 0
+        self.counts: Counter = Counter()
+
+    async def acquire(self) -> None:
+        if self.waiting >= self.max_queue and self._semaphore.locked():
+            self.counts["rejected_queue_full"] += 1
+            raise Overloaded("Too many requests waiting")
+
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.counts["rejected_queue_timeout"] += 1
+            raise Overloaded("Timed out waiting for a free slot")
+        finally:
+            self.waiting -= 1
+
+        self.running += 1
+        self.counts["accepted"] += 1
+
+    def release(self) -> None:
+        self.running -= 1
+        self._semaphore.release()
+
+    @property
+    def saturated(self) -> bool:
+        return self.waiting >= self.max_queue
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "running": self.running,
+            "waiting": self.waiting,
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            **self.counts,
+        }
+
+
+class ChatRequest(BaseModel):
+    message: str = Field(..., min_length=1)
+    # With a session id the server keeps the history; otherwise the client sends it
+    session_id: Optional[str] = Field(None, min_length=1, max_length=128)
+    conversation_history: List[Dict[str, Any]] = Field(default_factory=list)
+    max_iterations: int = Field(3, ge=1, le=10)
+    # {"latitude": ..., "longitude": ...} for nearest-store answers
+    user_location: Optional[Dict[str, float]] = None
+
+
+def turn_result(state: Dict[str, Any], turn_time: float) -> Dict[str, Any]:
+    """Response body for a finished turn"""
+    return {
+        "response": state.get("final_response") or "I'm sorry, I couldn't process your request.",
+        "language": state.get("language"),
+        "route": state.get("routing_decision"),
+        "response_cache_hit": bool(state.get("response_cache_hit")),
+        "retry_stages": state.get("retry_stages") or [],
+        "timed_out_sources": state.get("timed_out_sources") or [],
+        "trace_id": state.get("trace_id"),
+        "turn_time": round(turn_time, 4),
+    }
+
+
+async def _turn_input(request: ChatRequest, stream_response: bool = False) -> Dict[str, Any]:
+    """Initial state for a request, with the stored history of its session if it has one"""
+    history = None
+    if request.session_id:
+        history = await asyncio.to_thread(get_conversation_store().history, request.session_id)
+    return initial_state(
+        request.message,
+        request.conversation_history,
+        max_iterations=request.max_iterations,
+        stream_response=stream_response,
+        user_location=request.user_location,
+        history=history,
+    )
+
+
+def _remember_turn(request: ChatRequest, state: Optional[Dict[str, Any]]) -> None:
+    """Append a finished turn to its session; runs after the response is sent"""
+    if not request.session_id or not state or not state.get("final_response"):
+        return
+    try:
+        get_conversation_store().append(request.session_id, request.message, state["final_response"])
+    except Exception as e:
+        print(f"[System] Could not store conversation turn: {e}")
+
+
+def _sse(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+class ClosingStreamingResponse(StreamingResponse):
+    """StreamingResponse that runs on_close however the response ends
+
+    Starlette skips the background task when the client is gone before or
+    while the body is sent, and a body iterator that was never iterated is
+    not closed at all; on_close runs in every case.
+    """
+
+    def __init__(self, content, on_close: Callable[[], Awaitable[None]], **kwargs):
+        super().__init__(content, **kwargs)
+        self.on_close = on_close
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.on_close()
+
+
+def _overloaded_response(error: Overloaded) -> JSONResponse:
+    return JSONResponse(
+        {"detail": str(error)},
+        status_code=503,
+        headers={"Retry-After": str(SERVER_RETRY_AFTER)},
+    )
+
+
+limiter = TurnLimiter()
+readiness: Dict[str, Any] = {"ready": False, "checks": {}, "attempted_at": None}
+_warm_up_task: Optional[asyncio.Task] = None
+
+
+def _warm_up() -> Dict[str, Any]:
+    """Load the index and shop directory so the first turns do not pay for it"""
+    checks = {}
+    retriever = get_retriever()
+    checks["index_dimension"] = retriever.dimension()
+    checks["retrieval_backend"] = retriever.name
+    checks["shops"] = len(get_shop_directory())
+    return checks
+
+
+async def warm_up() -> None:
+    """Run _warm_up off the event loop and record whether the service is ready"""
+    readiness["attempted_at"] = time.monotonic()
+    try:
+        readiness["checks"] = await asyncio.to_thread(_warm_up)
+        readiness["ready"] = True
+    except Exception as e:
+        print(f"[System] Warm-up failed, staying unready: {e}")
+        readiness["checks"] = {"error": str(e)}
+
+
+def _retry_warm_up() -> None:
+    """Start another warm-up in the background unless one is running or the last was too recent"""
+    global _warm_up_task
+    if readiness["ready"] or (_warm_up_task is not None and not _warm_up_task.done()):
+        return
+    attempted_at = readiness["attempted_at"]
+    if attempted_at is not None and time.monotonic() - attempted_at < SERVER_WARMUP_RETRY_INTERVAL:
+        return
+    # Not awaited by the probe: a slow index load must not outlast the probe's timeout
+    _warm_up_task = asyncio.ensure_future(warm_up())
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await warm_up()
+    yield
+    if _warm_up_task is not None and not _warm_up_task.done():
+        _warm_up_task.cancel()
+
+
+app = FastAPI(title="AI Sales Assistant", lifespan=lifespan)
+
+
+@app.get("/healthz")
+async def healthz():
+    """Liveness: the process is up and serving requests"""
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+async def readyz():
+    """Readiness: warmed up and not shedding load; a failed warm-up is retried from here"""
+    if not readiness["ready"]:
+        _retry_warm_up()
+    ready = readiness["ready"] and not limiter.saturated
+    body = {"ready": ready, "checks": readiness["checks"], "load": limiter.stats()}
+    return JSONResponse(body, status_code=200 if ready else 503)
+
+
+@app.get("/metrics")
+async def metrics():
+    """Queue gauges, plus trace metrics when the Prometheus sink is enabled"""
+    stats = limiter.stats()
+    lines = [
+        "# TYPE agent_server_running_turns gauge",
+        f"agent_server_running_turns {stats['running']}",
+        "# TYPE agent_server_waiting_turns gauge",
+        f"agent_server_waiting_turns {stats['waiting']}",
+        "# TYPE agent_server_requests_total counter",
+    ]
+    for outcome in ("accepted", "rejected_queue_full", "rejected_queue_timeout"):
+        lines.append(f'agent_server_requests_total{{outcome="{outcome}"}} {stats.get(outcome, 0)}')
+    text = "\n".join(lines) + "\n"
+
+    prometheus = get_tracer().find_sink(PrometheusSink)
+    if prometheus is not None:
+        text += prometheus.render()
+    return PlainTextResponse(text, media_type="text/plain; version=0.0.4")
+
+
+@app.post("/chat")
+async def chat(request: ChatRequest, background_tasks: BackgroundTasks):
+    """Run one turn and return the final answer"""
+    try:
+        await limiter.acquire()
+    except Overloaded as e:
+        return _overloaded_response(e)
+
+    try:
+        started = time.perf_counter()
+        state = await compiled_graph.ainvoke(await _turn_input(request))
+        background_tasks.add_task(_remember_turn, request, state)
+        return turn_result(state, time.perf_counter() - started)
+    except Exception as e:
+        print(f"[System] Turn failed: {e}")
+        raise HTTPException(status_code=500, detail="The assistant could not answer this request")
+    finally:
+        limiter.release()
+
+
+@app.post("/chat/stream")
+async def chat_stream(request: ChatRequest, http_request: Request):
+    """Run one turn as Server-Sent Events: accepted, node and token events, then result (or error)"""
+    try:
+        await limiter.acquire()
+    except Overloaded as e:
+        return _overloaded_response(e)
+
+    # Filled in by the stream, stored once the response is complete
+    finished: Dict[str, Any] = {}
+
+    async def events() -> AsyncIterator[str]:
+        started = time.perf_counter()
+        try:
+            input_state = await _turn_input(request, stream_response=True)
+            yield _sse("accepted", {"trace_id": input_state["trace_id"]})
+            turn = astream_turn(input_state, node_events=True)
+            try:
+                async for kind, payload in turn:
+                    if kind == "token":
+                        yield _sse("token", {"text": payload})
+                    elif kind == "node":
+                        yield _sse("node", {**payload._asdict(), "duration": payload.duration})
+                    else:
+                        finished["state"] = payload
+                        yield _sse("result", turn_result(payload, time.perf_counter() - started))
+                    if await http_request.is_disconnected():
+                        # Stop working on an answer nobody is reading
+                        break
+            finally:
+                # Breaking out leaves the graph run suspended; closing it cancels the run now
+                await turn.aclose()
+        except Exception as e:
+            print(f"[System] Streamed turn failed: {e}")
+            yield _sse("error", {"detail": "The assistant could not answer this request"})
+
+    async def close() -> None:
+        # Cancels a turn still running for a client that left, then frees its slot
+        try:
+            await stream.aclose()
+        finally:
+            limiter.release()
+
+    # Run up to the accepted event here, so it carries the turn's trace id
+    stream = events()
+    try:
+        accepted = await stream.__anext__()
+    except BaseException:
+        await close()
+        raise
+
+    async def body() -> AsyncIterator[str]:
+        yield accepted
+        async for event in stream:
+            yield event
+
+    return ClosingStreamingResponse(
+        body(),
+        on_close=close,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=BackgroundTask(lambda: _remember_turn(request, finished.get("state"))),
+    )
+
+
+if __name__ == "__main__":
+    uvicorn.run(app, host=SERVER_HOST, port=SERVER_PORT)
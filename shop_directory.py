@@ -0,0 +1,127 @@
+import json
+import math
+import os
+import threading
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from lexical_index import tokenize
+
+load_dotenv()
+
+SHOP_DIRECTORY_PATH = os.getenv("SHOP_DIRECTORY_PATH", "./shops.json")
+# Stores sent to the LLM when only the customer's coordinates are known
+NEAREST_SHOPS = int(os.getenv("NEAREST_SHOPS", "1"))
+
+EARTH_RADIUS_KM = 6371.0
+
+
+def _fold(text: str) -> str:
+    return " ".join(tokenize(text))
+
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Great-circle distance between two points in kilometres"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lon2 - lon1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+class Shop(NamedTuple):
+    record: Dict[str, Any]
+    # Pre-rendered context line for the shop agent prompt
+    context: str
+    # Pre-rendered one-line summary with the phone number
+    summary: str
+
+
+class ShopDirectory:
+    """Store records loaded once, with pre-rendered text and an area index
+
+    Wards, districts and street names are indexed diacritic-folded, so
+    "Hoàng Mai", "hoang mai" and "HOANG MAI" find the same stores.
+    """
+
+    def __init__(self, records: List[Dict[str, Any]]):
+        self.shops = [
+            Shop(
+                record,
+                f"Address: {record['address']}, Hours: {record['opening_hours']}, Maps: {record['maps_url']}",
+                f"{record['address']}, Hours: {record['opening_hours']}, Phone: {record['phone']}",
+            )
+            for record in records
+        ]
+        self.records = [shop.record for shop in self.shops]
+        # Stores are blank-line separated so the context budget treats each as a chunk
+        self.context = "\n\n".join(shop.context for shop in self.shops)
+
+        self._areas: Dict[str, List[int]] = {}
+        for position, record in enumerate(records):
+            for name in [record.get("ward"), record.get("district"), record.get("name")] + record.get("aliases", []):
+                if name:
+                    positions = self._areas.setdefault(_fold(name), [])
+                    if position not in positions:
+                        positions.append(position)
+
+    @classmethod
+    def load(cls, path: str = SHOP_DIRECTORY_PATH) -> "ShopDirectory":
+        with open(path, encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    def __len__(self) -> int:
+        return len(self.shops)
+
+    def find_by_area(self, text: str) -> List[Shop]:
+        """Stores in every ward, district or street named in the text"""
+        padded = f" {_fold(text)} "
+        positions = sorted({
+            position
+            for area, area_positions in self._areas.items()
+            if f" {area} " in padded
+            for position in area_positions
+        })
+        return [self.shops[position] for position in positions]
+
+    def nearest(self, latitude: float, longitude: float, k: int = NEAREST_SHOPS) -> List[Tuple[Shop, float]]:
+        """The k closest stores with their distance in kilometres"""
+        located = [
+            (shop, haversine_km(latitude, longitude, shop.record["latitude"], shop.record["longitude"]))
+            for shop in self.shops
+            if shop.record.get("latitude") is not None and shop.record.get("longitude") is not None
+        ]
+        located.sort(key=lambda item: item[1])
+        return located[:k]
+
+    def context_for(self, text: str, location: Optional[Dict[str, float]] = None) -> str:
+        """Context lines for the stores relevant to a query
+
+        Stores in an area named in the text win; otherwise the nearest stores
+        to the given {"latitude", "longitude"}; otherwise every store.
+        """
+        matched = self.find_by_area(text)
+        if matched:
+            return "\n\n".join(shop.context for shop in matched)
+
+        if location and location.get("latitude") is not None and location.get("longitude") is not None:
+            nearest = self.nearest(location["latitude"], location["longitude"])
+            if nearest:
+                return "\n\n".join(f"{shop.context}, Distance: about {distance:.1f} km" for shop, distance in nearest)
+
+        return self.context
+
+
+_directory: Optional[ShopDirectory] = None
+_directory_lock = threading.Lock()
+
+
+def get_shop_directory() -> ShopDirectory:
+    """Process-wide shop directory, loaded on first use"""
+    global _directory
+    if _directory is None:
+        with _directory_lock:
+            if _directory is None:
+                _directory = ShopDirectory.load()
+    return _directory
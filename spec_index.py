@@ -0,0 +1,281 @@
+import bisect
+import json
+import os
+import re
+from typing import Any, Dict, List, Optional, Sequence
+
+from lexical_index import fold_diacritics
+
+SPEC_INDEX_FILE = "spec_index.json"
+
+# Typed attributes extracted from each product
+NUMERIC_ATTRIBUTES = ["price_vnd", "ram_gb", "storage_gb", "battery_mah", "screen_inch"]
+
+# Title keyword -> brand
+BRAND_ALIASES = {
+    "iphone": "apple",
+    "ipad": "apple",
+    "apple": "apple",
+    "samsung": "samsung",
+    "galaxy": "samsung",
+    "nokia": "nokia",
+    "xiaomi": "xiaomi",
+    "redmi": "xiaomi",
+    "poco": "xiaomi",
+    "oppo": "oppo",
+    "realme": "realme",
+    "vivo": "vivo",
+    "tecno": "tecno",
+    "infinix": "infinix",
+    "honor": "honor",
+    "itel": "itel",
+    "nubia": "nubia",
+    "tcl": "tcl",
+    "zte": "zte",
+    "inoi": "inoi",
+    "vsmart": "vsmart",
+    "blackberry": "blackberry",
+    "oscal": "oscal",
+    "htc": "htc",
+    "masstel": "masstel",
+    "energizer": "energizer",
+}
+
+_SIZE_RE = re.compile(r"(\d+(?:[.,]\d+)?)\s*(tb|gb|g|mb)(?![a-z])", re.IGNORECASE)
+_NUMBER_RE = re.compile(r"\d+(?:[.,]\d+)?")
+
+
+def parse_price(text: Any) -> Optional[int]:
+    """Parse a price like "1,590,000 ₫" into VND; None for "Giá: Liên hệ" and the like"""
+    digits = re.sub(r"[^\d]", "", str(text or ""))
+    return int(digits) if digits else None
+
+
+def parse_size_gb(text: Any) -> Optional[float]:
+    """Parse the first memory size ("8GB", "512 MB", "1TB") into GB"""
+    match = _SIZE_RE.search(str(text or ""))
+    if not match:
+        return None
+    value = float(match.group(1).replace(",", "."))
+    unit = match.group(2).lower()
+    if unit == "tb":
+        return value * 1024
+    if unit == "mb":
+        return round(value / 1024, 4)
+    return value
+
+
+def parse_number(text: Any) -> Optional[float]:
+    """Parse the first number in a spec value ("5000 mAh", "6.7 inch")"""
+    match = _NUMBER_RE.search(str(text or ""))
+    return float(match.group(0).replace(",", ".")) if match else None
+
+
+def parse_specs(product_specs: Any) -> Dict[str, str]:
+    """Split the "Label:\\nvalue<br>" spec string into a dict"""
+    specs = {}
+    for part in str(product_specs or "").split("<br>"):
+        if ":" in part:
+            label, value = part.split(":", 1)
+            specs[label.strip()] = value.strip()
+    return specs
+
+
+def detect_brand(title: Any) -> Optional[str]:
+    for token in re.findall(r"[a-z0-9]+", fold_diacritics(str(title or "")).lower()):
+        if token in BRAND_ALIASES:
+            return BRAND_ALIASES[token]
+    return None
+
+
+def extract_attributes(title: Any, current_price: Any, product_specs: Any) -> Dict[str, Any]:
+    """Typed price/spec attributes for one product; unknown values are left out"""
+    specs = parse_specs(product_specs)
+    attributes = {
+        "price_vnd": parse_price(current_price),
+        "ram_gb": parse_size_gb(specs.get("RAM")),
+        "storage_gb": parse_size_gb(specs.get("Bộ nhớ trong")),
+        "battery_mah": parse_number(specs.get("Dung lượng pin")),
+        "screen_inch": parse_number(specs.get("Kích thước màn hình")),
+        "brand": detect_brand(title),
+    }
+
+    # Titles like "galaxy a05s - 6gb/128gb" fill in missing memory sizes
+    title_sizes = re.search(r"(\d+)\s*gb\s*/\s*(\d+)\s*(gb|tb)", str(title or ""), re.IGNORECASE)
+    if title_sizes:
+        if attributes["ram_gb"] is None:
+            attributes["ram_gb"] = float(title_sizes.group(1))
+        if attributes["storage_gb"] is None:
+            attributes["storage_gb"] = parse_size_gb(f"{title_sizes.group(2)}{title_sizes.group(3)}")
+
+    return {key: value for key, value in attributes.items() if value is not None}
+
+
+# Bare memory sizes up to this many GB are taken as RAM, larger ones as storage
+MAX_RAM_GB = 24
+
+
+def parse_query_filters(query: str) -> Dict[str, Any]:
+    """Pull structured filters out of a natural-language query
+
+    Understands Vietnamese and English price phrases ("dưới 5 triệu",
+    "rẻ hơn 5 triệu", "từ 3 đến 5 triệu", "under 5 million"), minimum RAM/storage ("RAM 8GB",
+    "6GB/128GB", or a bare "256GB"), minimum battery ("pin trên 5000 mAh")
+    and brand names.
+    """
+    text = fold_diacritics(query).lower()
+    filters: Dict[str, Any] = {}
+
+    def to_vnd(number: str, unit: str) -> int:
+        value = float(number.replace(",", "."))
+        if unit in ("trieu", "tr", "m", "million"):
+            return int(value * 1_000_000)
+        if unit in ("k", "nghin", "ngan"):
+            return int(value * 1_000)
+        return int(value)
+
+    unit = r"(trieu|tr|million|m|k|nghin|ngan)\b"
+    number = r"(\d+(?:[.,]\d+)?)\s*"
+
+    between = re.search(r"\b(?:tu|from|between)\s+" + number + r"(?:" + unit + r")?\s*(?:den|toi|-|to|and)\s*" + number + unit, text)
+    if between:
+        high_unit = between.group(4)
+        filters["min_price"] = to_vnd(between.group(1), between.group(2) or high_unit)
+        filters["max_price"] = to_vnd(between.group(3), high_unit)
+    else:
+        # A bare "hơn" ("hơn 2 triệu một chút") gives no direction; "rẻ hơn" is a ceiling
+        below = re.search(
+            r"\b(?:duoi|khong qua|toi da|(?:re|thap|it) hon|under|below|less than|cheaper than|max)\s+" + number + unit, text
+        )
+        if below:
+            filters["max_price"] = to_vnd(below.group(1), below.group(2))
+        above = re.search(
+            r"\b(?:tren|(?:dat|cao|nhieu) hon|tu|over|above|more than|more expensive than|at least)\s+" + number + unit, text
+        )
+        if above:
+            filters["min_price"] = to_vnd(above.group(1), above.group(2))
+
+    # "6GB/128GB" and "8+8GB/256GB" give RAM then storage
+    pair = re.search(r"\b(\d+)(?:\s*\+\s*\d+)?\s*gb\s*/\s*(\d+)\s*(gb|tb)\b", text)
+    if pair:
+        filters["min_ram_gb"] = float(pair.group(1))
+        filters["min_storage_gb"] = parse_size_gb(f"{pair.group(2)}{pair.group(3)}")
+        text = text[:pair.start()] + " " + text[pair.end():]
+
+    ram = re.search(r"\bram\s*(?:>=|tu|it nhat|toi thieu|at least)?\s*(\d+)\s*gb\b|\b(\d+)\s*gb\s*ram\b", text)
+    if ram:
+        filters["min_ram_gb"] = float(ram.group(1) or ram.group(2))
+        text = text[:ram.start()] + " " + text[ram.end():]
+
+    storage = re.search(r"\b(?:bo nho|rom|storage)\s*(?:trong)?\s*(\d+)\s*(gb|tb)\b", text)
+    if storage:
+        filters["min_storage_gb"] = parse_size_gb(f"{storage.group(1)}{storage.group(2)}")
+        text = text[:storage.start()] + " " + text[storage.end():]
+
+    # Remaining bare sizes: small ones are RAM, large ones storage
+    for size, size_unit in re.findall(r"\b(\d+)\s*(gb|tb)\b", text):
+        gigabytes = parse_size_gb(f"{size}{size_unit}")
+        key = "min_ram_gb" if size_unit == "gb" and gigabytes <= MAX_RAM_GB else "min_storage_gb"
+        filters.setdefault(key, gigabytes)
+
+    battery = re.search(r"\b(?:pin|battery)?\s*(?:tren|tu|it nhat|toi thieu|>=|over|above|at least)?\s*(\d+)\s*mah\b", text)
+    if battery:
+        filters["min_battery_mah"] = float(battery.group(1))
+
+    brands = sorted({BRAND_ALIASES[token] for token in re.findall(r"[a-z0-9]+", text) if token in BRAND_ALIASES})
+    if brands:
+        filters["brand"] = brands
+
+    return filters
+
+
+def has_numeric_filters(filters: Dict[str, Any]) -> bool:
+    """Whether the filters constrain price or specs, not only the brand"""
+    return any(value is not None for key, value in filters.items() if key != "brand")
+
+
+class SpecIndex:
+    """Columnar index of typed product attributes
+
+    Prices are kept in a sorted array so price ranges resolve with a binary
+    search; brands map to position sets; other numeric filters are checked
+    against their columns for the remaining candidates.
+    """
+
+    def __init__(self, ids: List[str], metadatas: List[Dict[str, Any]], columns: Dict[str, List[Any]]):
+        self.ids = ids
+        self.metadatas = metadatas
+        self.columns = columns
+
+        priced = sorted(
+            (price, position) for position, price in enumerate(columns.get("price_vnd", [])) if price is not None
+        )
+        self._price_values = [price for price, _ in priced]
+        self._price_positions = [position for _, position in priced]
+
+        self._brands: Dict[str, set] = {}
+        for position, brand in enumerate(columns.get("brand", [])):
+            if brand:
+                self._brands.setdefault(brand, set()).add(position)
+
+    @classmethod
+    def build(cls, ids: Sequence[str], metadatas: Sequence[Dict[str, Any]]) -> "SpecIndex":
+        """Build from product metadata that already carries the typed attributes"""
+        columns = {
+            name: [metadata.get(name) for metadata in metadatas]
+            for name in NUMERIC_ATTRIBUTES + ["brand"]
+        }
+        return cls(list(ids), list(metadatas), columns)
+
+    def save(self, path: str) -> None:
+        os.makedirs(path, exist_ok=True)
+        tmp_path = os.path.join(path, SPEC_INDEX_FILE + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"ids": self.ids, "metadatas": self.metadatas, "columns": self.columns}, f, ensure_ascii=False)
+        os.replace(tmp_path, os.path.join(path, SPEC_INDEX_FILE))
+
+    @classmethod
+    def load(cls, path: str) -> "SpecIndex":
+        with open(os.path.join(path, SPEC_INDEX_FILE), encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data["ids"], data["metadatas"], data["columns"])
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def filter(self, filters: Dict[str, Any]) -> List[int]:
+        """Return positions of products matching every filter, cheapest first"""
+        min_price = filters.get("min_price")
+        max_price = filters.get("max_price")
+
+        if min_price is not None or max_price is not None:
+            low = bisect.bisect_left(self._price_values, min_price) if min_price is not None else 0
+            high = bisect.bisect_right(self._price_values, max_price) if max_price is not None else len(self._price_values)
+            candidates = self._price_positions[low:high]
+        else:
+            candidates = list(self._price_positions)
+            priced = set(candidates)
+            candidates += [position for position in range(len(self.ids)) if position not in priced]
+
+        brand = filters.get("brand")
+        if brand:
+            brands = [brand] if isinstance(brand, str) else brand
+            allowed = set().union(*(self._brands.get(b.lower(), set()) for b in brands))
+            candidates = [position for position in candidates if position in allowed]
+
+        minimums = {
+            "min_ram_gb": "ram_gb",
+            "min_storage_gb": "storage_gb",
+            "min_battery_mah": "battery_mah",
+            "min_screen_inch": "screen_inch",
+        }
+        for key, column in minimums.items():
+            if filters.get(key) is not None:
+                values = self.columns[column]
+                candidates = [p for p in candidates if values[p] is not None and values[p] >= filters[key]]
+
+        if filters.get("max_screen_inch") is not None:
+            values = self.columns["screen_inch"]
+            candidates = [p for p in candidates if values[p] is not None and values[p] <= filters["max_screen_inch"]]
+
+        return candidates
@@ -1,12 +1,14 @@
 import streamlit as st
 import time
-from typing import Dict, Any, List
+import uuid
 import os
 from dotenv import load_dotenv
 
 # Import your existing modules
-from app import compiled_graph, AgentState
-import google.generativeai as genai
+from app import evaluation_stats, initial_state, stream_turn
+from conversation_store import get_conversation_store
+from query_classifier import stats as classifier_counters
+from response_cache import get_response_cache
 
 load_dotenv()
 
@@ -107,8 +109,9 @@ st.markdown("""
 def initialize_session_state():
     if "messages" not in st.session_state:
         st.session_state.messages = []
-    if "conversation_history" not in st.session_state:
-        st.session_state.conversation_history = []
+    if "session_id" not in st.session_state:
+        # Key of this browser session's history in the conversation store
+        st.session_state.session_id = uuid.uuid4().hex
     if "processing" not in st.session_state:
         st.session_state.processing = False
     if "stats" not in st.session_state:
@@ -118,6 +121,11 @@ def initialize_session_state():
             "product_queries": 0,
             "shop_queries": 0
         }
+    if "latency" not in st.session_state:
+        st.session_state.latency = {
+            "time_to_first_token": None,
+            "turn_time": None
+        }
 
 def display_header():
     st.markdown("""
@@ -152,6 +160,7 @@ def display_sidebar():
         st.subheader("💬 Chat Settings")
         show_system_messages = st.checkbox("Show System Messages", value=False)
         show_agent_workflow = st.checkbox("Show Agent Workflow", value=True)
+        stream_response = st.checkbox("Stream Response", value=True)
         max_iterations = st.slider("Max Query Iterations", 1, 5, 3)
         
         st.divider()
@@ -172,13 +181,40 @@ def display_sidebar():
         success_rate = (stats["successful_responses"] / stats["total_queries"] * 100) if stats["total_queries"] > 0 else 0
         st.metric("Success Rate", f"{success_rate:.1f}%")
         
+        # Latency of the last turn; time to first token is what the user feels
+        latency = st.session_state.latency
+        if latency["turn_time"] is not None:
+            col1, col2 = st.columns(2)
+            with col1:
+                ttft = latency["time_to_first_token"]
+                st.metric("Time to First Token", f"{ttft:.2f}s" if ttft is not None else "n/a")
+            with col2:
+                st.metric("Total Turn Time", f"{latency['turn_time']:.2f}s")
+        
+        # Near-duplicate questions answered without running the graph
+        cache_stats = get_response_cache().stats()
+        if cache_stats["hits"] + cache_stats["misses"]:
+            st.metric("Response Cache Hit Rate", f"{cache_stats['hit_rate'] * 100:.1f}%")
+        
+        # Streamed answers are scored after delivery
+        evaluations = evaluation_stats.snapshot()
+        if evaluations:
+            st.metric("Background Evaluations Passed", f"{evaluations.get('good', 0)}/{sum(evaluations.values())}")
+        
+        # Rule-based classifier fast path
+        classifier_stats = classifier_counters.snapshot()
+        if classifier_stats:
+            short_circuited = sum(v for k, v in classifier_stats.items() if k.endswith("short_circuited"))
+            total = sum(classifier_stats.values())
+            st.metric("LLM Calls Skipped by Rules", f"{short_circuited}/{total}")
+        
         st.divider()
         
         # Actions
         st.subheader("🔄 Actions")
         if st.button("🗑️ Clear Chat History"):
             st.session_state.messages = []
-            st.session_state.conversation_history = []
+            get_conversation_store().clear(st.session_state.session_id)
             st.success("Chat history cleared!")
             st.rerun()
         
@@ -205,7 +241,7 @@ def display_sidebar():
                 mime="text/plain"
             )
     
-    return show_system_messages, show_agent_workflow, max_iterations
+    return show_system_messages, show_agent_workflow, stream_response, max_iterations
 
 def display_chat_interface():
     # Chat container
@@ -227,7 +263,45 @@ def display_chat_interface():
                 </div>
                 """, unsafe_allow_html=True)
 
-def process_query_with_workflow(user_input: str, max_iterations: int, show_system: bool, show_workflow: bool):
+# Display labels for graph nodes in the workflow panel
+NODE_LABELS = {
+    "check_response_cache": "💾 Checking Response Cache",
+    "plan_query": "🗺️ Planning Query",
+    "detect_language": "🌐 Detecting Language",
+    "rewrite_query": "✏️ Rewriting Query",
+    "determine_agent_and_context_need": "🎯 Determining Agent Route",
+    "select_information_sources": "🔍 Selecting Information Sources",
+    "retrieve_context": "📖 Retrieving Context",
+    "generate_response": "🤖 Generating Response",
+    "generate_direct_response": "🤖 Generating Direct Response",
+    "evaluate_response": "✅ Evaluating Response Quality",
+    "plan_retry": "🔁 Planning Retry",
+    "finalize_response": "🏁 Finalizing Response"
+}
+
+def render_workflow(events) -> str:
+    """HTML for the nodes seen so far with their start and finish times"""
+    step_html = ""
+    for event in events:
+        label = NODE_LABELS.get(event.node, event.node)
+        if event.status == "started":
+            step_html += f'<div class="agent-status agent-active">⏳ {label} (started {event.started_at:.2f}s)</div>'
+        elif event.status == "failed":
+            step_html += f'<div class="error-message">❌ {label} ({event.started_at:.2f}s → {event.finished_at:.2f}s)</div>'
+        else:
+            step_html += (
+                f'<div class="agent-status agent-completed">✅ {label} '
+                f'({event.started_at:.2f}s → {event.finished_at:.2f}s, {event.duration * 1000:.0f} ms)</div>'
+            )
+    return step_html
+
+def remember_turn(user_input: str, response: str, success: bool):
+    """Add a finished turn to this session's conversation history"""
+    # Error messages would only confuse follow-up questions
+    if success:
+        get_conversation_store().append(st.session_state.session_id, user_input, response)
+
+def process_query_with_workflow(user_input: str, max_iterations: int, show_system: bool, show_workflow: bool, stream_response: bool = True):
     """Process query and show workflow if enabled"""
     
     # Update stats
@@ -248,81 +322,47 @@ def process_query_with_workflow(user_input: str, max_iterations: int, show_syste
             system_placeholder = st.empty()
     
     # Prepare input state
-    input_state = {
-        "original_query": user_input,
-        "rewritten_query": "",
-        "current_query": user_input,
-        "language": "en",
-        "max_iterations": max_iterations,
-        "current_iteration": 0,
-        "messages": st.session_state.conversation_history + [{"role": "user", "content": user_input}],
-        "routing_decision": None,
-        "needs_additional_info": False,
-        "selected_sources": [],
-        "product_rag_results": None,
-        "shop_info_rag_results": None,
-        "internet_search_results": None,
-        "retrieved_context": None,
-        "response": None,
-        "response_quality_good": False,
-        "final_response": None
-    }
+    input_state = initial_state(
+        user_input,
+        max_iterations=max_iterations,
+        stream_response=stream_response,
+        history=get_conversation_store().history(st.session_state.session_id)
+    )
     
-    workflow_steps = []
     system_messages = []
     
     try:
-        # Create a custom callback for workflow tracking
-        class WorkflowTracker:
-            def __init__(self):
-                self.current_step = 0
-                self.steps = [
-                    "🌐 Detecting Language",
-                    "✏️ Rewriting Query", 
-                    "🎯 Determining Agent Route",
-                    "📊 Evaluating Context Need",
-                    "🔍 Selecting Information Sources",
-                    "📖 Retrieving Context",
-                    "🤖 Generating Response",
-                    "✅ Evaluating Response Quality"
-                ]
-            
-            def update_step(self, step_name, status="active"):
-                if show_workflow:
-                    step_html = ""
-                    for i, step in enumerate(self.steps):
-                        if step_name in step.lower():
-                            step_html += f'<div class="agent-status agent-active">⏳ {step}</div>'
-                        elif i < self.current_step:
-                            step_html += f'<div class="agent-status agent-completed">✅ {step}</div>'
-                        else:
-                            step_html += f'<div class="agent-status">⭕ {step}</div>'
-                    
-                    workflow_placeholder.markdown(step_html, unsafe_allow_html=True)
-                    
-                if step_name == "completed":
-                    self.current_step = len(self.steps)
-                else:
-                    self.current_step += 1
-        
-        tracker = WorkflowTracker()
+        # Node name -> NodeEvent, in the order the graph ran them (retries update in place)
+        node_events = {}
         
-        # Process with progress tracking
         with st.spinner("Processing your query..."):
-            # Step-by-step processing simulation
-            tracker.update_step("detecting")
-            time.sleep(0.5)
+            started = time.perf_counter()
+            time_to_first_token = None
+            response_placeholder = st.empty() if stream_response else None
+            streamed_text = ""
+            result = None
             
-            tracker.update_step("rewriting")
-            time.sleep(0.5)
-            
-            tracker.update_step("determining")
-            time.sleep(0.5)
-            
-            # Execute the actual graph
-            result = compiled_graph.invoke(input_state)
+            # Render the real graph progress and, when streaming, answer tokens as they arrive
+            for kind, payload in stream_turn(input_state, node_events=show_workflow):
+                if kind == "node":
+                    node_events[payload.node] = payload
+                    workflow_placeholder.markdown(render_workflow(node_events.values()), unsafe_allow_html=True)
+                elif kind == "token":
+                    if time_to_first_token is None:
+                        time_to_first_token = time.perf_counter() - started
+                    streamed_text += payload
+                    response_placeholder.markdown(f"""
+                    <div class="assistant-message">
+                        <strong>Assistant:</strong> {streamed_text}
+                    </div>
+                    """, unsafe_allow_html=True)
+                else:
+                    result = payload
             
-            tracker.update_step("completed")
+            st.session_state.latency = {
+                "time_to_first_token": time_to_first_token,
+                "turn_time": time.perf_counter() - started
+            }
         
         # Extract results
         final_response = result.get("final_response", "I'm sorry, I couldn't process your request.")
@@ -354,7 +394,7 @@ def main():
     
     # Display components
     display_header()
-    show_system, show_workflow, max_iterations = display_sidebar()
+    show_system, show_workflow, stream_response, max_iterations = display_sidebar()
     
     # Main chat area
     col1, col2 = st.columns([3, 1])
@@ -389,17 +429,14 @@ def main():
             
             # Process query
             response, success = process_query_with_workflow(
-                user_input, max_iterations, show_system, show_workflow
+                user_input, max_iterations, show_system, show_workflow, stream_response
             )
             
             # Add assistant response
             st.session_state.messages.append({"role": "assistant", "content": response})
             
             # Update conversation history
-            st.session_state.conversation_history = [
-                {"role": "user", "content": user_input},
-                {"role": "assistant", "content": response}
-            ]
+            remember_turn(user_input, response, success)
             
             # Reset processing state
             st.session_state.processing = False
@@ -426,14 +463,11 @@ def main():
                 st.session_state.messages.append({"role": "user", "content": query})
                 
                 response, success = process_query_with_workflow(
-                    query, max_iterations, show_system, show_workflow
+                    query, max_iterations, show_system, show_workflow, stream_response
                 )
                 
                 st.session_state.messages.append({"role": "assistant", "content": response})
-                st.session_state.conversation_history.extend([
-                    {"role": "user", "content": query},
-                    {"role": "assistant", "content": response}
-                ])
+                remember_turn(query, response, success)
                 
                 st.rerun()
         
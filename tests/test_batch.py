@@ -0,0 +1,104 @@
+import asyncio
+import gc
+
+import pytest
+
+from batch import CoalescingEmbeddings, repair_checkpoint
+
+
+class SlowProvider:
+    """Async embedder that holds each request until released"""
+
+    model = "fake"
+
+    def __init__(self):
+        self.requests = []
+        self.release = None
+
+    def embed(self, texts):
+        return [[float(len(text))] for text in texts]
+
+    async def aembed(self, texts):
+        self.requests.append(list(texts))
+        await self.release.wait()
+        return [[float(len(text))] for text in texts]
+
+
+def test_concurrent_requests_share_a_batch_and_get_their_own_vectors():
+    provider = SlowProvider()
+
+    async def main():
+        provider.release = asyncio.Event()
+        provider.release.set()
+        coalescing = CoalescingEmbeddings(provider, batch_size=10, window=0.01)
+        results = await asyncio.gather(coalescing.aembed(["a"]), coalescing.aembed(["bb", "ccc"]))
+        await coalescing.aclose()
+        return coalescing, results
+
+    coalescing, results = asyncio.run(main())
+    assert results == [[[1.0]], [[2.0], [3.0]]]
+    assert provider.requests == [["a", "bb", "ccc"]]
+    assert coalescing.requests == 1
+
+
+def test_batches_in_flight_survive_garbage_collection():
+    provider = SlowProvider()
+
+    async def main():
+        provider.release = asyncio.Event()
+        coalescing = CoalescingEmbeddings(provider, batch_size=1)
+        waiting = asyncio.ensure_future(coalescing.aembed(["abcd"]))
+        await asyncio.sleep(0.01)
+        assert len(coalescing._tasks) == 1
+        gc.collect()
+        provider.release.set()
+        result = await asyncio.wait_for(waiting, 1)
+        await coalescing.aclose()
+        return coalescing, result
+
+    coalescing, result = asyncio.run(main())
+    assert result == [[4.0]]
+    assert not coalescing._tasks
+
+
+def test_aclose_sends_queued_requests():
+    provider = SlowProvider()
+
+    async def main():
+        provider.release = asyncio.Event()
+        provider.release.set()
+        coalescing = CoalescingEmbeddings(provider, batch_size=10, window=60)
+        waiting = asyncio.ensure_future(coalescing.aembed(["ab"]))
+        await asyncio.sleep(0)
+        await coalescing.aclose()
+        return await waiting
+
+    assert asyncio.run(main()) == [[2.0]]
+
+
+def test_aclose_with_cancel_stops_batches_in_flight():
+    provider = SlowProvider()
+
+    async def main():
+        provider.release = asyncio.Event()
+        coalescing = CoalescingEmbeddings(provider, batch_size=1)
+        waiting = asyncio.ensure_future(coalescing.aembed(["ab"]))
+        await asyncio.sleep(0.01)
+        await asyncio.wait_for(coalescing.aclose(cancel=True), 1)
+        assert not coalescing._tasks
+        # The turn waiting on the batch is not left hanging
+        with pytest.raises(asyncio.CancelledError):
+            await asyncio.wait_for(waiting, 1)
+
+    asyncio.run(main())
+
+
+def test_repair_checkpoint_drops_a_cut_off_last_line(tmp_path):
+    path = tmp_path / "results.jsonl"
+    path.write_text('{"id": "q1"}\n{"id": "q2", "ans', encoding="utf-8")
+
+    repair_checkpoint(str(path))
+    assert path.read_text(encoding="utf-8") == '{"id": "q1"}\n'
+
+    repair_checkpoint(str(path))
+    assert path.read_text(encoding="utf-8") == '{"id": "q1"}\n'
@@ -0,0 +1,57 @@
+import sqlite3
+import time
+
+import embedding_cache
+from embedding_cache import EmbeddingCache, cache_key
+
+
+def last_access(path, model, text):
+    with sqlite3.connect(path) as conn:
+        (value,) = conn.execute("SELECT last_access FROM embeddings WHERE key = ?", (cache_key(model, text),)).fetchone()
+    return value
+
+
+def test_disk_hits_do_not_write_until_flushed(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    EmbeddingCache(path).put_many("m", ["a"], [[1.0, 2.0]])
+    stored = last_access(path, "m", "a")
+    time.sleep(0.002)
+
+    # A fresh process: the hit comes from SQLite, not the memory tier
+    cache = EmbeddingCache(path)
+    assert cache.get_many("m", ["a", "b"]) == {0: [1.0, 2.0]}
+    assert last_access(path, "m", "a") == stored
+    assert not cache._conn.in_transaction
+
+    cache.flush()
+    assert last_access(path, "m", "a") > stored
+
+
+def test_access_times_flush_once_enough_are_pending(tmp_path, monkeypatch):
+    monkeypatch.setattr(embedding_cache, "ACCESS_FLUSH_ENTRIES", 2)
+    path = str(tmp_path / "cache.sqlite3")
+    EmbeddingCache(path).put_many("m", ["a", "b"], [[1.0], [2.0]])
+    stored = last_access(path, "m", "a")
+    time.sleep(0.002)
+
+    cache = EmbeddingCache(path)
+    cache.get_many("m", ["a"])
+    assert last_access(path, "m", "a") == stored
+    cache.get_many("m", ["b"])
+    assert last_access(path, "m", "a") > stored
+
+
+def test_eviction_keeps_recently_read_entries(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    cache = EmbeddingCache(path, max_entries=2, memory_entries=1)
+    cache.put_many("m", ["old"], [[1.0]])
+    time.sleep(0.002)
+    cache.put_many("m", ["newer"], [[2.0]])
+    time.sleep(0.002)
+
+    # Read "old" (from disk, memory holds only "newer"), then a third entry trims one row
+    cache.get_many("m", ["old"])
+    cache.put_many("m", ["newest"], [[3.0]])
+
+    fresh = EmbeddingCache(path)
+    assert sorted(fresh.get_many("m", ["old", "newer", "newest"])) == [0, 2]
@@ -0,0 +1,147 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import embedding_pipeline
+from embedding_pipeline import TokenBucket, embed_texts_batched, embed_with_retry
+
+
+class FlakyEmbedder:
+    """Fails the first `failures` calls, then returns [index of text] vectors"""
+
+    def __init__(self, failures: int = 0):
+        self.failures = failures
+        self.calls = 0
+        self.batches = []
+        self._lock = threading.Lock()
+
+    def __call__(self, texts):
+        with self._lock:
+            self.calls += 1
+            if self.calls <= self.failures:
+                raise RuntimeError("429 Too Many Requests")
+            self.batches.append(list(texts))
+        return [[float(text.split("-")[1])] for text in texts]
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Record backoff sleeps instead of waiting, with jitter pinned to its maximum"""
+    recorded = []
+    monkeypatch.setattr(embedding_pipeline.time, "sleep", recorded.append)
+    monkeypatch.setattr(embedding_pipeline.random, "random", lambda: 1.0)
+    return recorded
+
+
+def test_retry_backs_off_exponentially_then_succeeds(sleeps):
+    embedder = FlakyEmbedder(failures=3)
+
+    assert embed_with_retry(embedder, ["t-1", "t-2"], max_retries=5, base_delay=1.0) == [[1.0], [2.0]]
+    assert embedder.calls == 4
+    assert sleeps == [1.0, 2.0, 4.0]
+
+
+def test_retry_delay_is_capped_and_jittered(monkeypatch, sleeps):
+    monkeypatch.setattr(embedding_pipeline.random, "random", lambda: 0.0)
+    embedder = FlakyEmbedder(failures=4)
+
+    embed_with_retry(embedder, ["t-1"], max_retries=5, base_delay=1.0, max_delay=3.0)
+    # Jitter scales each delay into [delay / 2, delay]
+    assert sleeps == [0.5, 1.0, 1.5, 1.5]
+
+
+def test_retry_gives_up_after_max_retries(sleeps):
+    embedder = FlakyEmbedder(failures=10)
+
+    with pytest.raises(RuntimeError):
+        embed_with_retry(embedder, ["t-1"], max_retries=2)
+    assert embedder.calls == 3
+    assert len(sleeps) == 2
+
+
+def test_retry_rejects_a_short_response(sleeps):
+    def short(texts):
+        return [[0.0]]
+
+    with pytest.raises(ValueError):
+        embed_with_retry(short, ["t-1", "t-2"], max_retries=1)
+
+
+def test_token_bucket_paces_requests_after_the_burst():
+    bucket = TokenBucket(rate=20, capacity=2)
+    started = time.monotonic()
+    for _ in range(6):
+        bucket.acquire()
+    elapsed = time.monotonic() - started
+
+    # Two from the initial burst, then four at 20 per second
+    assert 0.18 <= elapsed < 0.5
+
+
+def test_token_bucket_async_acquire_paces_without_blocking_the_loop():
+    bucket = TokenBucket(rate=20, capacity=1)
+    ticks = []
+
+    async def ticker():
+        for _ in range(10):
+            ticks.append(time.monotonic())
+            await asyncio.sleep(0.01)
+
+    async def main():
+        started = time.monotonic()
+        tick_task = asyncio.ensure_future(ticker())
+        for _ in range(4):
+            await bucket.aacquire()
+        elapsed = time.monotonic() - started
+        await tick_task
+        return elapsed
+
+    elapsed = asyncio.run(main())
+    assert 0.13 <= elapsed < 0.4
+    # The loop kept running other tasks while the bucket waited
+    assert len(ticks) == 10
+
+
+def test_token_bucket_rejects_a_non_positive_rate():
+    with pytest.raises(ValueError):
+        TokenBucket(0)
+
+
+def test_batched_output_keeps_input_order_across_concurrent_batches():
+    texts = [f"t-{i}" for i in range(23)]
+
+    def out_of_order(batch):
+        # Later batches finish first
+        time.sleep(0.02 * (30 - int(batch[0].split("-")[1])) / 30)
+        return [[float(text.split("-")[1])] for text in batch]
+
+    vectors = embed_texts_batched(texts, out_of_order, batch_size=5, max_concurrency=4, requests_per_second=0)
+    assert vectors == [[float(i)] for i in range(23)]
+
+
+def test_batched_retries_failed_batches_and_reports_progress(sleeps):
+    embedder = FlakyEmbedder(failures=2)
+    progress = []
+    texts = [f"t-{i}" for i in range(10)]
+
+    vectors = embed_texts_batched(
+        texts, embedder, batch_size=4, max_concurrency=1, requests_per_second=0,
+        on_progress=lambda done, total: progress.append((done, total)),
+    )
+    assert vectors == [[float(i)] for i in range(10)]
+    assert [len(batch) for batch in embedder.batches] == [4, 4, 2]
+    assert len(sleeps) == 2
+    assert progress == [(4, 10), (8, 10), (10, 10)]
+
+
+def test_batched_raises_when_a_batch_keeps_failing(sleeps):
+    with pytest.raises(RuntimeError):
+        embed_texts_batched(["t-1", "t-2"], FlakyEmbedder(failures=10), batch_size=1, max_retries=1, requests_per_second=0)
+
+
+def test_batched_empty_input_makes_no_requests():
+    embedder = FlakyEmbedder()
+    assert embed_texts_batched([], embedder) == []
+    assert embedder.calls == 0
@@ -0,0 +1,47 @@
+import pytest
+
+from query_classifier import RULE_CLASSIFIER_THRESHOLD, QueryClassifier, load_catalog_terms
+
+
+@pytest.fixture(scope="module")
+def classifier():
+    return QueryClassifier(load_catalog_terms())
+
+
+def test_catalog_terms_keep_names_and_drop_everyday_words(classifier):
+    terms = classifier.catalog_terms
+    for name in ["samsung", "galaxy", "redmi", "iphone", "nokia", "3210"]:
+        assert name in terms
+    for word in ["may", "minh", "tai", "thay", "nguoi", "gia", "man", "hinh", "sac", "cam", "hot", "key", "test", "find"]:
+        assert word not in terms
+
+
+@pytest.mark.parametrize("query, route", [
+    ("Cửa hàng ở Hoàng Mai mở cửa mấy giờ?", "shop_information"),
+    ("Cửa hàng có ở đâu?", "shop_information"),
+    ("Giờ mở cửa", "shop_information"),
+    ("Chính sách bảo hành như thế nào?", "shop_information"),
+    ("Where is your store?", "shop_information"),
+    ("Nokia 3210 4G có giá bao nhiêu?", "product"),
+    ("Samsung Galaxy A05s giá bao nhiêu?", "product"),
+    ("What is the price of the Redmi Note 13?", "product"),
+])
+def test_routes_example_queries_without_the_llm(classifier, query, route):
+    label, confidence = classifier.route(query)
+    assert label == route
+    assert confidence >= RULE_CLASSIFIER_THRESHOLD
+
+
+@pytest.mark.parametrize("query, language", [
+    ("Cửa hàng ở Hoàng Mai mở cửa mấy giờ?", "vi"),
+    ("gia dien thoai samsung bao nhieu", "vi"),
+    ("What is the price of the Redmi Note 13?", "en"),
+])
+def test_detects_language(classifier, query, language):
+    label, confidence = classifier.detect_language(query)
+    assert label == language
+    assert confidence >= RULE_CLASSIFIER_THRESHOLD
+
+
+def test_escalates_when_unsure(classifier):
+    assert classifier.route("xin chào") == (None, 0.0)
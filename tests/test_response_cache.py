@@ -0,0 +1,43 @@
+import pytest
+
+from query_classifier import refers_to_history
+from response_cache import ResponseCache, identity_tokens
+
+
+def test_identity_tokens_separate_models_and_prices():
+    assert identity_tokens("iPhone 14 giá") != identity_tokens("iPhone 15 giá")
+    assert identity_tokens("iPhone 15 giá") != identity_tokens("iPhone 15 Pro giá")
+    assert identity_tokens("Samsung giá rẻ") != identity_tokens("Xiaomi giá rẻ")
+    assert identity_tokens("Giá iPhone 15?") == identity_tokens("iphone 15 giá bao nhiêu")
+
+
+def test_lookup_requires_matching_identity_tokens():
+    cache = ResponseCache(threshold=0.9)
+    cache.put("iPhone 15 giá", [1.0, 0.0], "15 answer")
+
+    # Same embedding, different model: not served
+    assert cache.lookup([1.0, 0.0], "iPhone 14 giá") is None
+    assert cache.lookup([1.0, 0.0], "Giá iPhone 15 bao nhiêu").response == "15 answer"
+
+
+def test_lookup_falls_through_to_the_entry_with_matching_tokens():
+    cache = ResponseCache(threshold=0.9)
+    cache.put("iPhone 15 giá", [1.0, 0.0], "15 answer")
+    cache.put("iPhone 14 giá", [0.99, 0.14], "14 answer")
+
+    assert cache.lookup([1.0, 0.0], "giá iPhone 14").response == "14 answer"
+
+
+@pytest.mark.parametrize("query, follow_up", [
+    ("còn cái rẻ hơn thì sao?", True),
+    ("Nó có mấy màu?", True),
+    ("máy này pin bao nhiêu", True),
+    ("what about the cheaper one?", True),
+    ("How much is it?", True),
+    ("iPhone 15 giá bao nhiêu", False),
+    ("Cửa hàng ở đâu?", False),
+    ("Điện thoại nào rẻ hơn 5 triệu?", False),
+    ("Do you have Samsung phones?", False),
+])
+def test_refers_to_history(query, follow_up):
+    assert refers_to_history(query) is follow_up
@@ -0,0 +1,207 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import httpx
+import pytest
+import requests
+
+import rag
+from search_client import CircuitBreaker, CircuitOpenError, SearchClient, SearchError
+
+RESULTS = {"organic_results": [{"title": "Galaxy S24", "snippet": "Giá 18 triệu", "link": "https://example.com/s24"}]}
+
+
+class StandIn:
+    """Local SerpAPI stand-in whose replies are set per test: "ok", "slow" or an error status"""
+
+    def __init__(self):
+        self.mode = "ok"
+        self.delay = 1.0
+        self.queries = []
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stand_in.queries.append(parse_qs(urlparse(self.path).query).get("q", [""])[0])
+                if stand_in.mode == "slow":
+                    time.sleep(stand_in.delay)
+                status = stand_in.mode if isinstance(stand_in.mode, int) else 200
+                body = json.dumps(RESULTS if status == 200 else {"error": "failed"}).encode("utf-8")
+                try:
+                    self.send_response(status)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except OSError:
+                    # The client gave up waiting
+                    pass
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/search"
+        threading.Thread(target=self.server.serve_forever, args=(0.01,), daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stand_in():
+    server = StandIn()
+    yield server
+    server.close()
+
+
+def make_client(stand_in, failure_threshold=2, reset_timeout=30.0, **kwargs):
+    return SearchClient(
+        base_url=stand_in.url,
+        api_key="test",
+        connect_timeout=1.0,
+        read_timeout=kwargs.pop("read_timeout", 0.2),
+        breaker=CircuitBreaker(failure_threshold, reset_timeout),
+        **kwargs,
+    )
+
+
+def test_search_returns_results_and_caches_them(stand_in):
+    client = make_client(stand_in)
+
+    assert client.search("Galaxy S24 giá") == RESULTS
+    assert client.search("  galaxy s24 GIÁ ") == RESULTS
+    assert stand_in.queries == ["Galaxy S24 giá"]
+    assert client.stats()["cache_hits"] == 1
+
+
+def test_read_timeout_counts_as_a_failure(stand_in):
+    client = make_client(stand_in)
+    stand_in.mode = "slow"
+
+    started = time.monotonic()
+    with pytest.raises(requests.exceptions.Timeout):
+        client.search("chậm")
+    assert time.monotonic() - started < stand_in.delay
+    assert client.breaker.state == "closed"
+
+
+def test_error_status_raises_search_error(stand_in):
+    client = make_client(stand_in)
+    stand_in.mode = 503
+
+    with pytest.raises(SearchError) as raised:
+        client.search("lỗi")
+    assert raised.value.status_code == 503
+
+
+def test_circuit_opens_after_repeated_failures_and_stops_calling(stand_in):
+    client = make_client(stand_in, failure_threshold=2)
+    stand_in.mode = 500
+
+    for query in ("a", "b"):
+        with pytest.raises(SearchError):
+            client.search(query)
+    assert client.breaker.state == "open"
+
+    with pytest.raises(CircuitOpenError):
+        client.search("c")
+    assert stand_in.queries == ["a", "b"]
+
+
+def test_cached_answers_are_served_while_the_circuit_is_open(stand_in):
+    client = make_client(stand_in, failure_threshold=1)
+    client.search("cached")
+    stand_in.mode = 500
+
+    with pytest.raises(SearchError):
+        client.search("fresh")
+    assert client.breaker.state == "open"
+    assert client.search("cached") == RESULTS
+
+
+def test_trial_call_after_reset_timeout_closes_the_circuit(stand_in):
+    client = make_client(stand_in, failure_threshold=1, reset_timeout=0.1)
+    stand_in.mode = 500
+    with pytest.raises(SearchError):
+        client.search("a")
+
+    time.sleep(0.15)
+    assert client.breaker.state == "half_open"
+    stand_in.mode = "ok"
+    assert client.search("b") == RESULTS
+    assert client.breaker.state == "closed"
+
+
+def test_failed_trial_call_reopens_the_circuit(stand_in):
+    client = make_client(stand_in, failure_threshold=1, reset_timeout=0.1)
+    stand_in.mode = 500
+    with pytest.raises(SearchError):
+        client.search("a")
+
+    time.sleep(0.15)
+    with pytest.raises(SearchError):
+        client.search("b")
+    assert client.breaker.state == "open"
+
+
+def test_async_search_times_out_and_then_recovers(stand_in):
+    client = make_client(stand_in, failure_threshold=1, reset_timeout=0.1)
+
+    async def main():
+        stand_in.mode = "slow"
+        with pytest.raises(httpx.TimeoutException):
+            await client.asearch("chậm")
+        assert client.breaker.state == "open"
+        with pytest.raises(CircuitOpenError):
+            await client.asearch("bị chặn")
+
+        await asyncio.sleep(0.15)
+        stand_in.mode = "ok"
+        return await client.asearch("nhanh")
+
+    assert asyncio.run(main()) == RESULTS
+    assert client.breaker.state == "closed"
+    assert "bị chặn" not in stand_in.queries
+
+
+def test_cancelled_async_search_does_not_count_as_a_failure(stand_in):
+    client = make_client(stand_in, failure_threshold=1, read_timeout=2.0)
+    stand_in.mode = "slow"
+
+    async def main():
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(client.asearch("hủy"), 0.05)
+
+    asyncio.run(main())
+    assert client.breaker.state == "closed"
+
+
+@pytest.fixture
+def search_internet_client(stand_in, monkeypatch):
+    client = make_client(stand_in, failure_threshold=1)
+    monkeypatch.setattr(rag, "get_search_client", lambda: client)
+    return client
+
+
+def test_search_internet_formats_results(stand_in, search_internet_client):
+    assert "1. Galaxy S24" in rag.search_internet("Galaxy S24")
+
+
+@pytest.mark.parametrize("mode, message", [
+    ("slow", "Unable to perform internet search at the moment."),
+    (502, "Internet search failed with status code: 502"),
+])
+def test_search_internet_falls_back_to_a_message(stand_in, search_internet_client, mode, message):
+    stand_in.mode = mode
+    assert rag.search_internet("Galaxy S24") == message
+    # The failure opened the circuit, so the next call is skipped
+    assert rag.search_internet("Galaxy S25") == "Internet search is temporarily unavailable."
+    assert asyncio.run(rag.asearch_internet("Galaxy S25")) == "Internet search is temporarily unavailable."
+    assert len(stand_in.queries) == 1
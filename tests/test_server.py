@@ -0,0 +1,111 @@
+import asyncio
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+from starlette.requests import ClientDisconnect
+
+import server
+
+
+@pytest.fixture
+def fresh_server(monkeypatch):
+    monkeypatch.setattr(server, "limiter", server.TurnLimiter(max_concurrency=2, max_queue=2, queue_timeout=1))
+    monkeypatch.setattr(server, "readiness", {"ready": False, "checks": {}, "attempted_at": None})
+    monkeypatch.setattr(server, "_warm_up_task", None)
+    monkeypatch.setattr(server, "SERVER_WARMUP_RETRY_INTERVAL", 0)
+
+
+def test_readyz_retries_a_failed_warm_up(fresh_server, monkeypatch):
+    attempts = []
+
+    def flaky_warm_up():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise RuntimeError("index not built yet")
+        return {"shops": 3}
+
+    monkeypatch.setattr(server, "_warm_up", flaky_warm_up)
+    with TestClient(server.app) as client:
+        assert client.get("/readyz").status_code == 503
+
+        deadline = time.monotonic() + 2
+        while client.get("/readyz").status_code != 200:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+        assert client.get("/readyz").json()["checks"] == {"shops": 3}
+    assert len(attempts) == 2
+
+
+def test_readyz_does_not_start_overlapping_warm_ups(fresh_server, monkeypatch):
+    monkeypatch.setattr(server, "SERVER_WARMUP_RETRY_INTERVAL", 60)
+    calls = []
+
+    def failing_warm_up():
+        calls.append(1)
+        raise RuntimeError("still failing")
+
+    monkeypatch.setattr(server, "_warm_up", failing_warm_up)
+    with TestClient(server.app) as client:
+        for _ in range(5):
+            assert client.get("/readyz").status_code == 503
+    # Only the startup attempt: retries wait for the interval
+    assert len(calls) == 1
+
+
+def test_closing_response_runs_on_close_when_the_client_is_gone():
+    closed = []
+
+    async def body():
+        yield "never sent"
+
+    async def on_close():
+        closed.append(True)
+
+    async def receive():
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        raise OSError("client went away")
+
+    response = server.ClosingStreamingResponse(body(), on_close=on_close)
+    with pytest.raises(ClientDisconnect):
+        asyncio.run(response({"type": "http", "asgi": {"spec_version": "2.4"}}, receive, send))
+    assert closed == [True]
+
+
+def test_stream_frees_its_slot_and_closes_the_turn_when_the_client_leaves_early(fresh_server, monkeypatch):
+    turn_closed = []
+
+    async def endless_turn(input_state, node_events=False):
+        try:
+            while True:
+                await asyncio.sleep(0.01)
+                yield "token", "x"
+        finally:
+            turn_closed.append(True)
+
+    monkeypatch.setattr(server, "astream_turn", endless_turn)
+    sent = []
+
+    async def receive():
+        await asyncio.sleep(10)
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message["type"])
+        # Gone after the accepted event and the first token
+        if len(sent) == 3:
+            raise OSError("client went away")
+
+    async def main():
+        request = server.ChatRequest(message="Samsung giá rẻ")
+        response = await server.chat_stream(request, None)
+        assert server.limiter.running == 1
+        with pytest.raises(ClientDisconnect):
+            await response({"type": "http", "asgi": {"spec_version": "2.4"}}, receive, send)
+
+    asyncio.run(main())
+    assert sent == ["http.response.start", "http.response.body", "http.response.body"]
+    assert server.limiter.running == 0
+    assert turn_closed == [True]
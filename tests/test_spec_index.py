@@ -0,0 +1,75 @@
+import pytest
+
+from spec_index import SpecIndex, has_numeric_filters, parse_query_filters
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("điện thoại dưới 5 triệu", {"max_price": 5_000_000}),
+    ("từ 3 đến 5 triệu", {"min_price": 3_000_000, "max_price": 5_000_000}),
+    ("under 5 million", {"max_price": 5_000_000}),
+    ("điện thoại 256GB", {"min_storage_gb": 256.0}),
+    ("RAM 8GB", {"min_ram_gb": 8.0}),
+    ("bộ nhớ trong 1TB", {"min_storage_gb": 1024.0}),
+    ("Samsung A05s 6GB/128GB", {"min_ram_gb": 6.0, "min_storage_gb": 128.0, "brand": ["samsung"]}),
+    ("pin trên 5000 mah", {"min_battery_mah": 5000.0}),
+    ("battery 6000mAh", {"min_battery_mah": 6000.0}),
+    ("iPhone 15 giá bao nhiêu", {"brand": ["apple"]}),
+])
+def test_parse_query_filters(query, expected):
+    assert parse_query_filters(query) == expected
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("Điện thoại nào rẻ hơn 5 triệu?", {"max_price": 5_000_000}),
+    ("giá thấp hơn 4 triệu", {"max_price": 4_000_000}),
+    ("ít hơn 3tr", {"max_price": 3_000_000}),
+    ("phones cheaper than 6 million", {"max_price": 6_000_000}),
+    ("less than 2 million", {"max_price": 2_000_000}),
+    ("máy đắt hơn 10 triệu", {"min_price": 10_000_000}),
+    ("cao hơn 8 triệu", {"min_price": 8_000_000}),
+    ("nhiều hơn 7 triệu", {"min_price": 7_000_000}),
+    ("điện thoại trên 20 triệu", {"min_price": 20_000_000}),
+    ("over 15 million", {"min_price": 15_000_000}),
+    ("at least 3 million", {"min_price": 3_000_000}),
+])
+def test_price_comparisons_keep_their_direction(query, expected):
+    assert parse_query_filters(query) == expected
+
+
+def test_bare_hon_is_not_a_price_floor():
+    assert parse_query_filters("hơn 2 triệu một chút") == {}
+
+
+def test_cheaper_than_query_ranks_cheap_products():
+    metadatas = [
+        {"price_vnd": 24_990_000, "brand": "samsung"},
+        {"price_vnd": 3_490_000, "brand": "samsung"},
+    ]
+    index = SpecIndex.build(["s24-ultra", "a05s"], metadatas)
+    positions = index.filter(parse_query_filters("Điện thoại nào rẻ hơn 5 triệu?"))
+    assert [index.ids[p] for p in positions] == ["a05s"]
+
+
+def test_price_keywords_need_word_boundaries():
+    # "rtu" and "thon" are not "tu" / "hon"
+    assert parse_query_filters("rtu 5 trieu") == {}
+    assert parse_query_filters("thon 10 trieu") == {}
+
+
+def test_only_price_and_spec_filters_count_as_numeric():
+    assert not has_numeric_filters({"brand": ["apple"]})
+    assert has_numeric_filters({"brand": ["apple"], "max_price": 5_000_000})
+
+
+def test_filter_applies_parsed_constraints():
+    metadatas = [
+        {"price_vnd": 3_000_000, "ram_gb": 4.0, "storage_gb": 64.0, "battery_mah": 5000.0, "brand": "samsung"},
+        {"price_vnd": 6_000_000, "ram_gb": 6.0, "storage_gb": 128.0, "battery_mah": 4000.0, "brand": "samsung"},
+        {"price_vnd": 4_000_000, "ram_gb": 8.0, "storage_gb": 256.0, "battery_mah": 6000.0, "brand": "xiaomi"},
+    ]
+    index = SpecIndex.build(["a", "b", "c"], metadatas)
+    matching = lambda query: [index.ids[p] for p in index.filter(parse_query_filters(query))]
+
+    assert matching("Samsung 6GB/128GB") == ["b"]
+    assert matching("pin trên 5000 mah dưới 5 triệu") == ["a", "c"]
+    assert matching("điện thoại 256GB") == ["c"]
@@ -0,0 +1,374 @@
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Comma-separated sinks: "ring", "jsonl", "prometheus"; empty disables tracing
+TRACE_SINKS = os.getenv("TRACE_SINKS", "ring")
+TRACE_JSONL_PATH = os.getenv("TRACE_JSONL_PATH", "./traces/spans.jsonl")
+TRACE_RING_SIZE = int(os.getenv("TRACE_RING_SIZE", "2048"))
+# Serve the Prometheus sink's text on this port (empty = no server)
+TRACE_METRICS_PORT = os.getenv("TRACE_METRICS_PORT", "")
+
+# Histogram buckets (seconds) for span durations
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Per-turn totals kept for turns that have not finished yet
+MAX_OPEN_TURNS = 1024
+
+# Numeric attributes summed into the per-turn totals (cache_hit=True counts as one cache hit)
+TURN_TOTALS = ("tokens_in", "tokens_out", "cache_hits", "retries")
+
+
+class Span:
+    """One timed operation within a turn
+
+    kind is "turn", "node", "llm", "embedding", "retrieval" or "search".
+    Attributes hold what was measured: tokens_in / tokens_out, cache_hit,
+    retries, error, and operation-specific details.
+    """
+
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "kind", "start", "duration", "attributes")
+
+    def __init__(self, name: str, kind: str, trace_id: Optional[str], parent_id: Optional[str]):
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start = time.time()
+        self.duration: Optional[float] = None
+        self.attributes: Dict[str, Any] = {}
+
+    def set(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "kind": self.kind,
+            "start": self.start,
+            "duration": self.duration,
+            "attributes": self.attributes,
+        }
+
+
+class SpanSink:
+    """Destination for finished spans"""
+
+    def emit(self, span: Span) -> None:
+        raise NotImplementedError
+
+
+class JsonlSink(SpanSink):
+    """Appends one JSON object per span to a file"""
+
+    def __init__(self, path: str = TRACE_JSONL_PATH):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._file = open(path, "a", encoding="utf-8")
+
+    def emit(self, span: Span) -> None:
+        line = json.dumps(span.to_dict(), ensure_ascii=False, default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+
+class RingBufferSink(SpanSink):
+    """Keeps the most recent spans in memory"""
+
+    def __init__(self, capacity: int = TRACE_RING_SIZE):
+        self._spans: deque = deque(maxlen=capacity)
+        self._lock = threading.Lock()
+
+    def emit(self, span: Span) -> None:
+        with self._lock:
+            self._spans.append(span.to_dict())
+
+    def spans(self, trace_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [span for span in self._spans if trace_id is None or span["trace_id"] == trace_id]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._spans.clear()
+
+
+def _labels(**labels: str) -> str:
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+
+
+class PrometheusSink(SpanSink):
+    """Aggregates spans into counters and duration histograms in Prometheus text format"""
+
+    def __init__(self, buckets: Tuple[float, ...] = DURATION_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counts: Counter = Counter()
+        self._sums: Counter = Counter()
+        self._bucket_counts: Counter = Counter()
+        self._errors: Counter = Counter()
+        self._tokens: Counter = Counter()
+        self._cache_hits: Counter = Counter()
+        self._retries: Counter = Counter()
+
+    def emit(self, span: Span) -> None:
+        key = (span.kind, span.name)
+        attributes = span.attributes
+        with self._lock:
+            self._counts[key] += 1
+            self._sums[key] += span.duration or 0.0
+            for bucket in self.buckets:
+                if (span.duration or 0.0) <= bucket:
+                    self._bucket_counts[key + (bucket,)] += 1
+            if attributes.get("error"):
+                self._errors[key] += 1
+            if span.kind == "turn":
+                # Turn spans carry totals already counted on their child spans
+                return
+            for direction in ("in", "out"):
+                if attributes.get(f"tokens_{direction}"):
+                    self._tokens[key + (direction,)] += attributes[f"tokens_{direction}"]
+            cache_hits = attributes.get("cache_hits") or (1 if attributes.get("cache_hit") else 0)
+            if cache_hits:
+                self._cache_hits[key] += cache_hits
+            if attributes.get("retries"):
+                self._retries[key] += attributes["retries"]
+
+    def render(self) -> str:
+        lines = [
+            "# HELP agent_span_duration_seconds Wall time of traced operations",
+            "# TYPE agent_span_duration_seconds histogram",
+        ]
+        with self._lock:
+            for key in sorted(self._counts):
+                kind, name = key
+                for bucket in self.buckets:
+                    lines.append(
+                        f"agent_span_duration_seconds_bucket{_labels(kind=kind, name=name, le=str(bucket))} "
+                        f"{self._bucket_counts[key + (bucket,)]}"
+                    )
+                lines.append(f"agent_span_duration_seconds_bucket{_labels(kind=kind, name=name, le='+Inf')} {self._counts[key]}")
+                lines.append(f"agent_span_duration_seconds_sum{_labels(kind=kind, name=name)} {self._sums[key]:.6f}")
+                lines.append(f"agent_span_duration_seconds_count{_labels(kind=kind, name=name)} {self._counts[key]}")
+
+            lines += ["# HELP agent_span_errors_total Traced operations that raised", "# TYPE agent_span_errors_total counter"]
+            for (kind, name), count in sorted(self._errors.items()):
+                lines.append(f"agent_span_errors_total{_labels(kind=kind, name=name)} {count}")
+
+            lines += ["# HELP agent_tokens_total Model tokens by direction", "# TYPE agent_tokens_total counter"]
+            for (kind, name, direction), count in sorted(self._tokens.items()):
+                lines.append(f"agent_tokens_total{_labels(kind=kind, name=name, direction=direction)} {count}")
+
+            lines += ["# HELP agent_cache_hits_total Operations answered from a cache or memo", "# TYPE agent_cache_hits_total counter"]
+            for (kind, name), count in sorted(self._cache_hits.items()):
+                lines.append(f"agent_cache_hits_total{_labels(kind=kind, name=name)} {count}")
+
+            lines += ["# HELP agent_retries_total Retries inside traced operations", "# TYPE agent_retries_total counter"]
+            for (kind, name), count in sorted(self._retries.items()):
+                lines.append(f"agent_retries_total{_labels(kind=kind, name=name)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+_current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("current_span", default=None)
+_current_trace: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("current_trace", default=None)
+
+
+class Tracer:
+    """Creates spans, tracks per-turn totals and forwards finished spans to the sinks"""
+
+    def __init__(self, sinks: Optional[List[SpanSink]] = None):
+        self.sinks: List[SpanSink] = list(sinks or [])
+        self._lock = threading.Lock()
+        self._turns: "OrderedDict[str, Counter]" = OrderedDict()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.sinks)
+
+    def add_sink(self, sink: SpanSink) -> None:
+        self.sinks.append(sink)
+
+    def find_sink(self, sink_type: type) -> Optional[SpanSink]:
+        return next((sink for sink in self.sinks if isinstance(sink, sink_type)), None)
+
+    def _accumulate(self, span: Span) -> None:
+        if span.trace_id is None or span.kind == "turn":
+            return
+        with self._lock:
+            totals = self._turns.get(span.trace_id)
+            if totals is None:
+                totals = self._turns[span.trace_id] = Counter()
+                while len(self._turns) > MAX_OPEN_TURNS:
+                    self._turns.popitem(last=False)
+            totals[f"{span.kind}_calls"] += 1
+            totals[f"{span.kind}_seconds"] += span.duration or 0.0
+            for attribute in TURN_TOTALS:
+                value = span.attributes.get(attribute)
+                if value:
+                    totals[attribute] += value
+            if span.attributes.get("cache_hit"):
+                totals["cache_hits"] += 1
+
+    def finish(self, span: Span) -> None:
+        span.duration = time.time() - span.start
+        self._accumulate(span)
+        for sink in self.sinks:
+            try:
+                sink.emit(span)
+            except Exception as e:
+                print(f"[System] Trace sink {type(sink).__name__} failed: {e}")
+
+    @contextmanager
+    def span(self, name: str, kind: str, trace_id: Optional[str] = None, **attributes: Any) -> Iterator[Optional[Span]]:
+        """Time the enclosed block as a child of the current span
+
+        Yields None when tracing is off, so callers annotate through
+        annotate() or check the yielded value.
+        """
+        if not self.enabled:
+            yield None
+            return
+
+        parent = _current_span.get()
+        trace_id = trace_id or (parent.trace_id if parent else _current_trace.get())
+        span = Span(name, kind, trace_id, parent.span_id if parent else None)
+        span.set(**attributes)
+        span_token = _current_span.set(span)
+        trace_token = _current_trace.set(trace_id)
+        try:
+            yield span
+        except BaseException as e:
+            span.set(error=f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            _current_span.reset(span_token)
+            _current_trace.reset(trace_token)
+            self.finish(span)
+
+    def record_turn(self, trace_id: Optional[str], started_at: Optional[float], **attributes: Any) -> None:
+        """Emit the turn span with the totals of every span recorded for it"""
+        if not self.enabled or trace_id is None:
+            return
+        with self._lock:
+            totals = self._turns.pop(trace_id, Counter())
+        span = Span("turn", "turn", trace_id, None)
+        if started_at is not None:
+            span.start = started_at
+        span.set(**{key: round(value, 6) if isinstance(value, float) else value for key, value in totals.items()})
+        span.set(**attributes)
+        self.finish(span)
+
+    def discard_turn(self, trace_id: Optional[str]) -> None:
+        """Drop the totals kept for a trace that never gets a turn span"""
+        if trace_id is None:
+            return
+        with self._lock:
+            self._turns.pop(trace_id, None)
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def annotate(**attributes: Any) -> None:
+    """Add attributes to the innermost open span, if any"""
+    span = _current_span.get()
+    if span is not None:
+        span.set(**attributes)
+
+
+def create_sinks(names: str = TRACE_SINKS) -> List[SpanSink]:
+    sinks: List[SpanSink] = []
+    for name in [name.strip().lower() for name in names.split(",") if name.strip()]:
+        if name == "ring":
+            sinks.append(RingBufferSink())
+        elif name == "jsonl":
+            sinks.append(JsonlSink())
+        elif name == "prometheus":
+            sinks.append(PrometheusSink())
+        else:
+            raise ValueError(f"Unknown trace sink: {name}")
+    return sinks
+
+
+def start_metrics_server(sink: PrometheusSink, port: int) -> ThreadingHTTPServer:
+    """Serve the sink's metrics text on GET /metrics from a daemon thread"""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = sink.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True, name="trace-metrics").start()
+    print(f"[System] Serving trace metrics on :{port}/metrics")
+    return server
+
+
+_tracer: Optional[Tracer] = None
+_tracer_lock = threading.Lock()
+
+
+def get_tracer() -> Tracer:
+    """Process-wide tracer with the sinks named in TRACE_SINKS"""
+    global _tracer
+    if _tracer is None:
+        with _tracer_lock:
+            if _tracer is None:
+                tracer = Tracer(create_sinks())
+                prometheus = tracer.find_sink(PrometheusSink)
+                if prometheus is not None and TRACE_METRICS_PORT:
+                    start_metrics_server(prometheus, int(TRACE_METRICS_PORT))
+                _tracer = tracer
+    return _tracer
+
+
+def span(name: str, kind: str, trace_id: Optional[str] = None, **attributes: Any):
+    """Shortcut for get_tracer().span(...)"""
+    return get_tracer().span(name, kind, trace_id, **attributes)
+
+
+def traced_node(name: str, func: Callable[[Dict[str, Any]], Any]) -> Callable[[Dict[str, Any]], Any]:
+    """Wrap a blocking graph node in a "node" span for the state's turn"""
+    def run(state):
+        with span(name, "node", state.get("trace_id"), iteration=state.get("current_iteration")):
+            return func(state)
+    run.__name__ = name
+    return run
+
+
+def atraced_node(name: str, afunc: Callable[[Dict[str, Any]], Any]) -> Callable[[Dict[str, Any]], Any]:
+    """Async variant of traced_node"""
+    async def run(state):
+        with span(name, "node", state.get("trace_id"), iteration=state.get("current_iteration")):
+            return await afunc(state)
+    run.__name__ = name
+    return run